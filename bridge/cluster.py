@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+多进程模式：N 个 worker 进程通过 SO_REUSEPORT 共享同一端口，由 Unix socket 中继（broker）连接
+
+- supervisor（主进程）只负责启动 broker 和 worker 进程，worker 意外退出时重启
+- 每个 worker 注册完客户端后向 broker 发送 claim（client_id / 角色 / 元数据），
+  broker 维护全局目录并转发给其他 worker；其他 worker 在本地注册表中放一个远程代理条目，
+  get_by_id / get_by_type 等查询和原来一样可用，发给远程代理的帧经 broker 转交所属 worker
+- session 相关消息按 session_id 哈希固定到一个 worker（home），保证 seq 和输入队列只有一份
+- server 发出的 execute_js 请求的 request_id 带 worker 标记，结果回到其他 worker 时转回发起方
+
+线路格式（每行一帧）：  "<op> <worker> <json>\\n"
+  worker → broker：<worker> 为目标 worker（claim / release 为 "*"）
+  broker → worker：<worker> 为来源 worker；broker 只解析行头，正文原样转发
+
+环境变量：
+  ORTENSIA_WORKERS         worker 进程数（默认 1 = 单进程，不启用 broker）
+  ORTENSIA_CLUSTER_SOCKET  broker 的 Unix socket 路径（默认 $TMPDIR/ortensia-<port>.sock）
+  ORTENSIA_WORKER_ID       由 supervisor 设置，标记当前进程是第几个 worker
+"""
+
+import asyncio
+import logging
+import os
+import re
+import socket
+import tempfile
+import zlib
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from codec import TEXT_CODEC
+
+logger = logging.getLogger(__name__)
+
+WORKERS_ENV = "ORTENSIA_WORKERS"
+WORKER_ID_ENV = "ORTENSIA_WORKER_ID"
+SOCKET_ENV = "ORTENSIA_CLUSTER_SOCKET"
+
+# worker → broker
+OP_HELLO = "hello"
+OP_CLAIM = "claim"        # 客户端在本 worker 注册 / 角色或元数据变化
+OP_RELEASE = "release"    # 客户端从本 worker 断开
+OP_DELIVER = "deliver"    # 把已编码的帧交给目标 worker 上的客户端
+OP_MESSAGE = "message"    # 把客户端发来的消息交给目标 worker 处理（session home）
+OP_RESULT = "result"      # server 发起的请求的响应，交还发起请求的 worker
+
+_BROADCAST = "*"
+_REQUEST_OWNER = re.compile(r"_w(\d+)_\d+\Z")
+
+RESTART_BACKOFF = 1.0  # worker 意外退出后的重启间隔（秒）
+LINE_LIMIT = 16 * 1024 * 1024  # 单行上限（websocket 帧转义后嵌在 JSON 字符串中）
+
+
+def cluster_supported() -> bool:
+    """当前平台是否支持多进程模式（需要 SO_REUSEPORT 和 Unix socket）"""
+    return hasattr(socket, "SO_REUSEPORT") and hasattr(socket, "AF_UNIX")
+
+
+def default_socket_path(port: int) -> str:
+    return os.path.join(tempfile.gettempdir(), f"ortensia-{port}.sock")
+
+
+def home_worker(session_id: str, workers: int) -> int:
+    """session 固定到的 worker（跨进程稳定，不能用内置 hash）"""
+    return zlib.crc32(session_id.encode("utf-8")) % workers
+
+
+def request_owner(request_id: Optional[str]) -> Optional[int]:
+    """从 PendingRequests 生成的 request_id 中取出发起请求的 worker"""
+    m = _REQUEST_OWNER.search(request_id or "")
+    return int(m.group(1)) if m else None
+
+
+def _encode_line(op: str, worker, body: Dict[str, Any]) -> bytes:
+    return f"{op} {worker} {TEXT_CODEC.encode(body)}\n".encode("utf-8")
+
+
+def _split_line(line: bytes) -> Tuple[str, str, bytes]:
+    op, worker, body = line.split(b" ", 2)
+    return op.decode("ascii"), worker.decode("ascii"), body
+
+
+# ============================================================================
+# Broker（supervisor 进程内）
+# ============================================================================
+
+class ClusterBroker:
+    """在 worker 之间转发帧，并维护 client_id → (worker, claim) 目录"""
+
+    def __init__(self):
+        self._writers: Dict[str, asyncio.StreamWriter] = {}
+        self._directory: Dict[str, Tuple[str, bytes]] = {}  # client_id → (worker, claim 正文)
+        self.stats = {"forwarded": 0, "claims": 0, "releases": 0, "unroutable": 0}
+
+    def _send(self, worker: str, op: str, source: str, body: bytes):
+        writer = self._writers.get(worker)
+        if writer is None:
+            self.stats["unroutable"] += 1
+            return
+        writer.write(b"%s %s %s" % (op.encode("ascii"), source.encode("ascii"), body))
+
+    def _broadcast(self, op: str, source: str, body: bytes):
+        for worker in self._writers:
+            if worker != source:
+                self._send(worker, op, source, body)
+
+    def _release(self, client_id: str, worker: str):
+        """只有当前所有者的 release 才生效（客户端可能已重连到别的 worker）"""
+        owner = self._directory.get(client_id)
+        if owner is None or owner[0] != worker:
+            return
+        del self._directory[client_id]
+        self.stats["releases"] += 1
+        self._broadcast(OP_RELEASE, worker, TEXT_CODEC.encode({"client_id": client_id}).encode("utf-8") + b"\n")
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker = None
+        try:
+            hello = await reader.readline()
+            op, worker, _ = _split_line(hello)
+            if op != OP_HELLO:
+                raise ValueError(f"期望 hello，收到 {op}")
+            self._writers[worker] = writer
+            # 新 worker（或重启的 worker）先拿到其他 worker 上的全部客户端
+            for owner, body in self._directory.values():
+                if owner != worker:
+                    self._send(worker, OP_CLAIM, owner, body)
+            logger.info(f"🔗 [Cluster] worker {worker} 已连接（共 {len(self._writers)} 个）")
+
+            async for line in reader:
+                op, target, body = _split_line(line)
+                if op == OP_CLAIM:
+                    client_id = TEXT_CODEC.decode(body)["client_id"]
+                    self._directory[client_id] = (worker, body)
+                    self.stats["claims"] += 1
+                    self._broadcast(op, worker, body)
+                elif op == OP_RELEASE:
+                    self._release(TEXT_CODEC.decode(body)["client_id"], worker)
+                else:
+                    self.stats["forwarded"] += 1
+                    self._send(target, op, worker, body)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"⚠️  [Cluster] worker {worker} 连接异常: {e}")
+        finally:
+            if worker is not None and self._writers.get(worker) is writer:
+                del self._writers[worker]
+                for client_id, (owner, _) in list(self._directory.items()):
+                    if owner == worker:
+                        self._release(client_id, worker)
+                logger.info(f"🔌 [Cluster] worker {worker} 已断开")
+            writer.close()
+
+
+async def run_supervisor(argv: List[str], workers: int, socket_path: str):
+    """启动 broker 和 N 个 worker 进程，直到被取消"""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    broker = ClusterBroker()
+    server = await asyncio.start_unix_server(broker.handle_worker, path=socket_path, limit=LINE_LIMIT)
+    logger.info(f"🧩 [Cluster] broker: {socket_path}，启动 {workers} 个 worker")
+
+    async def spawn(worker_id: int):
+        env = dict(os.environ, **{WORKER_ID_ENV: str(worker_id), SOCKET_ENV: socket_path, WORKERS_ENV: str(workers)})
+        return await asyncio.create_subprocess_exec(*argv, env=env)
+
+    async def keep_running(worker_id: int):
+        while True:
+            proc = await spawn(worker_id)
+            try:
+                code = await proc.wait()
+            except asyncio.CancelledError:
+                if proc.returncode is None:
+                    proc.terminate()
+                    try:
+                        await asyncio.wait_for(proc.wait(), 5)
+                    except asyncio.TimeoutError:
+                        proc.kill()
+                raise
+            logger.error(f"❌ [Cluster] worker {worker_id} 退出（code={code}），{RESTART_BACKOFF:g}s 后重启")
+            await asyncio.sleep(RESTART_BACKOFF)
+
+    tasks = [asyncio.create_task(keep_running(i)) for i in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+# ============================================================================
+# Worker 端
+# ============================================================================
+
+ClusterHandler = Callable[[str, int, Dict[str, Any]], Awaitable[None]]
+
+
+class ClusterLink:
+    """worker 到 broker 的连接"""
+
+    def __init__(self, worker_id: int, workers: int, socket_path: str):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.socket_path = socket_path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self.stats = {"sent": 0, "received": 0, "send_failures": 0}
+
+    async def connect(self, on_message: ClusterHandler, attempts: int = 50):
+        """连接 broker 并开始接收；broker 可能比 worker 晚就绪，短暂重试"""
+        for _ in range(attempts):
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.socket_path, limit=LINE_LIMIT)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError(f"无法连接 cluster broker: {self.socket_path}")
+        self._writer.write(_encode_line(OP_HELLO, self.worker_id, {}))
+        self._reader_task = asyncio.create_task(self._read_loop(reader, on_message))
+
+    async def _read_loop(self, reader: asyncio.StreamReader, on_message: ClusterHandler):
+        try:
+            async for line in reader:
+                op, source, body = _split_line(line)
+                self.stats["received"] += 1
+                try:
+                    await on_message(op, int(source), TEXT_CODEC.decode(body))
+                except Exception as e:
+                    logger.error(f"❌ [Cluster] 处理 {op} 失败: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ [Cluster] broker 连接异常: {e}")
+        logger.error("❌ [Cluster] 与 broker 的连接已断开，跨 worker 消息将无法投递")
+        self._writer = None
+
+    def _send(self, op: str, target, body: Dict[str, Any]) -> bool:
+        if self._writer is None:
+            self.stats["send_failures"] += 1
+            return False
+        self._writer.write(_encode_line(op, target, body))
+        self.stats["sent"] += 1
+        return True
+
+    def home_worker(self, session_id: str) -> int:
+        return home_worker(session_id, self.workers)
+
+    def claim(self, client_id: str, roles, metadata: Dict[str, Any]):
+        self._send(OP_CLAIM, _BROADCAST, {"client_id": client_id, "roles": sorted(roles), "metadata": metadata})
+
+    def release(self, client_id: str):
+        self._send(OP_RELEASE, _BROADCAST, {"client_id": client_id})
+
+    def deliver(self, worker: int, to: Union[str, List[str]], frame: str, msg_type: Optional[str]) -> bool:
+        """to 为单个 client_id 或同一 worker 上的多个 client_id（广播时合并为一帧）"""
+        return self._send(OP_DELIVER, worker, {"to": to, "frame": frame, "msg_type": msg_type})
+
+    def forward_message(self, worker: int, origin_id: str, frame: str) -> bool:
+        return self._send(OP_MESSAGE, worker, {"origin": origin_id, "frame": frame})
+
+    def forward_result(self, worker: int, frame: str) -> bool:
+        return self._send(OP_RESULT, worker, {"frame": frame})
+
+    def snapshot(self) -> Dict[str, int]:
+        return {"worker": self.worker_id, "workers": self.workers, "connected": int(self._writer is not None), **self.stats}
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
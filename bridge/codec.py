@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Ortensia 协议编解码层
+
+- JsonCodec:    标准库 json（始终可用）
+- OrjsonCodec:  orjson（已安装时作为默认文本编解码器）
+- MsgpackCodec: msgpack 二进制帧（可选，客户端在 register 时协商）
+
+文本编解码器在线路上完全兼容（都是 UTF-8 JSON 文本帧），只是编码速度不同；
+二进制编解码器需要对端支持，服务端只对在 register payload 的 codecs 列表中声明了它的客户端使用。
+
+另外提供 peek_route()：只从帧开头提取 type / from / to，
+供服务端对纯转发类消息（*_RESULT 等）跳过完整解析、原样转发。
+"""
+
+import json
+import re
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 取决于运行环境
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - 取决于运行环境
+    msgpack = None
+
+Frame = Union[str, bytes]
+
+
+class JsonCodec:
+    """标准库 json"""
+    name = "json"
+    binary = False
+
+    def encode(self, data: Dict[str, Any]) -> str:
+        return json.dumps(data, ensure_ascii=False)
+
+    def decode(self, frame: Frame) -> Dict[str, Any]:
+        return json.loads(frame)
+
+
+class OrjsonCodec:
+    """orjson：输出与 JsonCodec 兼容的 UTF-8 JSON 文本"""
+    name = "orjson"
+    binary = False
+
+    def encode(self, data: Dict[str, Any]) -> str:
+        # OPT_NON_STR_KEYS：兼容 payload 中偶尔出现的非字符串 key（stdlib json 会自动转成字符串）
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def decode(self, frame: Frame) -> Dict[str, Any]:
+        return orjson.loads(frame)
+
+
+class MsgpackCodec:
+    """msgpack 二进制帧"""
+    name = "msgpack"
+    binary = True
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, frame: Frame) -> Dict[str, Any]:
+        return msgpack.unpackb(frame, raw=False)
+
+
+JSON_CODEC = JsonCodec()
+TEXT_CODEC = OrjsonCodec() if orjson is not None else JSON_CODEC
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+
+# 可协商的编解码器（名称 → 实例）；"orjson" 对客户端而言等同于 "json"
+AVAILABLE_CODECS: Dict[str, Any] = {"json": TEXT_CODEC, "orjson": TEXT_CODEC}
+if MSGPACK_CODEC is not None:
+    AVAILABLE_CODECS["msgpack"] = MSGPACK_CODEC
+
+
+def negotiate_codec(requested: Optional[Iterable[str]]):
+    """
+    按客户端偏好顺序选择第一个服务端支持的编解码器
+
+    Args:
+        requested: register payload 中的 codecs 列表（None 表示只支持 JSON）
+    """
+    for name in requested or ():
+        codec = AVAILABLE_CODECS.get(str(name).lower())
+        if codec is not None:
+            return codec
+    return TEXT_CODEC
+
+
+def decode_frame(frame: Frame) -> Dict[str, Any]:
+    """解码一帧：文本帧按 JSON，二进制帧按 msgpack"""
+    if isinstance(frame, str):
+        return TEXT_CODEC.decode(frame)
+    if MSGPACK_CODEC is None:
+        raise ValueError("收到二进制帧，但服务端未安装 msgpack")
+    return MSGPACK_CODEC.decode(frame)
+
+
+# 只匹配以 type / from / to 开头的顶层对象（所有官方客户端都按这个顺序序列化）；
+# 其他顺序或带转义的值返回 None，由调用方回退到完整解析
+_ROUTE_PEEK = re.compile(
+    r'\A\s*\{\s*"type"\s*:\s*"([^"\\]*)"\s*,'
+    r'\s*"from"\s*:\s*"([^"\\]*)"\s*,'
+    r'\s*"to"\s*:\s*(?:"([^"\\]*)"|null)'
+)
+
+
+def peek_route(frame: Frame) -> Optional[Tuple[str, str, Optional[str]]]:
+    """
+    不解析整帧，只读取开头的 (type, from, to)
+
+    Returns:
+        (type, from, to)；帧不是以这三个字段开头的文本 JSON 时返回 None
+    """
+    if not isinstance(frame, str):
+        return None
+    m = _ROUTE_PEEK.match(frame)
+    if m is None:
+        return None
+    return m.group(1), m.group(2), m.group(3) or None
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+注入脚本模板（在 Cursor 渲染进程中执行的 JavaScript）
+
+每个脚本只定义一次：一个接收 args 对象的函数表达式。
+- 支持模板的 inject（register 的 capabilities 含 "js_templates"）在注册时收到全部模板定义，
+  之后 execute_js 只携带模板名 / hash / JSON 参数；inject 在每个渲染进程里按 hash 缓存编译好的函数，
+  每次调用只需解析一行调用代码
+- 不支持模板的旧 inject：服务端用 render() 生成内联代码，行为完全一致
+
+脚本与服务端逻辑解耦，可以单独导出调试：
+  python js_templates.py                                   # 列出模板、hash 与大小
+  python js_templates.py cursor_input_text '{"text": "hi"}'  # 输出内联代码（可粘贴到 DevTools 执行）
+"""
+
+import hashlib
+import json
+import sys
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+JS_TEMPLATES_CAPABILITY = "js_templates"
+
+
+@dataclass(frozen=True)
+class JsTemplate:
+    """一个注入脚本：source 为函数表达式，调用方式为 source(args)"""
+    name: str
+    source: str
+    hash: str = field(init=False)
+
+    def __post_init__(self):
+        digest = hashlib.sha1(self.source.encode("utf-8")).hexdigest()[:12]
+        object.__setattr__(self, "hash", digest)
+
+    def render(self, args: Optional[Dict[str, Any]] = None) -> str:
+        """生成内联调用代码（不支持模板的 inject 使用）"""
+        return f"({self.source})({json.dumps(args or {}, ensure_ascii=False)})"
+
+    def definition(self) -> Dict[str, str]:
+        """发给 inject 的模板定义"""
+        return {"name": self.name, "hash": self.hash, "source": self.source}
+
+
+TEMPLATES: Dict[str, JsTemplate] = {}
+
+
+def define_template(name: str, source: str) -> JsTemplate:
+    """登记模板（同名覆盖）"""
+    template = JsTemplate(name=name, source=source.strip())
+    TEMPLATES[name] = template
+    return template
+
+
+def get_template(name: str) -> JsTemplate:
+    return TEMPLATES[name]
+
+
+def template_definitions() -> List[Dict[str, str]]:
+    return [t.definition() for t in TEMPLATES.values()]
+
+
+# ============================================================================
+# 内置模板
+# ============================================================================
+
+# 输入文本（可选按 Enter 执行）
+# args: {text, conversation_id, execute}
+# 🔑 广播模式：脚本内包含 conversation_id 检查，不匹配的窗口返回 {skipped: true, current}
+# 使用模拟键盘输入的方式，适用于 Lexical 等复杂编辑器
+CURSOR_INPUT_TEXT = define_template("cursor_input_text", r'''
+async function(args) {
+    try {
+        // 🔑 首先检查 conversation_id 是否匹配（广播模式下的过滤）
+        const targetConversationId = args.conversation_id || null;
+        
+        if (targetConversationId) {
+            // 提取当前窗口的 conversation_id
+            const convEl = document.querySelector('[id^="composer-bottom-add-context-"]');
+            let currentConvId = null;
+            if (convEl) {
+                const match = convEl.id.match(/composer-bottom-add-context-([a-f0-9-]+)/);
+                currentConvId = match ? match[1] : null;
+            }
+            
+            // 如果不匹配，跳过执行
+            if (currentConvId !== targetConversationId) {
+                return JSON.stringify({
+                    success: true,
+                    skipped: true,
+                    reason: 'conversation_id 不匹配',
+                    target: targetConversationId,
+                    current: currentConvId
+                });
+            }
+        }
+        
+        // 查找 Composer 输入框
+        const inputSelector = 'div[contenteditable="true"][role="textbox"],' +
+                             'div[contenteditable="true"][aria-label*="composer"],' +
+                             'textarea[placeholder*="Ask"]';
+        
+        const inputElement = document.querySelector(inputSelector);
+        
+        if (!inputElement) {
+            return JSON.stringify({
+                success: false,
+                error: '找不到 Cursor 输入框'
+            });
+        }
+        
+        // 聚焦输入框
+        inputElement.focus();
+        
+        // 清空现有内容（如果有）
+        if (inputElement.tagName === 'TEXTAREA' || inputElement.tagName === 'INPUT') {
+            inputElement.value = '';
+        } else {
+            // 对于 contenteditable，选中所有内容并删除
+            const range = document.createRange();
+            range.selectNodeContents(inputElement);
+            const selection = window.getSelection();
+            selection.removeAllRanges();
+            selection.addRange(range);
+            document.execCommand('delete', false);
+        }
+        
+        // 模拟键盘输入
+        const textToInput = String(args.text || "");
+        
+        // 使用 document.execCommand insertText（对 Lexical 等编辑器有效）
+        document.execCommand('insertText', false, textToInput);
+        
+        // 备用方法：逐字符模拟输入事件
+        if (!inputElement.textContent && !inputElement.value) {
+            for (let char of textToInput) {
+                const keyboardEvent = new KeyboardEvent('keypress', {
+                    key: char,
+                    code: 'Key' + char.toUpperCase(),
+                    charCode: char.charCodeAt(0),
+                    keyCode: char.charCodeAt(0),
+                    bubbles: true,
+                    cancelable: true
+                });
+                inputElement.dispatchEvent(keyboardEvent);
+                
+                const inputEvent = new InputEvent('input', {
+                    data: char,
+                    inputType: 'insertText',
+                    bubbles: true,
+                    cancelable: false
+                });
+                inputElement.dispatchEvent(inputEvent);
+            }
+        }
+        
+        // 验证内容是否输入成功
+        let currentContent = '';
+        if (inputElement.tagName === 'TEXTAREA' || inputElement.tagName === 'INPUT') {
+            currentContent = inputElement.value;
+        } else {
+            currentContent = inputElement.textContent || inputElement.innerText || '';
+        }
+        
+        const shouldExecute = Boolean(args.execute);
+        
+        // 如果需要执行，模拟按 Enter 键
+        if (shouldExecute) {
+            // 等待一小段时间确保输入已处理
+            await new Promise(resolve => setTimeout(resolve, 100));
+            
+            // 模拟按下 Enter 键
+            const enterEvent = new KeyboardEvent('keydown', {
+                key: 'Enter',
+                code: 'Enter',
+                keyCode: 13,
+                which: 13,
+                bubbles: true,
+                cancelable: true
+            });
+            inputElement.dispatchEvent(enterEvent);
+            
+            const enterUpEvent = new KeyboardEvent('keyup', {
+                key: 'Enter',
+                code: 'Enter',
+                keyCode: 13,
+                which: 13,
+                bubbles: true,
+                cancelable: true
+            });
+            inputElement.dispatchEvent(enterUpEvent);
+            
+            // 也尝试查找并点击发送按钮（备用方案）
+            const sendButton = document.querySelector('button[aria-label*="Send"]') ||
+                              document.querySelector('button[title*="Send"]') ||
+                              document.querySelector('button[type="submit"]');
+            if (sendButton) {
+                sendButton.click();
+            }
+        }
+        
+        return JSON.stringify({
+            success: currentContent.includes(textToInput) || currentContent.length > 0,
+            message: shouldExecute ? '文本已输入并执行' : '文本已输入到 Cursor',
+            executed: shouldExecute,
+            inputLength: textToInput.length,
+            currentLength: currentContent.length,
+            preview: currentContent.substring(0, 50)
+        });
+    } catch (error) {
+        return JSON.stringify({
+            success: false,
+            error: error.message
+        });
+    }
+}
+''')
+
+# 查询窗口当前的 conversation_id 和标题
+# args: {}
+GET_CONVERSATION_ID = define_template("get_conversation_id", r'''
+() => {
+    const el = document.querySelector('[id^="composer-bottom-add-context-"]');
+    if (!el) {
+        return JSON.stringify({ 
+            found: false, 
+            conversationId: null,
+            title: null
+        });
+    }
+    
+    const match = el.id.match(/composer-bottom-add-context-([a-f0-9-]+)/);
+    const conversationId = match ? match[1] : null;
+    
+    // 获取窗口标题
+    let title = document.querySelector('.window-title')?.textContent?.trim();
+    if (!title) {
+        title = document.querySelector('.titlebar-center')?.textContent?.trim();
+    }
+    // 清理标题（移除 "AgentsEditor" 等前缀）
+    if (title) {
+        title = title.replace(/^AgentsEditor\s*/, '').trim();
+    }
+    if (!title) {
+        title = 'Untitled Conversation';
+    }
+    
+    return JSON.stringify({ 
+        found: true, 
+        conversationId: conversationId,
+        title: title,
+        elementId: el.id
+    });
+}
+''')
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 2:
+        for t in TEMPLATES.values():
+            print(f"{t.name:<24} {t.hash}  {len(t.source.encode('utf-8')):>6} bytes")
+        return 0
+    template = TEMPLATES.get(argv[1])
+    if template is None:
+        print(f"未知模板: {argv[1]}（可用: {', '.join(TEMPLATES)}）", file=sys.stderr)
+        return 2
+    args = json.loads(argv[2]) if len(argv) > 2 else {}
+    print(template.render(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -12,6 +12,8 @@ from enum import Enum
 import time
 import json
 
+from codec import TEXT_CODEC
+
 
 # ============================================================================
 # 枚举类型定义
@@ -104,6 +106,7 @@ class MessageType(str, Enum):
     # 通用 JavaScript 执行（inject 专用）
     EXECUTE_JS = "execute_js"  # 在 Cursor 中执行 JavaScript 代码
     EXECUTE_JS_RESULT = "execute_js_result"  # JavaScript 执行结果
+    JS_TEMPLATE_DEFINE = "js_template_define"  # Server → Inject: 下发注入脚本模板（见 js_templates.py）
 
     # =========================================================================
     # VNext: Session 事件流（多终端一致性）
@@ -112,6 +115,40 @@ class MessageType(str, Enum):
     INPUT_ACK = "input_ack"                  # Server → Client: 输入事件被接收（返回 seq）
     CLIENT_EVENT_SUBMIT = "client_event_submit"  # Client → Server: 通用扩展事件入口（不触达 inject）
     SESSION_EVENT = "session_event"          # Server → Clients: 会话事件广播（权威事件流）
+    SESSION_RESUME = "session_resume"        # Client → Server: 重连后补齐 last_seq 之后的事件
+    SESSION_RESUME_RESULT = "session_resume_result"  # Server → Client: 一次性返回错过的事件
+
+    # 运维诊断（按需查询，不在消息热路径上输出）
+    SERVER_DIAGNOSTICS = "server_diagnostics"                # Client → Server: 查询服务器内部状态
+    SERVER_DIAGNOSTICS_RESULT = "server_diagnostics_result"  # Server → Client: 诊断结果
+
+    # 流量控制
+    THROTTLED = "throttled"  # Server → Client: 消息超出速率预算被拒绝（未处理），retry_after_ms 后再试
+
+
+# 消息类型查找表（比 MessageType(value) 的 Enum 构造快）
+MESSAGE_TYPES: Dict[str, MessageType] = {t.value: t for t in MessageType}
+
+# 服务端只做转发（route_message）的消息类型：可以不解析 payload，原样转发原始帧
+RELAY_MESSAGE_TYPES = frozenset({
+    MessageType.COMPOSER_SEND_PROMPT_RESULT.value,
+    MessageType.COMPOSER_STATUS_RESULT.value,
+    MessageType.AGENT_EXECUTE_PROMPT_RESULT.value,
+    MessageType.AGENT_STOP_EXECUTION_RESULT.value,
+    MessageType.CURSOR_INPUT_TEXT_RESULT.value,
+    MessageType.GET_CONVERSATION_ID_RESULT.value,
+    MessageType.AITUBER_SPEAK.value,
+    MessageType.AITUBER_EMOTION.value,
+    MessageType.AITUBER_STATUS.value,
+})
+
+
+def parse_message_type(value: str) -> MessageType:
+    """字符串 → MessageType（未知类型抛 ValueError，与 MessageType(value) 一致）"""
+    try:
+        return MESSAGE_TYPES[value]
+    except (KeyError, TypeError):
+        raise ValueError(f"{value!r} is not a valid MessageType") from None
 
 
 # ============================================================================
@@ -309,6 +346,7 @@ class InputSubmitPayload:
     execute: bool = False                    # 是否立即执行
     session_id: Optional[str] = None         # 会话 ID（可选；默认可用 conversation_id）
     meta: Optional[Dict[str, Any]] = None    # 扩展元数据（可选）
+    priority: Optional[str] = None           # interactive / automation / bulk（可选；默认按提交方角色）
 
 
 @dataclass
@@ -339,12 +377,48 @@ class SessionEventPayload:
     source_client_id: Optional[str] = None   # 事件来源（可选，便于追踪/回放）
 
 
+@dataclass
+class SessionResumePayload:
+    """重连补齐请求：返回 seq > last_seq 的事件，并加入该 session 接收后续实时事件"""
+    session_id: str
+    last_seq: int = 0
+    limit: Optional[int] = None              # 最多返回多少条（服务端有上限）
+    request_id: Optional[str] = None
+
+
+@dataclass
+class SessionResumeResultPayload:
+    """重连补齐结果"""
+    session_id: str
+    events: List[Dict[str, Any]]             # [{seq, event_name, event_payload, source_client_id, timestamp}, ...]
+    head_seq: int                            # 当前最新 seq
+    has_more: bool = False                   # 还有更多事件：以最后一条的 seq 作为 last_seq 再次请求
+    durable: bool = True                     # False 表示服务端未启用事件日志，无法补齐
+    request_id: Optional[str] = None
+    error: Optional[str] = None              # 请求参数无效时的原因（此时 events 为空）
+
+
+@dataclass
+class ThrottledPayload:
+    """被限流拒绝的消息（服务端没有处理它）"""
+    message_type: str                        # 被拒绝的消息类型
+    scope: str                               # client（该客户端的预算）/ session（该 session 的预算）
+    budget: str                              # command / event / session
+    retry_after_ms: int                      # 预算恢复到可以接受下一条消息的等待时间
+    rate: float                              # 预算的持续速率（条/秒）
+    burst: int                               # 预算的突发上限
+    client_event_id: Optional[str] = None    # 被拒绝消息的 client_event_id（如有）
+    request_id: Optional[str] = None         # 被拒绝消息的 request_id（如有）
+    session_id: Optional[str] = None
+
+
 @dataclass
 class CursorInputTextResultPayload:
     """Cursor 输入文本结果的 Payload"""
     success: bool
     message: Optional[str] = None
     error: Optional[str] = None
+    latency_ms: Optional[float] = None  # server 发出 execute_js 到收到 inject 结果的耗时
 
 
 @dataclass
@@ -362,11 +436,23 @@ class ExecuteJsPayload:
     - conversation_id 检查逻辑可以在 JavaScript 代码中处理
     
     注：当前实现使用广播模式 + JS 代码内检查
+    
+    模板模式：template / template_hash / args 非空时 code 为空，
+    inject 调用注册时下发的模板函数 template(args)
     """
     code: str  # JavaScript 代码
     request_id: Optional[str] = None  # 请求 ID（用于匹配响应）
     window_index: Optional[int] = None  # 窗口索引（单播模式）
     conversation_id: Optional[str] = None  # 会话 ID（单播模式，inject 自动查找）
+    template: Optional[str] = None  # 模板名（模板模式）
+    template_hash: Optional[str] = None  # 模板 hash（校验 inject 持有的是同一版本）
+    args: Optional[Dict[str, Any]] = None  # 模板参数
+
+
+@dataclass
+class JsTemplateDefinePayload:
+    """下发注入脚本模板的 Payload"""
+    templates: List[Dict[str, str]]  # [{name, hash, source}, ...]
 
 
 @dataclass
@@ -378,6 +464,28 @@ class ExecuteJsResultPayload:
     request_id: Optional[str] = None
 
 
+@dataclass
+class ServerDiagnosticsPayload:
+    """查询服务器诊断信息的 Payload"""
+    request_id: Optional[str] = None
+
+
+@dataclass
+class ServerDiagnosticsResultPayload:
+    """服务器诊断结果的 Payload"""
+    stats: Dict[str, int]                    # 各主要角色的客户端数
+    clients: List[Dict[str, Any]]            # 已注册客户端（client_id / roles / 心跳 / 出站队列等）
+    request_id: Optional[str] = None
+    outbox: Dict[str, int] = field(default_factory=dict)  # 全局出站计数（入队/发送/丢弃/溢出断开）
+    handlers: Dict[str, Dict[str, float]] = field(default_factory=dict)  # 各消息类型的处理耗时（count / total_ms / avg_ms / max_ms）
+    pending: Dict[str, int] = field(default_factory=dict)  # 待响应请求表（in_flight / resolved / timeouts / failed / late）
+    routing: Dict[str, int] = field(default_factory=dict)  # conversation → 窗口缓存（entries / hits / misses / stale）
+    sessions: Dict[str, int] = field(default_factory=dict)  # session 生命周期（live / workers / queued / members / created / evicted）
+    heartbeat: Dict[str, int] = field(default_factory=dict)  # 存活检测（tracked / timeouts / close_timeouts / reschedules）
+    cluster: Dict[str, int] = field(default_factory=dict)  # 多进程模式（worker / workers / connected / sent / received）；单进程为空
+    discovery: Dict[str, int] = field(default_factory=dict)  # 对话目录缓存（injects / conversations / hits / misses / refreshes / invalidations）
+
+
 # ============================================================================
 # 消息基础类
 # ============================================================================
@@ -400,34 +508,34 @@ class Message:
         if self.timestamp == 0:
             self.timestamp = int(time.time())
     
-    def to_json(self) -> str:
-        """转换为 JSON 字符串"""
-        data = {
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为线路格式的字典（字段顺序 type / from / to 在前，供 peek_route 快速读取）"""
+        return {
             "type": self.type.value if isinstance(self.type, Enum) else self.type,
             "from": self.from_,
             "to": self.to or "",
             "timestamp": self.timestamp,
             "payload": self.payload
         }
-        return json.dumps(data, ensure_ascii=False)
+    
+    def encode(self, codec=TEXT_CODEC):
+        """用指定编解码器编码（默认文本 JSON；msgpack 客户端得到 bytes）"""
+        return codec.encode(self.to_dict())
+    
+    def to_json(self) -> str:
+        """转换为 JSON 字符串"""
+        return TEXT_CODEC.encode(self.to_dict())
     
     @classmethod
     def from_json(cls, json_str: str) -> 'Message':
         """从 JSON 字符串创建消息"""
-        data = json.loads(json_str)
-        return cls(
-            type=MessageType(data["type"]),
-            from_=data["from"],
-            to=data.get("to") or None,
-            timestamp=data["timestamp"],
-            payload=data["payload"]
-        )
+        return cls.from_dict(TEXT_CODEC.decode(json_str))
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'Message':
         """从字典创建消息"""
         return cls(
-            type=MessageType(data["type"]),
+            type=parse_message_type(data["type"]),
             from_=data["from"],
             to=data.get("to") or None,
             timestamp=data["timestamp"],
@@ -933,13 +1041,15 @@ class MessageBuilder:
         to_id: str,
         success: bool,
         message: Optional[str] = None,
-        error: Optional[str] = None
+        error: Optional[str] = None,
+        latency_ms: Optional[float] = None
     ) -> Message:
         """创建 Cursor 输入文本结果消息"""
         payload = CursorInputTextResultPayload(
             success=success,
             message=message,
-            error=error
+            error=error,
+            latency_ms=latency_ms
         )
         
         return Message(
@@ -961,7 +1071,10 @@ class MessageBuilder:
         code: str,
         request_id: Optional[str] = None,
         window_index: Optional[int] = None,
-        conversation_id: Optional[str] = None
+        conversation_id: Optional[str] = None,
+        template: Optional[str] = None,
+        template_hash: Optional[str] = None,
+        args: Optional[Dict[str, Any]] = None
     ) -> Message:
         """创建执行 JavaScript 消息
         
@@ -969,12 +1082,16 @@ class MessageBuilder:
         - window_index: 单播模式，直接指定窗口索引
         - conversation_id: 单播模式，inject 自动查找窗口
         - 都不指定: 广播模式
+        - template / template_hash / args: 模板模式（code 传空字符串）
         """
         payload = ExecuteJsPayload(
             code=code,
             request_id=request_id,
             window_index=window_index,
-            conversation_id=conversation_id
+            conversation_id=conversation_id,
+            template=template,
+            template_hash=template_hash,
+            args=args
         )
         
         return Message(
@@ -1010,6 +1127,19 @@ class MessageBuilder:
             payload=asdict(payload)
         )
 
+    @staticmethod
+    def js_template_define(to_id: str, templates: List[Dict[str, str]]) -> Message:
+        """创建下发注入脚本模板的消息"""
+        payload = JsTemplateDefinePayload(templates=templates)
+        
+        return Message(
+            type=MessageType.JS_TEMPLATE_DEFINE,
+            from_="server",
+            to=to_id,
+            timestamp=int(time.time()),
+            payload=asdict(payload)
+        )
+
     # ========================================================================
     # VNext: Session 事件流（多终端一致性）
     # ========================================================================
@@ -1023,7 +1153,8 @@ class MessageBuilder:
         conversation_id: Optional[str] = None,
         execute: bool = False,
         session_id: Optional[str] = None,
-        meta: Optional[Dict[str, Any]] = None
+        meta: Optional[Dict[str, Any]] = None,
+        priority: Optional[str] = None
     ) -> Message:
         """创建输入事件提交消息（服务端仲裁/排序）"""
         payload = InputSubmitPayload(
@@ -1032,7 +1163,8 @@ class MessageBuilder:
             conversation_id=conversation_id,
             execute=execute,
             session_id=session_id,
-            meta=meta
+            meta=meta,
+            priority=priority
         )
 
         return Message(
@@ -1120,6 +1252,153 @@ class MessageBuilder:
             payload=asdict(payload)
         )
 
+    @staticmethod
+    def session_resume(
+        from_id: str,
+        session_id: str,
+        last_seq: int = 0,
+        limit: Optional[int] = None,
+        request_id: Optional[str] = None
+    ) -> Message:
+        """创建重连补齐请求"""
+        payload = SessionResumePayload(
+            session_id=session_id,
+            last_seq=last_seq,
+            limit=limit,
+            request_id=request_id
+        )
+
+        return Message(
+            type=MessageType.SESSION_RESUME,
+            from_=from_id,
+            to="server",
+            timestamp=int(time.time()),
+            payload=asdict(payload)
+        )
+
+    @staticmethod
+    def session_resume_result(
+        to_id: str,
+        session_id: str,
+        events: List[Dict[str, Any]],
+        head_seq: int,
+        has_more: bool = False,
+        durable: bool = True,
+        request_id: Optional[str] = None,
+        error: Optional[str] = None
+    ) -> Message:
+        """创建重连补齐结果"""
+        payload = SessionResumeResultPayload(
+            session_id=session_id,
+            events=events,
+            head_seq=head_seq,
+            has_more=has_more,
+            durable=durable,
+            request_id=request_id,
+            error=error
+        )
+
+        return Message(
+            type=MessageType.SESSION_RESUME_RESULT,
+            from_="server",
+            to=to_id,
+            timestamp=int(time.time()),
+            payload=asdict(payload)
+        )
+
+    # ========================================================================
+    # 流量控制
+    # ========================================================================
+
+    @staticmethod
+    def throttled(
+        to_id: str,
+        message_type: str,
+        scope: str,
+        budget: str,
+        retry_after_ms: int,
+        rate: float,
+        burst: int,
+        client_event_id: Optional[str] = None,
+        request_id: Optional[str] = None,
+        session_id: Optional[str] = None
+    ) -> Message:
+        """创建限流拒绝消息"""
+        payload = ThrottledPayload(
+            message_type=message_type,
+            scope=scope,
+            budget=budget,
+            retry_after_ms=retry_after_ms,
+            rate=rate,
+            burst=burst,
+            client_event_id=client_event_id,
+            request_id=request_id,
+            session_id=session_id
+        )
+
+        return Message(
+            type=MessageType.THROTTLED,
+            from_="server",
+            to=to_id,
+            timestamp=int(time.time()),
+            payload=asdict(payload)
+        )
+
+    # ========================================================================
+    # 运维诊断
+    # ========================================================================
+
+    @staticmethod
+    def server_diagnostics(from_id: str, request_id: Optional[str] = None) -> Message:
+        """创建服务器诊断查询消息"""
+        payload = ServerDiagnosticsPayload(request_id=request_id)
+
+        return Message(
+            type=MessageType.SERVER_DIAGNOSTICS,
+            from_=from_id,
+            to="server",
+            timestamp=int(time.time()),
+            payload=asdict(payload)
+        )
+
+    @staticmethod
+    def server_diagnostics_result(
+        to_id: str,
+        stats: Dict[str, int],
+        clients: List[Dict[str, Any]],
+        request_id: Optional[str] = None,
+        outbox: Optional[Dict[str, int]] = None,
+        handlers: Optional[Dict[str, Dict[str, float]]] = None,
+        pending: Optional[Dict[str, int]] = None,
+        routing: Optional[Dict[str, int]] = None,
+        sessions: Optional[Dict[str, int]] = None,
+        heartbeat: Optional[Dict[str, int]] = None,
+        cluster: Optional[Dict[str, int]] = None,
+        discovery: Optional[Dict[str, int]] = None
+    ) -> Message:
+        """创建服务器诊断结果消息"""
+        payload = ServerDiagnosticsResultPayload(
+            stats=stats,
+            clients=clients,
+            request_id=request_id,
+            outbox=outbox or {},
+            handlers=handlers or {},
+            pending=pending or {},
+            routing=routing or {},
+            sessions=sessions or {},
+            heartbeat=heartbeat or {},
+            cluster=cluster or {},
+            discovery=discovery or {}
+        )
+
+        return Message(
+            type=MessageType.SERVER_DIAGNOSTICS_RESULT,
+            from_="server",
+            to=to_id,
+            timestamp=int(time.time()),
+            payload=asdict(payload)
+        )
+
 
 # ============================================================================
 # 使用示例
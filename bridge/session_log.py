@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Session 事件日志（SQLite WAL，只追加）
+
+- 每条 session_event 按 (session_id, seq) 持久化，服务器重启后 seq 从日志中的最大值继续
+- 客户端重连后发送 session_resume(session_id, last_seq)，服务端一次性返回错过的事件
+- 写入在独立线程中批量提交，不阻塞事件循环；读取（resume）排在已提交的写入之后，
+  保证不会漏掉刚广播过的事件
+
+环境变量：
+  ORTENSIA_SESSION_LOG            日志文件路径（默认 ~/.ortensia/session_log.sqlite3，"off" 关闭）
+  ORTENSIA_SESSION_LOG_RETENTION  保留多久的事件（秒，默认 7 天）
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = Path.home() / ".ortensia" / "session_log.sqlite3"
+DEFAULT_RETENTION = 7 * 24 * 3600
+
+# 同一个 seq 会有多条事件（input_submitted / cursor_input_dispatching / cursor_input_dispatched），
+# 回放按写入顺序（id）排列
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_events (
+    id               INTEGER PRIMARY KEY,
+    session_id       TEXT    NOT NULL,
+    seq              INTEGER NOT NULL,
+    event_name       TEXT    NOT NULL,
+    event_payload    TEXT    NOT NULL,
+    source_client_id TEXT,
+    timestamp        REAL    NOT NULL,
+    UNIQUE (session_id, seq, event_name)
+);
+CREATE INDEX IF NOT EXISTS session_events_ts ON session_events (timestamp);
+"""
+
+
+class SessionLog:
+    """按 session 追加、按 seq 回放的事件日志"""
+
+    def __init__(self, path, retention: float = DEFAULT_RETENTION):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.retention = retention
+        self.stats = {"appended": 0, "flushes": 0, "replayed": 0, "pruned": 0, "write_errors": 0}
+
+        # 写连接只在 writer 线程中使用；读连接用于事件循环中的小查询（WAL 下读写互不阻塞）
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-log")
+        self._writer: Optional[sqlite3.Connection] = None
+        self._executor.submit(self._open_writer).result()
+        self._reader = self._connect()
+
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._flush_scheduled = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _open_writer(self):
+        self._writer = self._connect()
+        self._writer.executescript(_SCHEMA)
+        self._writer.commit()
+
+    # ------------------------------------------------------------------
+    # 写入（事件循环线程调用，批量提交在 writer 线程）
+    # ------------------------------------------------------------------
+
+    def append(
+        self,
+        session_id: str,
+        seq: int,
+        event_name: str,
+        event_payload: Dict[str, Any],
+        source_client_id: Optional[str] = None,
+        timestamp: Optional[float] = None,
+    ):
+        row = (
+            session_id,
+            seq,
+            event_name,
+            json.dumps(event_payload, ensure_ascii=False, default=str),
+            source_client_id,
+            timestamp if timestamp is not None else time.time(),
+        )
+        with self._lock:
+            self._pending.append(row)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._executor.submit(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            rows, self._pending = self._pending, []
+            self._flush_scheduled = False
+        if not rows:
+            return
+        try:
+            # 同一 (session_id, seq, event_name) 只保留第一次写入
+            self._writer.executemany(
+                "INSERT OR IGNORE INTO session_events "
+                "(session_id, seq, event_name, event_payload, source_client_id, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._writer.commit()
+            self.stats["appended"] += len(rows)
+            self.stats["flushes"] += 1
+        except sqlite3.Error as e:
+            self.stats["write_errors"] += 1
+            logger.error(f"❌ [SessionLog] 写入失败（丢弃 {len(rows)} 条）: {e}")
+
+    # ------------------------------------------------------------------
+    # 读取
+    # ------------------------------------------------------------------
+
+    def last_seq(self, session_id: str) -> int:
+        """日志中该 session 的最大 seq（没有记录时为 0）"""
+        row = self._reader.execute(
+            "SELECT MAX(seq) FROM session_events WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return int(row[0] or 0)
+
+    def _read_since(self, session_id: str, after_seq: int, limit: int) -> List[Dict[str, Any]]:
+        rows = self._writer.execute(
+            "SELECT seq, event_name, event_payload, source_client_id, timestamp FROM session_events "
+            "WHERE session_id = ? AND seq > ? ORDER BY id LIMIT ?",
+            (session_id, after_seq, limit),
+        ).fetchall()
+        return [
+            {
+                "seq": seq,
+                "event_name": event_name,
+                "event_payload": json.loads(payload),
+                "source_client_id": source,
+                "timestamp": ts,
+            }
+            for seq, event_name, payload, source, ts in rows
+        ]
+
+    async def read_since(self, session_id: str, after_seq: int, limit: int) -> List[Dict[str, Any]]:
+        """
+        读取 seq > after_seq 的事件（最多 limit 条）
+
+        在 writer 线程中执行：排在之前提交的批量写入之后，结果包含所有已 append 的事件
+        """
+        loop = asyncio.get_running_loop()
+        events = await loop.run_in_executor(self._executor, self._read_since, session_id, after_seq, limit)
+        self.stats["replayed"] += len(events)
+        return events
+
+    # ------------------------------------------------------------------
+    # 维护
+    # ------------------------------------------------------------------
+
+    def _prune(self) -> int:
+        cur = self._writer.execute(
+            "DELETE FROM session_events WHERE timestamp < ?", (time.time() - self.retention,)
+        )
+        self._writer.commit()
+        return cur.rowcount
+
+    async def prune(self) -> int:
+        """删除超过保留期的事件"""
+        loop = asyncio.get_running_loop()
+        removed = await loop.run_in_executor(self._executor, self._prune)
+        self.stats["pruned"] += removed
+        return removed
+
+    def close(self):
+        self._executor.submit(self._flush).result()
+        self._executor.submit(self._writer.close).result()
+        self._executor.shutdown()
+        self._reader.close()
+
+
+def open_session_log_from_env() -> Optional[SessionLog]:
+    """按环境变量打开日志；关闭或打开失败时返回 None（服务器退回纯内存模式）"""
+    path = os.environ.get("ORTENSIA_SESSION_LOG", str(DEFAULT_PATH)).strip()
+    if not path or path.lower() in ("off", "0", "none"):
+        return None
+    retention = float(os.environ.get("ORTENSIA_SESSION_LOG_RETENTION", DEFAULT_RETENTION))
+    try:
+        return SessionLog(path, retention=retention)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"⚠️  [SessionLog] 无法打开 {path}，session 事件不做持久化: {e}")
+        return None
@@ -10,19 +10,25 @@ Ortensia 中央 WebSocket Server
 """
 
 import asyncio
+import heapq
+import itertools
 import websockets
 import json
 import logging
 from datetime import datetime
-from typing import Dict, Set, Optional
+from typing import Any, Awaitable, Callable, Dict, Set, Optional
 import time
 import os
+import reprlib
+import sys
+from collections import OrderedDict, deque
 
 # ⚠️ 必须在任何 logging 调用之前配置！
 # 配置日志 - DEBUG 级别用于调试
 logging.basicConfig(
     level=logging.DEBUG,  # 🔧 改为 DEBUG 级别，显示更多信息
-    format='[%(asctime)s] %(levelname)s: %(message)s',
+    # 多进程模式下每行带上 worker 编号
+    format='[%(asctime)s] ' + (f"[w{os.environ['ORTENSIA_WORKER_ID']}] " if os.environ.get('ORTENSIA_WORKER_ID') else '') + '%(levelname)s: %(message)s',
     datefmt='%H:%M:%S'
 )
 logger = logging.getLogger(__name__)
@@ -37,71 +43,273 @@ from protocol import (
     MessageType,
     ClientType,
     AgentStatus,
-    Platform
+    Platform,
+    RELAY_MESSAGE_TYPES,
+    parse_message_type,
+)
+from codec import TEXT_CODEC, decode_frame, negotiate_codec, peek_route
+from metrics import REGISTRY as METRICS, SIZE_BUCKETS, serve_metrics
+from session_log import SessionLog, open_session_log_from_env
+from cluster import (
+    OP_CLAIM,
+    OP_DELIVER,
+    OP_MESSAGE,
+    OP_RELEASE,
+    OP_RESULT,
+    SOCKET_ENV,
+    WORKER_ID_ENV,
+    WORKERS_ENV,
+    ClusterLink,
+    cluster_supported,
+    default_socket_path,
+    request_owner,
+    run_supervisor,
+)
+from js_templates import (
+    CURSOR_INPUT_TEXT,
+    GET_CONVERSATION_ID,
+    JS_TEMPLATES_CAPABILITY,
+    JsTemplate,
+    template_definitions,
 )
 
 # ============================================================================
 # VNext: Session 事件流（多终端一致性 + 输入仲裁）
 # ============================================================================
 
-class _RecentIdSet:
-    """简单的去重集合（保留最近 N 个）"""
+class _RecentIdMap:
+    """定长去重表：保留最近 N 个 client_event_id 及其 seq，插入/查询/淘汰都是 O(1)"""
 
     def __init__(self, max_size: int = 512):
         self.max_size = max_size
-        self._items = []  # 保留插入顺序
-        self._set = set()
+        self._items: "OrderedDict[str, Optional[int]]" = OrderedDict()  # 按插入顺序，最早的在前
 
     def __contains__(self, item: str) -> bool:
-        return item in self._set
+        return item in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
 
-    def add(self, item: str):
-        if item in self._set:
+    def add(self, item: str, seq: Optional[int] = None):
+        if item in self._items:
             return
-        self._set.add(item)
-        self._items.append(item)
-        # 裁剪
+        self._items[item] = seq
         if len(self._items) > self.max_size:
-            drop = self._items[: len(self._items) - self.max_size]
-            self._items = self._items[-self.max_size :]
-            for d in drop:
-                self._set.discard(d)
+            self._items.popitem(last=False)
+
+    def get(self, item: str, default: Optional[int] = None) -> Optional[int]:
+        seq = self._items.get(item)
+        return default if seq is None else seq
+
+
+# ----------------------------------------------------------------------------
+# Session 生命周期：
+#   ORTENSIA_SESSION_TTL             没有成员的 session 空闲多久回收（秒，默认 3600）
+#   ORTENSIA_SESSION_SWEEP_INTERVAL  回收检查间隔（秒，默认 60）
+# 队列为空时 worker 退出，下次入队再启动；被回收的 session 记住最后的 seq，
+# 重新创建时从该 seq 继续，客户端看到的 seq 不会回退
+# 启用事件日志（session_log.py）时，seq 还会从日志中恢复，服务器重启后同样不回退
+# ----------------------------------------------------------------------------
+SESSION_IDLE_TTL = float(os.environ.get("ORTENSIA_SESSION_TTL", "3600"))
+SESSION_SWEEP_INTERVAL = float(os.environ.get("ORTENSIA_SESSION_SWEEP_INTERVAL", "60"))
+SESSION_DEDUPE_SIZE = 1024  # 每个 session 保留的最近 client_event_id 数
+SESSION_SEQ_TOMBSTONES = 4096  # 最多记住多少个已回收 session 的 seq
+SESSION_RESUME_MAX_EVENTS = 1000  # session_resume 单次最多返回的事件数
+
+# 持久化事件日志（main() 中按环境变量打开；为 None 时只在内存中维护 session）
+session_log: Optional[SessionLog] = None
+
+
+# ----------------------------------------------------------------------------
+# Session 队列优先级（从高到低）：
+#   interactive  用户在前端输入的内容（默认）
+#   automation   hook / 脚本等自动提交（agent_hook、cursor_hook 角色的默认值）
+#   bulk         批量回放 / 导入
+# 提交方可在 input_submit 的 payload.priority 中显式指定。
+# worker 总是先取高优先级的输入；任一队首等待超过 ORTENSIA_SESSION_STARVATION_MS
+# （默认 2000）时改为先取等待最久的，低优先级不会被持续的高优先级输入饿死。
+# 各优先级的排队耗时见指标 ortensia_session_queue_wait_seconds{lane}
+# ----------------------------------------------------------------------------
+LANE_INTERACTIVE = "interactive"
+LANE_AUTOMATION = "automation"
+LANE_BULK = "bulk"
+SESSION_LANES = (LANE_INTERACTIVE, LANE_AUTOMATION, LANE_BULK)
+AUTOMATION_ROLES = frozenset({"agent_hook", "cursor_hook"})
+SESSION_STARVATION_AFTER = max(0.0, float(os.environ.get("ORTENSIA_SESSION_STARVATION_MS", "2000")) / 1000)
+
+
+class SessionQueue:
+    """
+    按优先级分道的 session 输入队列（单消费者）
+    
+    接口与 asyncio.Queue 中 worker 用到的部分一致：put_nowait / get / get_nowait / empty / qsize
+    """
+
+    def __init__(self):
+        self._lanes: Dict[str, deque] = {lane: deque() for lane in SESSION_LANES}  # (入队时间, item)
+        self._size = 0
+        self._not_empty = asyncio.Event()
+        self.promoted = 0  # 因等待超时被提前处理的次数
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def lane_sizes(self) -> Dict[str, int]:
+        return {lane: len(q) for lane, q in self._lanes.items()}
+
+    def put_nowait(self, item: dict, lane: str = LANE_INTERACTIVE):
+        self._lanes[lane].append((time.monotonic(), item))
+        self._size += 1
+        self._not_empty.set()
+
+    def _next_lane(self) -> str:
+        now = time.monotonic()
+        first = None
+        oldest = None
+        for lane in SESSION_LANES:
+            q = self._lanes[lane]
+            if not q:
+                continue
+            if first is None:
+                first = lane
+            if now - q[0][0] >= SESSION_STARVATION_AFTER and (oldest is None or q[0][0] < self._lanes[oldest][0][0]):
+                oldest = lane
+        if oldest is not None and oldest != first:
+            self.promoted += 1
+            return oldest
+        return first
+
+    def get_nowait(self) -> dict:
+        if self._size == 0:
+            raise asyncio.QueueEmpty
+        lane = self._next_lane()
+        enqueued_at, item = self._lanes[lane].popleft()
+        self._size -= 1
+        if self._size == 0:
+            self._not_empty.clear()
+        metric_session_queue_wait.observe(time.monotonic() - enqueued_at, lane)
+        return item
+
+    async def get(self) -> dict:
+        while self._size == 0:
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+
+def _input_lane(client_info: "ClientInfo", payload: Dict[str, Any]) -> str:
+    """input_submit 进入哪个优先级：显式 payload.priority，否则按提交方角色"""
+    lane = payload.get("priority")
+    if lane in SESSION_LANES:
+        return lane
+    if client_info.client_types & AUTOMATION_ROLES:
+        return LANE_AUTOMATION
+    return LANE_INTERACTIVE
 
 
 class SessionState:
     """单个 session 的有序事件流状态"""
 
-    def __init__(self, session_id: str):
+    def __init__(self, session_id: str, seq: int = 0):
         self.session_id = session_id
-        self.seq = 0
-        self.queue: asyncio.Queue = asyncio.Queue()
-        self.dedupe = _RecentIdSet(max_size=1024)
-        self.event_id_to_seq: Dict[str, int] = {}  # client_event_id -> seq（用于幂等回执）
+        self.seq = seq
+        self.queue = SessionQueue()
+        self.dedupe = _RecentIdMap(max_size=SESSION_DEDUPE_SIZE)  # client_event_id -> seq（幂等去重与回执）
         self.worker_task: Optional[asyncio.Task] = None
         self.members: Set[str] = set()  # client_id 集合（用于广播 session_event）
+        self.last_active = time.monotonic()
+        self.admission: Optional["TokenBucket"] = None  # session 共享的速率预算（首次提交时创建）
+
+    def touch(self):
+        self.last_active = time.monotonic()
 
     def next_seq(self) -> int:
         self.seq += 1
+        self.touch()
         return self.seq
 
+    def remember_event(self, client_event_id: str, seq: Optional[int] = None):
+        """记录已处理的 client_event_id（幂等去重），超出上限时淘汰最早的"""
+        self.dedupe.add(client_event_id, seq)
+
+    @property
+    def worker_running(self) -> bool:
+        return self.worker_task is not None and not self.worker_task.done()
+
+    @property
+    def busy(self) -> bool:
+        return self.worker_running or not self.queue.empty()
+
 
 class SessionManager:
     """管理所有 session 的队列、序号、成员与 worker"""
 
     def __init__(self):
         self.sessions: Dict[str, SessionState] = {}
+        self._client_sessions: Dict[str, Set[str]] = {}  # client_id -> 所在的 session_id
+        self._seq_floor: Dict[str, int] = {}  # 已回收 session 的最后 seq
+        self.stats = {"created": 0, "evicted": 0, "workers_started": 0}
 
     def get_or_create(self, session_id: str) -> SessionState:
-        if session_id not in self.sessions:
-            self.sessions[session_id] = SessionState(session_id=session_id)
-        return self.sessions[session_id]
+        s = self.sessions.get(session_id)
+        if s is None:
+            s = SessionState(session_id=session_id, seq=self._restore_seq(session_id))
+            self.sessions[session_id] = s
+            self.stats["created"] += 1
+        return s
+
+    def _restore_seq(self, session_id: str) -> int:
+        seq = self._seq_floor.pop(session_id, 0)
+        if session_log is not None:
+            try:
+                seq = max(seq, session_log.last_seq(session_id))
+            except Exception as e:
+                logger.warning(f"⚠️  [SessionLog] 读取 {session_id} 的 seq 失败: {e}")
+        return seq
 
     def join(self, session_id: str, client_id: str):
-        self.get_or_create(session_id).members.add(client_id)
+        s = self.get_or_create(session_id)
+        s.members.add(client_id)
+        s.touch()
+        self._client_sessions.setdefault(client_id, set()).add(session_id)
 
     def leave_all(self, client_id: str):
-        for s in self.sessions.values():
-            s.members.discard(client_id)
+        for session_id in self._client_sessions.pop(client_id, ()):
+            s = self.sessions.get(session_id)
+            if s is not None:
+                s.members.discard(client_id)
+
+    def evict_idle(self, ttl: float) -> list:
+        """
+        回收空闲超过 ttl 秒、没有待处理输入且没有成员的 session，返回被回收的 session_id
+        
+        仍有成员（例如注册时带 session_id 加入、长时间没有输入的客户端）的 session 不回收：
+        回收会丢掉成员关系和去重表，成员将收不到之后的 session_event，重发的 client_event_id 也会被当作新输入
+        """
+        now = time.monotonic()
+        evicted = [
+            sid for sid, s in self.sessions.items()
+            if not s.members and not s.busy and now - s.last_active >= ttl
+        ]
+        for sid in evicted:
+            s = self.sessions.pop(sid)
+            self._seq_floor[sid] = s.seq
+            while len(self._seq_floor) > SESSION_SEQ_TOMBSTONES:
+                del self._seq_floor[next(iter(self._seq_floor))]
+        self.stats["evicted"] += len(evicted)
+        return evicted
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "live": len(self.sessions),
+            "workers": sum(1 for s in self.sessions.values() if s.worker_running),
+            "queued": sum(s.queue.qsize() for s in self.sessions.values()),
+            "queue_promotions": sum(s.queue.promoted for s in self.sessions.values()),
+            "members": sum(len(s.members) for s in self.sessions.values()),
+            **self.stats,
+        }
 
 
 session_manager = SessionManager()
@@ -111,24 +319,281 @@ session_manager = SessionManager()
 # 客户端管理
 # ============================================================================
 
+# 主要角色优先级（ClientInfo.client_type 向后兼容用）
+ROLE_PRIORITY = ('cursor_inject', 'aituber_client', 'command_client', 'agent_hook')
+
+# ----------------------------------------------------------------------------
+# 出站队列（每个客户端一个有界队列 + 独立的写任务）
+#
+# 慢消费者只会堆积自己的队列，不会阻塞广播方和其他客户端。
+# 队列满时按消息类型选择溢出策略：
+#   drop_oldest  丢弃队列中最旧的一条可丢弃消息（表情/状态类事件，只关心最新值）
+#   disconnect   断开该客户端（命令结果、确认、会话事件等不能丢的消息）
+#
+# 环境变量：
+#   ORTENSIA_OUTBOX_SIZE    每个客户端的队列上限（默认 256）
+#   ORTENSIA_OUTBOX_POLICY  覆盖策略，例如 "aituber_receive_text=disconnect,*=drop_oldest"
+#                           （key 为消息类型，"legacy" 表示旧协议消息，"*" 表示默认）
+# ----------------------------------------------------------------------------
+OUTBOX_MAX_SIZE = max(1, int(os.environ.get("ORTENSIA_OUTBOX_SIZE", "256")))
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DISCONNECT = "disconnect"
+
+_OVERFLOW_POLICY: Dict[str, str] = {
+    MessageType.AITUBER_RECEIVE_TEXT.value: OVERFLOW_DROP_OLDEST,
+    MessageType.AITUBER_EMOTION.value: OVERFLOW_DROP_OLDEST,
+    MessageType.AITUBER_STATUS.value: OVERFLOW_DROP_OLDEST,
+    MessageType.AITUBER_SPEAK.value: OVERFLOW_DROP_OLDEST,
+    MessageType.AGENT_STATUS_CHANGED.value: OVERFLOW_DROP_OLDEST,
+    MessageType.HEARTBEAT_ACK.value: OVERFLOW_DROP_OLDEST,
+    MessageType.THROTTLED.value: OVERFLOW_DROP_OLDEST,
+    "legacy": OVERFLOW_DROP_OLDEST,
+    "*": OVERFLOW_DISCONNECT,
+}
+
+
+def _load_overflow_policy_overrides():
+    raw = os.environ.get("ORTENSIA_OUTBOX_POLICY", "")
+    for item in raw.split(","):
+        if "=" not in item:
+            continue
+        key, policy = (part.strip() for part in item.split("=", 1))
+        if policy in (OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT):
+            _OVERFLOW_POLICY[key] = policy
+        else:
+            logger.warning(f"⚠️  忽略无效的出站队列策略: {item}")
+
+
+_load_overflow_policy_overrides()
+
+
+def overflow_policy_for(msg_type: Optional[str]) -> str:
+    """消息类型对应的溢出策略"""
+    return _OVERFLOW_POLICY.get(msg_type or "legacy", _OVERFLOW_POLICY["*"])
+
+
+# 全局出站计数（包含已断开的客户端）
+outbox_counters: Dict[str, int] = {
+    "enqueued": 0,
+    "sent": 0,
+    "send_errors": 0,
+    "dropped": 0,
+    "overflow_disconnects": 0,
+}
+
+
+# ----------------------------------------------------------------------------
+# 指标（metrics.py，Prometheus 文本格式）
+#
+# 热路径上只做计数 / 分桶；连接数、队列深度等 gauge 在抓取时从现有结构计算
+# （见文件末尾「指标注册」一节）。
+#
+# 环境变量：
+#   ORTENSIA_METRICS_PORT  旁路 HTTP 端口，提供 GET /metrics（默认关闭；
+#                          多进程模式下每个 worker 监听 端口 + worker 编号）
+#   ORTENSIA_METRICS_HOST  监听地址（默认 127.0.0.1）
+# ----------------------------------------------------------------------------
+metric_frames_in = METRICS.counter(
+    "ortensia_frames_in_total", "收到的帧数（path: handler / relay 直通 / legacy 旧协议）", ("type", "path"))
+metric_frames_out = METRICS.counter(
+    "ortensia_frames_out_total", "放入出站队列的帧数", ("type",))
+metric_handler_seconds = METRICS.histogram(
+    "ortensia_handler_duration_seconds", "每条入站消息的处理耗时", ("type", "path"))
+metric_route_misses = METRICS.counter(
+    "ortensia_route_misses_total", "目标客户端不存在、无法路由的消息数", ("type",))
+metric_fanout_targets = METRICS.histogram(
+    "ortensia_broadcast_targets", "每次广播的目标客户端数", ("type",), buckets=SIZE_BUCKETS)
+metric_fanout_seconds = METRICS.histogram(
+    "ortensia_broadcast_duration_seconds", "每次广播编码并放入各出站队列的耗时", ("type",))
+metric_throttled = METRICS.counter(
+    "ortensia_throttled_total", "超出速率预算被拒绝的消息数", ("role", "budget"))
+metric_inject_seconds = METRICS.histogram(
+    "ortensia_inject_request_duration_seconds", "server 发给各 inject 的 execute_js 往返耗时（op: discovery / input）", ("inject", "op"))
+metric_session_queue_wait = METRICS.histogram(
+    "ortensia_session_queue_wait_seconds", "输入在 session 队列中的等待时间（按优先级）", ("lane",))
+
+
+# ----------------------------------------------------------------------------
+# 准入控制（令牌桶）
+#
+# 每个客户端按消息类别各有一个令牌桶：command（输入 / 命令 / 查询）和 event（hook / AITuber 事件）；
+# 注册、心跳、*_RESULT 响应等不限流。超出预算的消息不做任何处理，直接回复 THROTTLED。
+# 多角色客户端取各角色中最宽松的预算。
+# 另外每个 session 有一个所有成员共享的 session 预算，限制进入同一 session 事件流的速率
+# （在 session 所在的 worker 上检查，重复提交的 client_event_id 不计入）。
+#
+# 环境变量：
+#   ORTENSIA_RATE_LIMITS  "off" 关闭；否则为「key=速率/突发」列表，例如
+#                         "command=50/100,event=200/400,agent_hook.event=50/100,session=20/40"
+#                         key 为 command / event / session，或 <角色>.command / <角色>.event
+# ----------------------------------------------------------------------------
+BUDGET_COMMAND = "command"
+BUDGET_EVENT = "event"
+BUDGET_SESSION = "session"
+
+# 预算 → (每秒令牌数, 桶容量)
+RATE_LIMITS: Dict[str, tuple] = {
+    BUDGET_COMMAND: (100.0, 200),
+    BUDGET_EVENT: (500.0, 1000),
+    BUDGET_SESSION: (50.0, 100),
+}
+RATE_LIMIT_ENABLED = True
+THROTTLE_NOTICE_INTERVAL = 1.0  # 秒；不带 client_event_id / request_id 的消息被拒时，每个桶每秒最多回复一次
+
+MESSAGE_BUDGETS: Dict[MessageType, str] = {
+    **dict.fromkeys((
+        MessageType.INPUT_SUBMIT,
+        MessageType.CLIENT_EVENT_SUBMIT,
+        MessageType.CURSOR_INPUT_TEXT,
+        MessageType.COMPOSER_SEND_PROMPT,
+        MessageType.COMPOSER_QUERY_STATUS,
+        MessageType.AGENT_EXECUTE_PROMPT,
+        MessageType.AGENT_STOP_EXECUTION,
+        MessageType.GET_CONVERSATION_ID,
+        MessageType.SESSION_RESUME,
+        MessageType.SERVER_DIAGNOSTICS,
+    ), BUDGET_COMMAND),
+    **dict.fromkeys((
+        MessageType.AITUBER_RECEIVE_TEXT,
+        MessageType.AITUBER_SPEAK,
+        MessageType.AITUBER_EMOTION,
+        MessageType.AITUBER_STATUS,
+        MessageType.AGENT_STATUS_CHANGED,
+        MessageType.AGENT_COMPLETED,
+        MessageType.AGENT_ERROR,
+        MessageType.SESSION_EVENT,
+    ), BUDGET_EVENT),
+}
+
+
+def _load_rate_limits():
+    global RATE_LIMIT_ENABLED
+    raw = os.environ.get("ORTENSIA_RATE_LIMITS", "").strip()
+    if raw.lower() in ("off", "0", "none"):
+        RATE_LIMIT_ENABLED = False
+        return
+    for item in raw.split(","):
+        if "=" not in item:
+            continue
+        key, value = (part.strip() for part in item.split("=", 1))
+        rate, _, burst = value.partition("/")
+        try:
+            rate = float(rate)
+            burst = int(burst) if burst else max(1, int(rate))
+        except ValueError:
+            rate = 0
+        if rate > 0 and burst > 0:
+            RATE_LIMITS[key] = (rate, burst)
+        else:
+            logger.warning(f"⚠️  忽略无效的限流配置: {item}")
+
+
+_load_rate_limits()
+
+
+class TokenBucket:
+    """令牌桶：按 rate 持续补充，最多积累 burst 个"""
+    
+    __slots__ = ("rate", "burst", "tokens", "updated", "last_notice")
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.last_notice = 0.0
+    
+    def take(self) -> float:
+        """取一个令牌；返回 0 表示放行，否则为还需等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def budget_for_roles(roles, budget: str) -> tuple:
+    """(速率, 突发)：按角色覆盖，多角色取最宽松的"""
+    return max(
+        (RATE_LIMITS.get(f"{role}.{budget}", RATE_LIMITS[budget]) for role in roles),
+        default=RATE_LIMITS[budget],
+    )
+
+
 class ClientInfo:
-    """客户端信息（支持多角色）"""
+    """客户端信息（支持多角色）
+    
+    角色变更（add_role / remove_role / set_roles）会通知所属的 ClientRegistry 更新索引，
+    因此不要直接修改 client_types 集合。
+    """
+    
+    remote = False  # 多进程模式下连接在其他 worker 上的客户端为 True（RemoteClientInfo）
+    worker: Optional[int] = None
     
     def __init__(self, websocket, client_id: str, client_types: set = None):
         self.websocket = websocket
         self.client_id = client_id
-        self.client_types = client_types or set()  # 多角色集合
+        self.client_types = set(client_types or ())  # 多角色集合
         self.registered_at = time.time()
-        self.last_heartbeat = time.time()
+        self.last_heartbeat = time.time()  # 最近一次收到任何帧的时间
+        self._hb_deadline: Optional[float] = None  # HeartbeatScheduler 中当前有效的截止时间
         self.metadata = {}  # 额外的元数据
+        self._buckets: Dict[str, TokenBucket] = {}  # 预算 → 令牌桶（首次用到时按角色创建）
+        self.throttled = 0  # 被限流拒绝的消息数
+        self.js_latency_ms: Optional[float] = None  # inject：server 发出的 execute_js 往返耗时（指数平均）
+        self.codec = TEXT_CODEC  # 出站编解码器（register 时按客户端声明的 codecs 协商）
+        self._registry: Optional["ClientRegistry"] = None  # 所属注册表（由 registry 设置）
+        self._primary_type = self._compute_primary_type()
+        
+        # 出站队列：(frame, policy)；写任务在第一次发送时启动
+        self._outbox: deque = deque()
+        self._outbox_ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._outbox_closed = False
+        self.outbox_stats = {"sent": 0, "dropped": 0, "max_depth": 0}
+    
+    def _compute_primary_type(self) -> str:
+        if not self.client_types:
+            return "unknown"
+        # 优先级：cursor_inject > aituber_client > command_client > agent_hook
+        for role in ROLE_PRIORITY:
+            if role in self.client_types:
+                return role
+        return min(self.client_types)
+    
+    def _roles_changed(self, added=(), removed=()):
+        self._buckets.clear()  # 预算随角色变化
+        old_primary = self._primary_type
+        self._primary_type = self._compute_primary_type()
+        if self._registry is not None:
+            self._registry._on_roles_changed(self, added, removed, old_primary)
     
     def add_role(self, role: str):
         """添加角色"""
+        if role in self.client_types:
+            return
         self.client_types.add(role)
+        self._roles_changed(added=(role,))
     
     def remove_role(self, role: str):
         """移除角色"""
+        if role not in self.client_types:
+            return
         self.client_types.discard(role)
+        self._roles_changed(removed=(role,))
+    
+    def set_roles(self, roles):
+        """整体替换角色集合"""
+        roles = set(roles)
+        added = tuple(roles - self.client_types)
+        removed = tuple(self.client_types - roles)
+        if not added and not removed:
+            return
+        self.client_types = roles
+        self._roles_changed(added=added, removed=removed)
     
     def has_role(self, role: str) -> bool:
         """检查是否拥有某个角色"""
@@ -136,22 +601,138 @@ class ClientInfo:
     
     @property
     def client_type(self) -> str:
-        """向后兼容：返回第一个角色（如果只有一个角色）或主要角色"""
-        if not self.client_types:
-            return "unknown"
-        # 优先级：cursor_inject > aituber_client > command_client > agent_hook
-        priority = ['cursor_inject', 'aituber_client', 'command_client', 'agent_hook']
-        for role in priority:
-            if role in self.client_types:
-                return role
-        return list(self.client_types)[0]
+        """向后兼容：返回第一个角色（如果只有一个角色）或主要角色（角色变更时预先计算）"""
+        return self._primary_type
+    
+    # ------------------------------------------------------------
+    # 出站队列
+    # ------------------------------------------------------------
+    
+    def send_message(self, message: Message) -> bool:
+        """按本客户端的编解码器编码并投递一条消息（不等待实际写出）"""
+        msg_type = message.type.value if isinstance(message.type, MessageType) else message.type
+        return self.send_frame(message.encode(self.codec), msg_type)
+    
+    def send_frame(self, frame: str, msg_type: Optional[str] = None) -> bool:
+        """
+        投递一条已编码的帧到出站队列（广播时多个客户端共享同一个 frame）
+        
+        Args:
+            frame: 已按本客户端编解码器编码的帧（文本 JSON 或 msgpack bytes）
+            msg_type: 消息类型（决定溢出策略；None 表示旧协议消息）
+        
+        Returns:
+            是否已入队（连接已关闭或因溢出被丢弃/断开时返回 False）
+        """
+        if self._outbox_closed:
+            return False
+        
+        policy = overflow_policy_for(msg_type)
+        if len(self._outbox) >= OUTBOX_MAX_SIZE:
+            if not self._handle_overflow(policy, msg_type):
+                return False
+        
+        self._outbox.append((frame, policy))
+        outbox_counters["enqueued"] += 1
+        metric_frames_out.inc(msg_type or "legacy")
+        depth = len(self._outbox)
+        if depth > self.outbox_stats["max_depth"]:
+            self.outbox_stats["max_depth"] = depth
+        self._outbox_ready.set()
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._writer_loop())
+        return True
+    
+    def _handle_overflow(self, policy: str, msg_type: Optional[str]) -> bool:
+        """队列已满；返回 True 表示已腾出位置，可以继续入队"""
+        # 先丢弃队列中最旧的可丢弃消息
+        for i, (_, queued_policy) in enumerate(self._outbox):
+            if queued_policy == OVERFLOW_DROP_OLDEST:
+                del self._outbox[i]
+                self._count_drop()
+                return True
+        
+        # 队列里全是不能丢的消息：可丢弃的新消息直接丢弃，否则断开
+        if policy == OVERFLOW_DROP_OLDEST:
+            self._count_drop()
+            return False
+        
+        logger.warning(
+            f"⚠️  [{self.client_id}] 出站队列已满 ({len(self._outbox)})，"
+            f"无法投递 {msg_type or 'legacy'}，断开慢客户端"
+        )
+        outbox_counters["overflow_disconnects"] += 1
+        self.close_outbox()
+        asyncio.create_task(self._close_slow_consumer())
+        return False
+    
+    def _count_drop(self):
+        self.outbox_stats["dropped"] += 1
+        outbox_counters["dropped"] += 1
+    
+    async def _close_slow_consumer(self):
+        try:
+            await self.websocket.close(code=1013, reason="outbound queue overflow")
+        except Exception:
+            pass
+    
+    async def _writer_loop(self):
+        """逐条写出出站队列（同一客户端内保持顺序）"""
+        try:
+            while True:
+                while not self._outbox:
+                    self._outbox_ready.clear()
+                    await self._outbox_ready.wait()
+                frame, _ = self._outbox.popleft()
+                try:
+                    await self.websocket.send(frame)
+                except websockets.exceptions.ConnectionClosed:
+                    break
+                except Exception as e:
+                    outbox_counters["send_errors"] += 1
+                    logger.error(f"❌ [{self.client_id}] 发送失败: {e}")
+                    continue
+                self.outbox_stats["sent"] += 1
+                outbox_counters["sent"] += 1
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._outbox_closed = True
+            self._outbox.clear()
+    
+    @property
+    def outbox_depth(self) -> int:
+        return len(self._outbox)
+    
+    def close_outbox(self):
+        """停止写任务并丢弃未发送的帧（连接断开时调用）"""
+        self._outbox_closed = True
+        self._outbox.clear()
+        if self._writer is not None and not self._writer.done():
+            self._writer.cancel()
     
     def update_heartbeat(self):
         """更新心跳时间"""
         self.last_heartbeat = time.time()
     
-    def is_alive(self, timeout=120):
-        """检查客户端是否存活（默认 120 秒超时）"""
+    @property
+    def heartbeat_timeout(self) -> float:
+        """按角色计算的心跳超时（多角色时取最宽松的）"""
+        return max(
+            (HEARTBEAT_ROLE_TIMEOUTS.get(role, HEARTBEAT_TIMEOUT) for role in self.client_types),
+            default=HEARTBEAT_TIMEOUT,
+        )
+    
+    @property
+    def rtt_ms(self) -> Optional[float]:
+        """websockets 协议层 ping/pong 测得的往返时延（尚未收到 pong 时为 None）"""
+        latency = getattr(self.websocket, "latency", 0) or 0
+        return round(latency * 1000, 1) if latency else None
+    
+    def is_alive(self, timeout: Optional[float] = None):
+        """检查客户端是否存活（默认使用角色对应的超时）"""
+        if timeout is None:
+            timeout = self.heartbeat_timeout
         return (time.time() - self.last_heartbeat) < timeout
     
     def __repr__(self):
@@ -159,8 +740,43 @@ class ClientInfo:
         return f"ClientInfo({self.client_id}, roles=[{roles}])"
 
 
+class RemoteClientInfo(ClientInfo):
+    """
+    多进程模式：连接在其他 worker 上的客户端（由 broker 转发的 claim 创建）
+    
+    只参与本 worker 的路由查询；发给它的帧经 broker 交给所属 worker 写出。
+    不参与心跳检测，由所属 worker 断开时的 release 移除。
+    """
+    
+    remote = True
+    
+    def __init__(self, client_id: str, worker: int, client_types=None):
+        super().__init__(None, client_id, client_types)
+        self.worker = worker
+    
+    def send_frame(self, frame: str, msg_type: Optional[str] = None) -> bool:
+        if cluster_link is None or not cluster_link.deliver(self.worker, self.client_id, frame, msg_type):
+            return False
+        self.outbox_stats["sent"] += 1
+        return True
+    
+    def __repr__(self):
+        roles = ", ".join(sorted(self.client_types)) if self.client_types else "none"
+        return f"RemoteClientInfo({self.client_id}@w{self.worker}, roles=[{roles}])"
+
+
 class ClientRegistry:
-    """客户端注册表"""
+    """客户端注册表
+    
+    除 client_id → ClientInfo 主表外，维护以下二级索引（注册/注销/角色变更/元数据更新时同步）：
+    - 角色 → 客户端（get_by_type）
+    - workspace → 客户端（get_by_workspace）
+    - conversation_id → 客户端（get_by_conversation）
+    - 主要角色计数（get_stats）
+    
+    注册表结构的修改请走 register / unregister / rename / remove_client / update_metadata，
+    不要直接改 clients 字典，否则索引会失效。
+    """
     
     def __init__(self):
         self.clients: Dict[str, ClientInfo] = {}  # client_id -> ClientInfo
@@ -170,6 +786,89 @@ class ClientRegistry:
         # V10: conversation_id 映射
         self.conversation_id_to_inject_id: Dict[str, str] = {}  # conversation_id -> inject_id
         self.inject_id_to_conversation_id: Dict[str, str] = {}  # inject_id -> conversation_id
+        
+        # 二级索引（内层 dict 保持注册顺序）
+        self._by_role: Dict[str, Dict[str, ClientInfo]] = {}
+        self._by_workspace: Dict[str, Dict[str, ClientInfo]] = {}
+        self._by_conversation: Dict[str, Dict[str, ClientInfo]] = {}
+        self._type_counts: Dict[str, int] = {}
+    
+    # ------------------------------------------------------------
+    # 索引维护
+    # ------------------------------------------------------------
+    
+    @staticmethod
+    def _index_add(index: Dict[str, Dict[str, ClientInfo]], key: Optional[str], client_info: ClientInfo):
+        if key:
+            index.setdefault(key, {})[client_info.client_id] = client_info
+    
+    @staticmethod
+    def _index_remove(index: Dict[str, Dict[str, ClientInfo]], key: Optional[str], client_id: str):
+        if not key:
+            return
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(client_id, None)
+            if not bucket:
+                del index[key]
+    
+    @staticmethod
+    def _conversation_key(client_info: ClientInfo) -> Optional[str]:
+        """客户端关联的 conversation_id：注册 payload 中的 conversation_id，或 hook-<conversation_id> 形式的 ID"""
+        conversation_id = client_info.metadata.get('conversation_id')
+        if conversation_id:
+            return conversation_id
+        if client_info.client_id.startswith("hook-"):
+            return client_info.client_id[5:]
+        return None
+    
+    def _count_type(self, client_type: str, delta: int):
+        count = self._type_counts.get(client_type, 0) + delta
+        if count > 0:
+            self._type_counts[client_type] = count
+        else:
+            self._type_counts.pop(client_type, None)
+    
+    def _index_attrs(self, client_info: ClientInfo):
+        self._index_add(self._by_workspace, client_info.metadata.get('workspace'), client_info)
+        self._index_add(self._by_conversation, self._conversation_key(client_info), client_info)
+    
+    def _unindex_attrs(self, client_info: ClientInfo):
+        self._index_remove(self._by_workspace, client_info.metadata.get('workspace'), client_info.client_id)
+        self._index_remove(self._by_conversation, self._conversation_key(client_info), client_info.client_id)
+    
+    def _index(self, client_info: ClientInfo):
+        for role in client_info.client_types:
+            self._index_add(self._by_role, role, client_info)
+        self._count_type(client_info.client_type, 1)
+        self._index_attrs(client_info)
+    
+    def _unindex(self, client_info: ClientInfo):
+        for role in client_info.client_types:
+            self._index_remove(self._by_role, role, client_info.client_id)
+        self._count_type(client_info.client_type, -1)
+        self._unindex_attrs(client_info)
+    
+    def _on_roles_changed(self, client_info: ClientInfo, added, removed, old_primary: str):
+        """ClientInfo 角色变更回调"""
+        if self.clients.get(client_info.client_id) is not client_info:
+            return
+        for role in added:
+            self._index_add(self._by_role, role, client_info)
+        for role in removed:
+            self._index_remove(self._by_role, role, client_info.client_id)
+        if old_primary != client_info.client_type:
+            self._count_type(old_primary, -1)
+            self._count_type(client_info.client_type, 1)
+    
+    def _add(self, client_info: ClientInfo):
+        self.clients[client_info.client_id] = client_info
+        client_info._registry = self
+        self._index(client_info)
+    
+    # ------------------------------------------------------------
+    # 注册 / 注销
+    # ------------------------------------------------------------
     
     def register(self, websocket, client_id: str, client_types: list, metadata: dict = None):
         """
@@ -197,15 +896,43 @@ class ClientRegistry:
         else:
             # 新客户端
             client_info = ClientInfo(websocket, client_id, set(client_types))
-            self.clients[client_id] = client_info
+            self._add(client_info)
             self.ws_to_id[websocket] = client_id
             logger.info(f"📝 注册客户端: {client_id}，角色: {sorted(client_types)}")
         
         if metadata:
-            client_info.metadata.update(metadata)
+            self.update_metadata(client_info, metadata)
         
         return client_info
     
+    def remove_client(self, client_id: str) -> Optional[ClientInfo]:
+        """从主表和索引中移除客户端（不处理 websocket 映射）"""
+        client_info = self.clients.pop(client_id, None)
+        if client_info is not None:
+            self._unindex(client_info)
+            client_info._registry = None
+        return client_info
+    
+    def rename(self, client_info: ClientInfo, new_id: str):
+        """修改客户端 ID（临时 ID → 注册 ID），同步主表、索引和 websocket 映射"""
+        old_id = client_info.client_id
+        if old_id == new_id:
+            return
+        if self.clients.get(old_id) is client_info:
+            self.remove_client(old_id)
+        client_info.client_id = new_id
+        self._add(client_info)
+        self.ws_to_id[client_info.websocket] = new_id
+    
+    def update_metadata(self, client_info: ClientInfo, metadata: dict):
+        """更新客户端元数据（workspace / conversation_id 变化时同步索引）"""
+        indexed = self.clients.get(client_info.client_id) is client_info
+        if indexed:
+            self._unindex_attrs(client_info)
+        client_info.metadata.update(metadata)
+        if indexed:
+            self._index_attrs(client_info)
+    
     def unregister(self, websocket):
         """注销客户端"""
         if websocket in self.ws_to_id:
@@ -227,10 +954,24 @@ class ClientRegistry:
                         del self.workspace_to_cursor[workspace]
                         logger.info(f"🗑️  清理 workspace 映射: {workspace}")
                 
-                del self.clients[client_id]
+                self.remove_client(client_id)
+                client_info.close_outbox()
+                if cluster_link is not None and client_info.client_type != "unknown":
+                    cluster_link.release(client_id)
+                
+                # 发往该客户端、尚未收到响应的请求立即失败（不必等到超时）
+                failed = pending_requests.fail_target(client_id, f"目标客户端已断开: {client_id}")
+                if failed:
+                    logger.info(f"⚠️  {failed} 个待响应请求因 {client_id} 断开而失败")
+                conversation_windows.drop_inject(client_id)
+                conversation_directory.drop_inject(client_id)
                 logger.info(f"📤 注销客户端: {client_id} (角色: [{roles_str}])")
             del self.ws_to_id[websocket]
     
+    # ------------------------------------------------------------
+    # 查询
+    # ------------------------------------------------------------
+    
     def get_by_id(self, client_id: str) -> Optional[ClientInfo]:
         """根据 ID 获取客户端"""
         return self.clients.get(client_id)
@@ -243,8 +984,19 @@ class ClientRegistry:
         return None
     
     def get_by_type(self, client_type: str) -> list:
-        """获取拥有指定角色的所有客户端（支持多角色）"""
-        return [c for c in self.clients.values() if c.has_role(client_type)]
+        """获取拥有指定角色的所有客户端（支持多角色，按注册顺序）"""
+        bucket = self._by_role.get(client_type)
+        return list(bucket.values()) if bucket else []
+    
+    def get_by_workspace(self, workspace: str) -> list:
+        """获取注册时声明了该 workspace 的所有客户端"""
+        bucket = self._by_workspace.get(workspace)
+        return list(bucket.values()) if bucket else []
+    
+    def get_by_conversation(self, conversation_id: str) -> list:
+        """获取关联到该 conversation_id 的所有客户端（hook 等）"""
+        bucket = self._by_conversation.get(conversation_id)
+        return list(bucket.values()) if bucket else []
     
     def update_heartbeat(self, client_id: str):
         """更新客户端心跳"""
@@ -269,128 +1021,638 @@ class ClientRegistry:
     # ============================================================
     
     def get_stats(self) -> dict:
-        """获取统计信息"""
-        stats = {}
-        for client in self.clients.values():
-            stats[client.client_type] = stats.get(client.client_type, 0) + 1
-        return stats
+        """获取统计信息（按主要角色计数）"""
+        return dict(self._type_counts)
 
 
 # 全局客户端注册表
 registry = ClientRegistry()
 
+
+def fanout_message(targets, message: Message) -> int:
+    """
+    把同一条消息投递给多个客户端：每种编解码器只编码一次，各目标共享同一帧
+    
+    Returns:
+        成功入队的客户端数
+    """
+    msg_type = message.type.value
+    started = time.perf_counter()
+    frames = {}
+    delivered = 0
+    total = 0
+    remote: Dict[int, list] = {}  # 多进程模式：同一 worker 上的目标合并为一次转发
+    for client in targets:
+        total += 1
+        if client.remote:
+            remote.setdefault(client.worker, []).append(client.client_id)
+            continue
+        frame = frames.get(client.codec.name)
+        if frame is None:
+            frame = frames[client.codec.name] = message.encode(client.codec)
+        if client.send_frame(frame, msg_type):
+            delivered += 1
+    if remote and cluster_link is not None:
+        frame = frames.get(TEXT_CODEC.name) or message.encode(TEXT_CODEC)
+        for worker, client_ids in remote.items():
+            if cluster_link.deliver(worker, client_ids, frame, msg_type):
+                delivered += len(client_ids)
+    metric_fanout_targets.observe(total, msg_type)
+    metric_fanout_seconds.observe(time.perf_counter() - started, msg_type)
+    return delivered
+
+
+def relay_raw_frame(route, frame: str) -> bool:
+    """
+    纯转发类消息的快速路径：不解析 payload，把原始帧原样放入目标的出站队列
+    
+    Returns:
+        True 表示已处理；False 表示需要回退到完整解析（目标不存在 / 目标使用二进制编解码器）
+    """
+    msg_type, from_id, to_id = route
+    target = registry.get_by_id(to_id) if to_id else None
+    if target is None or target.codec.binary:
+        return False
+    if target.send_frame(frame, msg_type):
+        logger.debug(f"📤 [直通] {msg_type}: {from_id} → {to_id}")
+    else:
+        logger.warning(f"⚠️  目标客户端出站队列不可用，消息未投递: {to_id}")
+    return True
+
 # ============================================================================
-# 消息处理
+# 待响应请求表（server → inject 的 execute_js 请求/响应关联）
 # ============================================================================
 
-async def handle_new_protocol_message(client_info: ClientInfo, message: Message):
-    """处理新协议消息"""
-    msg_type = message.type
+# ----------------------------------------------------------------------------
+# 环境变量：
+#   ORTENSIA_EXECUTE_JS_TIMEOUT   等待 execute_js_result 的超时（秒，默认 10）
+#   ORTENSIA_DISCOVERY_TIMEOUT    conversation_id 查询的超时（秒，默认 5）
+#   ORTENSIA_INPUT_MAX_ATTEMPTS   仅输入（execute=False）的最大尝试次数（默认 2）；
+#                                 execute=True 只尝试一次，避免重复提交 prompt
+# ----------------------------------------------------------------------------
+EXECUTE_JS_TIMEOUT = float(os.environ.get("ORTENSIA_EXECUTE_JS_TIMEOUT", "10"))
+DISCOVERY_TIMEOUT = float(os.environ.get("ORTENSIA_DISCOVERY_TIMEOUT", "5"))
+INPUT_MAX_ATTEMPTS = max(1, int(os.environ.get("ORTENSIA_INPUT_MAX_ATTEMPTS", "2")))
+INPUT_RETRY_BACKOFF = 0.2  # 秒，按尝试次数线性增加
+
+
+class PendingRequestError(Exception):
+    """待响应请求失败（目标断开等）"""
+
+
+class PendingRequestTimeout(PendingRequestError):
+    """待响应请求超时"""
+
+
+class PendingRequests:
+    """
+    按 request_id 关联 server 发出的请求与对端的响应
     
-    # 🔧 增强日志：显示完整的收包信息
-    logger.info(f"📨 [收包] {msg_type.value}")
-    logger.debug(f"    from: {message.from_}")
-    logger.debug(f"    to: {message.to or 'broadcast'}")
-    logger.debug(f"    payload: {str(message.payload)[:200]}...")
+    - new_request_id(): 生成唯一 request_id
+    - register():      登记请求，返回 Future（发送请求之前调用，避免响应先到）
+    - resolve():       收到 EXECUTE_JS_RESULT 时完成 Future
+    - wait():          带超时等待响应，返回 (响应消息, 耗时秒)
+    - fail_target():   目标客户端断开时，发往它的请求立即失败（不必等到超时）
+    """
     
-    try:
-        if msg_type == MessageType.REGISTER:
-            await handle_register(client_info, message)
-        
-        elif msg_type == MessageType.HEARTBEAT:
-            await handle_heartbeat(client_info, message)
-        
-        elif msg_type == MessageType.DISCONNECT:
-            await handle_disconnect(client_info, message)
-        
-        elif msg_type == MessageType.COMPOSER_SEND_PROMPT:
-            await handle_composer_send_prompt(client_info, message)
-        
-        elif msg_type == MessageType.COMPOSER_QUERY_STATUS:
-            await handle_composer_query_status(client_info, message)
-        
-        elif msg_type == MessageType.COMPOSER_SEND_PROMPT_RESULT:
-            await route_message(message)
-        
-        elif msg_type == MessageType.COMPOSER_STATUS_RESULT:
-            await route_message(message)
-        
-        # 语义操作（V9 新增）
-        elif msg_type == MessageType.AGENT_EXECUTE_PROMPT:
-            await handle_agent_execute_prompt(client_info, message)
-        
-        elif msg_type == MessageType.AGENT_EXECUTE_PROMPT_RESULT:
-            await route_message(message)
-        
-        elif msg_type == MessageType.AGENT_STOP_EXECUTION:
-            await handle_agent_stop_execution(client_info, message)
-        
-        elif msg_type == MessageType.AGENT_STOP_EXECUTION_RESULT:
-            await route_message(message)
-        
-        elif msg_type in [MessageType.AGENT_STATUS_CHANGED, MessageType.AGENT_COMPLETED, MessageType.AGENT_ERROR]:
-            await broadcast_event(message)
-        
-        # AITuber 操作
-        elif msg_type == MessageType.AITUBER_RECEIVE_TEXT:
-            await handle_aituber_receive_text(client_info, message)
-        
-        elif msg_type == MessageType.AITUBER_SPEAK:
-            await route_message(message)
-        
-        elif msg_type == MessageType.AITUBER_EMOTION:
-            await route_message(message)
-        
-        elif msg_type == MessageType.AITUBER_STATUS:
-            await route_message(message)
-        
-        # Cursor 输入操作
-        elif msg_type == MessageType.CURSOR_INPUT_TEXT:
-            # VNext: 不直接执行，统一进入 session 队列串行化，避免多端并发交错
-            await handle_cursor_input_text_enqueued(client_info, message)
-        
-        elif msg_type == MessageType.CURSOR_INPUT_TEXT_RESULT:
-            await route_message(message)  # 结果转发回发送者
-
-        # VNext: 输入仲裁（文本事件）
-        elif msg_type == MessageType.INPUT_SUBMIT:
-            await handle_input_submit(client_info, message)
-        elif msg_type == MessageType.INPUT_ACK:
-            await route_message(message)
-
-        # VNext: 通用扩展事件入口（不触达 inject）
-        elif msg_type == MessageType.CLIENT_EVENT_SUBMIT:
-            await handle_client_event_submit(client_info, message)
-        elif msg_type == MessageType.SESSION_EVENT:
-            # SESSION_EVENT 只应由 server 产生，这里默认转发（或丢弃）以兼容测试工具
-            await route_message(message)
+    def __init__(self):
+        self._pending: Dict[str, dict] = {}
+        self._next_id = 0
+        self.node = ""  # 多进程模式下为 "w<worker>"，写入 request_id 以便结果转回发起方
+        self.stats = {"registered": 0, "resolved": 0, "timeouts": 0, "failed": 0, "late": 0}
+    
+    def __len__(self) -> int:
+        return len(self._pending)
+    
+    def __contains__(self, request_id: str) -> bool:
+        return request_id in self._pending
+    
+    def new_request_id(self, prefix: str) -> str:
+        self._next_id += 1
+        if self.node:
+            return f"{prefix}_{self.node}_{self._next_id}"
+        return f"{prefix}_{self._next_id}"
+    
+    def register(self, request_id: str, target_id: str, **context) -> asyncio.Future:
+        if request_id in self._pending:
+            raise ValueError(f"request_id 已在等待中: {request_id}")
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = {
+            "future": future,
+            "target_id": target_id,
+            "context": context,
+            "sent_at": time.perf_counter(),
+        }
+        self.stats["registered"] += 1
+        return future
+    
+    def context(self, request_id: str) -> Optional[dict]:
+        entry = self._pending.get(request_id)
+        return entry["context"] if entry else None
+    
+    def discard(self, request_id: str):
+        """放弃等待（例如请求没发出去）"""
+        entry = self._pending.pop(request_id, None)
+        if entry and not entry["future"].done():
+            entry["future"].cancel()
+    
+    def resolve(self, message: Message) -> bool:
+        """
+        用响应消息完成对应的 Future
         
-        # 🆕 Conversation ID 查询（V10）
-        elif msg_type == MessageType.GET_CONVERSATION_ID:
-            await handle_get_conversation_id(client_info, message)
+        Returns:
+            True 表示匹配到了待响应请求
+        """
+        request_id = (message.payload or {}).get('request_id')
+        entry = self._pending.pop(request_id, None) if request_id else None
+        if entry is None:
+            return False
+        if not entry["future"].done():
+            entry["future"].set_result(message)
+        self.stats["resolved"] += 1
+        return True
+    
+    def fail_target(self, target_id: str, reason: str) -> int:
+        """让发往 target_id 的所有请求立即失败，返回受影响的请求数"""
+        failed = [rid for rid, entry in self._pending.items() if entry["target_id"] == target_id]
+        for rid in failed:
+            entry = self._pending.pop(rid)
+            if not entry["future"].done():
+                entry["future"].set_exception(PendingRequestError(reason))
+        self.stats["failed"] += len(failed)
+        return len(failed)
+    
+    async def wait(self, request_id: str, timeout: float):
+        """
+        等待响应
         
-        elif msg_type == MessageType.GET_CONVERSATION_ID_RESULT:
-            await route_message(message)  # 转发给请求者
+        Returns:
+            (响应消息, 从 register 到收到响应的耗时秒)
         
-        # 通用 JavaScript 执行
-        elif msg_type == MessageType.EXECUTE_JS:
-            # 🔒 白名单：禁止外部客户端直接请求 execute_js（防止绕过仲裁）
-            logger.warning(f"⛔ 拒绝外部 EXECUTE_JS 请求: from={message.from_}")
+        Raises:
+            PendingRequestTimeout: 超时
+            PendingRequestError: 目标断开
+        """
+        entry = self._pending.get(request_id)
+        if entry is None:
+            raise PendingRequestError(f"request_id 未登记: {request_id}")
+        try:
+            message = await asyncio.wait_for(entry["future"], timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(request_id, None)
+            self.stats["timeouts"] += 1
+            raise PendingRequestTimeout(f"等待响应超时（{timeout:g}s）: {request_id}") from None
+        return message, time.perf_counter() - entry["sent_at"]
+    
+    def snapshot(self) -> Dict[str, int]:
+        return {"in_flight": len(self._pending), **self.stats}
+
+
+pending_requests = PendingRequests()
+
+# ----------------------------------------------------------------------------
+# conversation_id → (inject_id, window_index) 缓存
+#
+# 由 discovery 结果和输入脚本的 execute_js_result 填充；命中时输入脚本只发给
+# 对应窗口（单播），未命中或映射过期（窗口返回 skipped / 索引越界）时回退到广播。
+# 输入脚本内仍保留 conversation_id 检查，所以过期映射不会输入到错误的窗口。
+# ----------------------------------------------------------------------------
+CONVERSATION_WINDOW_CACHE_SIZE = 1024
+
+
+class ConversationWindowCache:
+    """conversation_id → (inject_id, window_index)"""
+    
+    def __init__(self, max_size: int = CONVERSATION_WINDOW_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: Dict[str, tuple] = {}
+        self.stats = {"hits": 0, "misses": 0, "stale": 0}
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def lookup(self, conversation_id: Optional[str]) -> Optional[tuple]:
+        """返回 (inject_id, window_index)；inject 已断开的条目视为未命中"""
+        if not conversation_id:
+            return None
+        entry = self._entries.get(conversation_id)
+        if entry is not None and registry.get_by_id(entry[0]) is None:
+            del self._entries[conversation_id]
+            entry = None
+        self.stats["hits" if entry is not None else "misses"] += 1
+        return entry
+    
+    def update(self, conversation_id: Optional[str], inject_id: str, window_index: Optional[int]):
+        if not conversation_id or window_index is None:
             return
+        # 同一窗口换了对话：旧对话的映射作废
+        for conv_id, entry in list(self._entries.items()):
+            if entry == (inject_id, window_index) and conv_id != conversation_id:
+                del self._entries[conv_id]
+        self._entries.pop(conversation_id, None)
+        self._entries[conversation_id] = (inject_id, window_index)
+        while len(self._entries) > self.max_size:
+            del self._entries[next(iter(self._entries))]
+    
+    def invalidate(self, conversation_id: Optional[str]):
+        """映射已过期（条目可能已被同一窗口的新对话顶掉，仍计入 stale）"""
+        self.stats["stale"] += 1
+        if conversation_id:
+            self._entries.pop(conversation_id, None)
+    
+    def drop_inject(self, inject_id: str):
+        """inject 断开：窗口索引全部失效"""
+        for conv_id in [c for c, entry in self._entries.items() if entry[0] == inject_id]:
+            del self._entries[conv_id]
+    
+    def snapshot(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), **self.stats}
+
+
+conversation_windows = ConversationWindowCache()
+
+
+# ----------------------------------------------------------------------------
+# 对话目录缓存（discovery 结果，按 inject 缓存）
+#   ORTENSIA_DISCOVERY_CACHE_TTL  有效期（秒，默认 30；0 = 关闭，每次查询都执行脚本）
+#
+# GET_CONVERSATION_ID 在缓存有效时直接回复；过期或失效时执行查询脚本，
+# 同一 inject 的并发查询合并为一次。以下情况缓存失效并立即在后台刷新：
+#   - hook 注册 / hook 事件带来了目录中没有的 conversation_id（新开了对话）
+#   - inject 断开（直接丢弃，不刷新）
+# 命中但已超过半个 TTL 的条目也在后台提前刷新，轮询 discovery 的客户端基本总能命中。
+# 多进程模式下每个 worker 各有一份（hook 事件只让所在 worker 的缓存失效，其余靠 TTL）。
+# ----------------------------------------------------------------------------
+DISCOVERY_CACHE_TTL = max(0.0, float(os.environ.get("ORTENSIA_DISCOVERY_CACHE_TTL", "30")))
+
+
+class ConversationDirectory:
+    """inject_id → 该 inject 各窗口的对话列表（[{conversation_id, title, window_index, inject_id}]）"""
+    
+    def __init__(self, ttl: float = DISCOVERY_CACHE_TTL):
+        self.ttl = ttl
+        self._entries: Dict[str, dict] = {}  # inject_id → {"conversations", "fetched_at", "valid"}
+        self._known: Dict[str, str] = {}  # conversation_id → inject_id
+        self._unmatched: Dict[str, float] = {}  # 触发过失效、刷新后仍未出现的 conversation_id → 时间
+        self._invalidated_at: Dict[str, float] = {}  # inject_id → 最近一次失效时间
+        self._refreshing: Dict[str, asyncio.Task] = {}  # inject_id → 进行中的查询
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "background_refreshes": 0,
+                      "invalidations": 0, "refresh_errors": 0}
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _age(self, inject_id: str) -> Optional[float]:
+        entry = self._entries.get(inject_id)
+        if entry is None or not entry["valid"]:
+            return None
+        return time.monotonic() - entry["fetched_at"]
+    
+    def lookup(self, inject_id: str) -> Optional[list]:
+        """有效的缓存结果；没有、已失效或已过期时返回 None"""
+        age = self._age(inject_id)
+        if age is None or age >= self.ttl:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return self._entries[inject_id]["conversations"]
+    
+    def owner(self, conversation_id: Optional[str]) -> Optional[str]:
+        """目录中该对话所在的 inject（不论缓存是否过期，只用于选择输入目标）"""
+        return self._known.get(conversation_id) if conversation_id else None
+    
+    def should_refresh_ahead(self, inject_id: str) -> bool:
+        age = self._age(inject_id)
+        return age is not None and age >= self.ttl / 2 and inject_id not in self._refreshing
+    
+    def store(self, inject_id: str, conversations: list, started_at: float):
+        for conv_id in [c for c, owner in self._known.items() if owner == inject_id]:
+            del self._known[conv_id]
+        for conv in conversations:
+            self._known[conv["conversation_id"]] = inject_id
+        # 查询进行期间又失效过：结果可能不含新对话，下次查询重新执行
+        valid = self._invalidated_at.get(inject_id, 0.0) < started_at
+        self._entries[inject_id] = {"conversations": conversations, "fetched_at": time.monotonic(), "valid": valid}
+    
+    def observe(self, conversation_id: Optional[str]) -> list:
+        """
+        hook 报告了一个 conversation_id；目录中没有时让所有缓存失效
         
-        elif msg_type == MessageType.EXECUTE_JS_RESULT:
-            # 检查是否是 discovery 请求的结果
-            if not await handle_execute_js_result_for_discovery(message):
-                # 不是 discovery 请求，正常转发
-                await route_message(message)
-        
-        else:
-            logger.warning(f"⚠️  未知消息类型: {msg_type.value}")
+        Returns:
+            需要刷新的 inject_id 列表
+        """
+        if not conversation_id or conversation_id in self._known or not self._entries:
+            return []
+        now = time.monotonic()
+        # 刷新后仍找不到的对话（窗口已关闭 / 不在任何 inject 中）在一个 TTL 内不再触发刷新
+        last = self._unmatched.get(conversation_id)
+        if last is not None and now - last < self.ttl:
+            return []
+        self._unmatched[conversation_id] = now
+        while len(self._unmatched) > CONVERSATION_WINDOW_CACHE_SIZE:
+            del self._unmatched[next(iter(self._unmatched))]
+        for inject_id, entry in self._entries.items():
+            entry["valid"] = False
+            self._invalidated_at[inject_id] = now
+        self.stats["invalidations"] += 1
+        return list(self._entries)
+    
+    def drop_inject(self, inject_id: str):
+        """inject 断开：丢弃它的目录"""
+        if self._entries.pop(inject_id, None) is not None:
+            for conv_id in [c for c, owner in self._known.items() if owner == inject_id]:
+                del self._known[conv_id]
+        self._invalidated_at.pop(inject_id, None)
+    
+    def refresh(self, inject_id: str, fetch: Callable[[], Awaitable[list]], background: bool = False) -> asyncio.Task:
+        """启动查询（同一 inject 已有进行中的查询时复用），结果写入缓存"""
+        task = self._refreshing.get(inject_id)
+        if task is None:
+            self.stats["background_refreshes" if background else "refreshes"] += 1
+            task = asyncio.create_task(self._run_refresh(inject_id, fetch))
+            self._refreshing[inject_id] = task
+            # 后台刷新没有等待方：取走异常，避免 "exception was never retrieved"
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+    
+    async def _run_refresh(self, inject_id: str, fetch: Callable[[], Awaitable[list]]) -> list:
+        started_at = time.monotonic()
+        try:
+            conversations = await fetch()
+        except Exception:
+            self.stats["refresh_errors"] += 1
+            raise
+        finally:
+            self._refreshing.pop(inject_id, None)
+        if registry.get_by_id(inject_id) is not None:
+            self.store(inject_id, conversations, started_at)
+        return conversations
+    
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "injects": len(self._entries),
+            "conversations": len(self._known),
+            "refreshing": len(self._refreshing),
+            **self.stats,
+        }
+
+
+conversation_directory = ConversationDirectory()
+
+
+# ----------------------------------------------------------------------------
+# 注入脚本：模板模式（inject 已缓存脚本，只传参数）/ 内联回退（旧 inject）
+# ----------------------------------------------------------------------------
+
+def supports_js_templates(client_info: ClientInfo) -> bool:
+    return JS_TEMPLATES_CAPABILITY in (client_info.metadata.get('capabilities') or ())
+
+
+def build_template_execute(
+    target_inject: ClientInfo,
+    template: JsTemplate,
+    args: dict,
+    request_id: str,
+    window_index: Optional[int] = None,
+) -> Message:
+    """构造调用注入脚本模板的 execute_js 消息"""
+    if supports_js_templates(target_inject):
+        return MessageBuilder.execute_js(
+            from_id="server",
+            to_id=target_inject.client_id,
+            code="",
+            request_id=request_id,
+            window_index=window_index,
+            template=template.name,
+            template_hash=template.hash,
+            args=args,
+        )
+    return MessageBuilder.execute_js(
+        from_id="server",
+        to_id=target_inject.client_id,
+        code=template.render(args),
+        request_id=request_id,
+        window_index=window_index,
+    )
+
+
+# ============================================================================
+# 消息处理
+# ============================================================================
+
+# ----------------------------------------------------------------------------
+# 消息分发表：MessageType → handler(client_info, message)
+#
+# 内置 handler 在文件末尾的「分发表注册」一节登记；插件可以调用 register_handler
+# 增加新类型或覆盖内置处理。每个类型的处理耗时记录在 handler_stats 中，
+# 通过 SERVER_DIAGNOSTICS 查询。
+#
+# RELAY_MESSAGE_TYPES 中的类型默认走直通快速路径（不经过 handler）；
+# 为其中某个类型登记了 _route_only 以外的 handler 时，该类型改走完整解析，handler 才会被调用。
+# ----------------------------------------------------------------------------
+HandlerFunc = Callable[["ClientInfo", Message], Awaitable[None]]
+
+MESSAGE_HANDLERS: Dict[MessageType, HandlerFunc] = {}
+
+# 当前走直通快速路径的类型（字符串值）；由 register_handler 维护
+relay_fast_path: Set[str] = set(RELAY_MESSAGE_TYPES)
+
+# 消息类型 → [次数, 总耗时(秒), 最大耗时(秒)]
+handler_stats: Dict[str, list] = {}
+
+
+def register_handler(msg_type, handler: Optional[HandlerFunc] = None):
+    """
+    登记消息处理函数（可作为装饰器使用）
+    
+    Args:
+        msg_type: MessageType 或其字符串值
+        handler: async def handler(client_info, message)
+    
+    Example:
+        @register_handler(MessageType.AITUBER_STATUS)
+        async def my_handler(client_info, message): ...
+    """
+    if not isinstance(msg_type, MessageType):
+        msg_type = parse_message_type(msg_type)
+    
+    def decorator(func: HandlerFunc) -> HandlerFunc:
+        previous = MESSAGE_HANDLERS.get(msg_type)
+        if previous is not None and previous is not func:
+            logger.info(f"🔌 覆盖消息处理函数: {msg_type.value} ({previous.__name__} → {func.__name__})")
+        MESSAGE_HANDLERS[msg_type] = func
+        if msg_type.value in RELAY_MESSAGE_TYPES:
+            if func is _route_only:
+                relay_fast_path.add(msg_type.value)
+            else:
+                relay_fast_path.discard(msg_type.value)
+        return func
+    
+    if handler is not None:
+        return decorator(handler)
+    return decorator
+
+
+def record_handler_time(msg_type: str, elapsed: float, path: str = "handler"):
+    """记录一次消息处理耗时（path 为 relay 时表示走了直通转发）"""
+    metric_frames_in.inc(msg_type, path)
+    metric_handler_seconds.observe(elapsed, msg_type, path)
+    if path != "handler":
+        msg_type = f"{msg_type} ({path})"
+    entry = handler_stats.get(msg_type)
+    if entry is None:
+        handler_stats[msg_type] = [1, elapsed, elapsed]
+    else:
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+
+
+def handler_stats_snapshot() -> Dict[str, Dict[str, float]]:
+    """按总耗时从高到低排列的处理耗时统计（毫秒）"""
+    rows = sorted(handler_stats.items(), key=lambda kv: kv[1][1], reverse=True)
+    return {
+        msg_type: {
+            "count": count,
+            "total_ms": round(total * 1000, 3),
+            "avg_ms": round(total * 1000 / count, 3),
+            "max_ms": round(worst * 1000, 3),
+        }
+        for msg_type, (count, total, worst) in rows
+    }
+
+
+class _PayloadPreview:
+    """延迟生成的 payload 摘要：只有日志真正输出时才格式化，且大小有上限"""
+    
+    _repr = reprlib.Repr()
+    _repr.maxstring = 80
+    _repr.maxother = 80
+    _repr.maxdict = 8
+    _repr.maxlist = 8
+    _repr.maxlevel = 3
+    
+    __slots__ = ("payload",)
+    
+    def __init__(self, payload):
+        self.payload = payload
+    
+    def __str__(self):
+        return self._repr.repr(self.payload)
+
+
+def _client_bucket(client_info: ClientInfo, budget: str) -> TokenBucket:
+    bucket = client_info._buckets.get(budget)
+    if bucket is None:
+        bucket = client_info._buckets[budget] = TokenBucket(*budget_for_roles(client_info.client_types, budget))
+    return bucket
+
+
+def admit(client_info: ClientInfo, message: Message) -> bool:
+    """按客户端预算检查一条入站消息；超出预算时回复 THROTTLED 并返回 False"""
+    if not RATE_LIMIT_ENABLED:
+        return True
+    budget = MESSAGE_BUDGETS.get(message.type)
+    if budget is None:
+        return True
+    bucket = _client_bucket(client_info, budget)
+    wait = bucket.take()
+    if not wait:
+        return True
+    _reject_throttled(client_info, message, bucket, wait, "client", budget)
+    return False
+
+
+def admit_relay(client_info: ClientInfo, msg_type: str) -> bool:
+    """
+    直通快速路径的预算检查（只有类型字符串，MessageType 是 str 枚举，可直接查表）
     
+    超出预算时返回 False，由调用方回退到完整解析：admit() 再次检查并回复带关联 ID 的 THROTTLED
+    """
+    if not RATE_LIMIT_ENABLED:
+        return True
+    budget = MESSAGE_BUDGETS.get(msg_type)
+    if budget is None:
+        return True
+    return not _client_bucket(client_info, budget).take()
+
+
+def admit_session(client_info: ClientInfo, message: Message, s: "SessionState") -> bool:
+    """按 session 共享预算检查一条进入事件流的消息"""
+    if not RATE_LIMIT_ENABLED:
+        return True
+    if s.admission is None:
+        s.admission = TokenBucket(*RATE_LIMITS[BUDGET_SESSION])
+    wait = s.admission.take()
+    if not wait:
+        return True
+    _reject_throttled(client_info, message, s.admission, wait, "session", BUDGET_SESSION, s.session_id)
+    return False
+
+
+def _reject_throttled(client_info: ClientInfo, message: Message, bucket: TokenBucket, wait: float,
+                      scope: str, budget: str, session_id: Optional[str] = None):
+    client_info.throttled += 1
+    metric_throttled.inc(client_info.client_type, budget)
+    payload = message.payload or {}
+    client_event_id = payload.get('client_event_id')
+    request_id = payload.get('request_id')
+    
+    # 日志与无法关联的回复都按桶限频，避免被限流的客户端反过来刷屏
+    now = time.monotonic()
+    quiet = now - bucket.last_notice < THROTTLE_NOTICE_INTERVAL
+    if not quiet:
+        bucket.last_notice = now
+        logger.warning(
+            f"🚦 [{client_info.client_id}] 超出 {scope}/{budget} 预算 "
+            f"({bucket.rate:g}/s, 突发 {bucket.burst})，拒绝 {message.type.value}（累计 {client_info.throttled}）"
+        )
+    if quiet and not (client_event_id or request_id):
+        return
+    client_info.send_message(MessageBuilder.throttled(
+        to_id=client_info.client_id,
+        message_type=message.type.value,
+        scope=scope,
+        budget=budget,
+        retry_after_ms=max(1, int(wait * 1000)),
+        rate=bucket.rate,
+        burst=bucket.burst,
+        client_event_id=client_event_id,
+        request_id=request_id,
+        session_id=session_id,
+    ))
+
+
+async def handle_new_protocol_message(client_info: ClientInfo, message: Message):
+    """处理新协议消息：按分发表调用对应的 handler"""
+    msg_type = message.type
+    
+    # 🔧 收包日志（payload 摘要只在 DEBUG 输出时才生成）
+    logger.info("📨 [收包] %s", msg_type.value)
+    logger.debug("    from: %s → to: %s, payload: %s", message.from_, message.to or 'broadcast', _PayloadPreview(message.payload))
+    
+    handler = MESSAGE_HANDLERS.get(msg_type)
+    if handler is None:
+        logger.warning(f"⚠️  未知消息类型: {msg_type.value}")
+        return
+    
+    # 多进程模式：session 相关消息交给 session 所在的 worker 处理
+    if cluster_link is not None and msg_type in SESSION_MESSAGE_TYPES and not client_info.remote:
+        home = cluster_link.home_worker(_resolve_session_id(client_info, message.payload))
+        if home != cluster_link.worker_id:
+            cluster_link.forward_message(home, client_info.client_id, message.encode(TEXT_CODEC))
+            return
+    
+    started = time.perf_counter()
+    try:
+        await handler(client_info, message)
     except Exception as e:
         logger.error(f"❌ 处理消息错误: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        record_handler_time(msg_type.value, time.perf_counter() - started)
 
 
 async def handle_register(client_info: ClientInfo, message: Message):
@@ -411,29 +1673,38 @@ async def handle_register(client_info: ClientInfo, message: Message):
     else:
         client_types = ['unknown']
     
-    # 更新客户端信息
-    client_info.client_id = client_id
+    real_roles = [role for role in client_types if role != 'unknown']
     
     # 更新角色（如果已存在，添加新角色；否则设置角色）
+    existing = registry.clients.get(client_id)
+    if existing is not None and existing.remote:
+        # 多进程模式：客户端重连到了本 worker，旧 worker 的 release 会被 broker 忽略
+        _forget_remote_client(client_id)
+    
     if client_id in registry.clients and client_id != old_id:
         # 这是已存在的客户端重新注册，添加新角色
         existing_info = registry.clients[client_id]
         for role in client_types:
             existing_info.add_role(role)
+        # 临时条目不再需要（websocket 映射保持原样）
+        if old_id:
+            registry.remove_client(old_id)
         client_info = existing_info
     else:
-        # 新客户端或ID未变
+        # 新客户端或ID未变：临时 ID → 注册 ID
+        registry.rename(client_info, client_id)
         for role in client_types:
             client_info.add_role(role)
+        # 去掉连接建立时的临时 "unknown" 角色
+        if real_roles:
+            client_info.remove_role('unknown')
     
-    client_info.metadata.update(payload)
+    registry.update_metadata(client_info, payload)
     client_info.update_heartbeat()
+    heartbeat_scheduler.track(client_info)  # 角色已确定，按角色超时重新排期
+    if client_info.has_role('cursor_hook') or client_info.has_role('agent_hook'):
+        observe_hook_conversation(registry._conversation_key(client_info))
     
-    # 更新注册表（ID 可能变了）
-    if old_id and old_id in registry.clients and old_id != client_id:
-        del registry.clients[old_id]
-    
-    registry.clients[client_id] = client_info
     registry.ws_to_id[client_info.websocket] = client_id
     
     # 如果是 cursor_hook 或 agent_hook，注册 workspace 映射
@@ -444,12 +1715,16 @@ async def handle_register(client_info: ClientInfo, message: Message):
     
     roles_str = ", ".join(sorted(client_info.client_types))
     logger.info(f"✅ [{client_id}] 注册成功，角色: [{roles_str}]")
+    publish_client(client_info)
 
     # VNext: 如果注册 payload 带默认 session_id，则加入 session 成员（用于 session_event 广播）
     default_session_id = payload.get('session_id')
-    if default_session_id:
+    if default_session_id and is_session_home(default_session_id):
         session_manager.join(default_session_id, client_id)
     
+    # 协商编解码器（payload.codecs 按偏好排序，例如 ["msgpack", "json"]）
+    codec = negotiate_codec(payload.get('codecs'))
+    
     # 发送确认
     ack_msg = MessageBuilder.register_ack(
         to_id=client_id,
@@ -459,11 +1734,20 @@ async def handle_register(client_info: ClientInfo, message: Message):
             "version": "2.0",
             "supported_protocols": ["v1"],
             "multi_role": True,  # 🆕 标记服务器支持多角色
-            "server_time": int(time.time())
+            "server_time": int(time.time()),
+            "codec": codec.name if codec.binary else "json",  # 之后服务端发给该客户端的帧格式
         }
     )
     
-    await client_info.websocket.send(ack_msg.to_json())
+    # 确认本身仍用 JSON 文本发送，之后才切换到协商的编解码器
+    client_info.send_message(ack_msg)
+    client_info.codec = codec
+    
+    # 支持模板的 inject：注册时一次性下发注入脚本，之后 execute_js 只传模板名和参数
+    if client_info.has_role('cursor_inject') and supports_js_templates(client_info):
+        definitions = template_definitions()
+        client_info.send_message(MessageBuilder.js_template_define(client_id, definitions))
+        logger.info(f"📜 已下发 {len(definitions)} 个注入脚本模板 → {client_id}")
     
     # V11: 不再主动请求 conversation_id，改用动态查询
 
@@ -474,7 +1758,7 @@ async def handle_heartbeat(client_info: ClientInfo, message: Message):
     
     # 发送心跳响应
     ack_msg = MessageBuilder.heartbeat_ack(to_id=client_info.client_id)
-    await client_info.websocket.send(ack_msg.to_json())
+    client_info.send_message(ack_msg)
 
 
 async def handle_disconnect(client_info: ClientInfo, message: Message):
@@ -552,55 +1836,80 @@ async def handle_aituber_receive_text(client_info: ClientInfo, message: Message)
     工作流程:
     1. 提取文本和情绪
     2. 将 conversation_id 添加到 payload 中
-    3. 转发给所有 AITuber 客户端
+    3. 序列化一次，并发转发给所有 AITuber 客户端
+    
+    注册表明细不再在这里逐条输出，需要时用 SERVER_DIAGNOSTICS 查询。
     """
     hook_id = message.from_
-    payload = message.payload
     
     # 1. 从 hook ID 提取 conversation_id
     conversation_id = "unknown"
     if hook_id.startswith("hook-"):
         conversation_id = hook_id[5:]
     
-    logger.info(f"📨 [AITuber] Hook 消息，conversation_id: {conversation_id}")
-    
     # 2. 获取所有 AITuber 客户端
     aituber_clients = registry.get_by_type('aituber_client')
     
-    # 🔍 诊断：显示当前所有已注册的客户端
-    all_clients = list(registry.clients.keys())
-    logger.info(f"🔍 [诊断] 当前已注册客户端总数: {len(all_clients)}")
-    if all_clients:
-        logger.info(f"🔍 [诊断] 已注册客户端列表:")
-        for cid in all_clients:
-            client = registry.clients.get(cid)
-            if client:
-                roles = sorted(client.client_types)
-                logger.info(f"    - {cid}: 角色={roles}")
-    
-    logger.info(f"🔍 [诊断] 查找 aituber_client 类型，找到 {len(aituber_clients)} 个客户端")
-    
     if not aituber_clients:
-        logger.warning(f"⚠️  [AITuber] 目标客户端不存在: aituber_client")
-        logger.warning(f"⚠️  [AITuber] 消息无法转发，请确保 AITuber 客户端已连接并注册")
+        logger.warning(f"⚠️  [AITuber] 没有已注册的 aituber_client，消息无法转发 (from={hook_id})")
         return
     
     # ✨ 将 conversation_id 添加到 payload 中
     message.payload['conversation_id'] = conversation_id
-    
-    # 5. 转发给所有 AITuber 客户端
-    for aituber in aituber_clients:
-        try:
-            await aituber.websocket.send(message.to_json())
-            logger.info(f"📤 [AITuber] 消息已转发: {hook_id} → {aituber.client_id}")
-        except Exception as e:
-            logger.error(f"❌ [AITuber] 转发失败: {aituber.client_id}, {e}")
+    if hook_id.startswith("hook-"):
+        observe_hook_conversation(conversation_id)
+    
+    # 3. 每种编解码器只序列化一次，放入各客户端的出站队列
+    success_count = fanout_message(aituber_clients, message)
+    logger.info(f"📤 [AITuber] {hook_id} (conversation_id: {conversation_id}) → {success_count}/{len(aituber_clients)} 客户端")
+
+
+async def handle_server_diagnostics(client_info: ClientInfo, message: Message):
+    """按需返回注册表明细（替代原先每条 hook 消息都输出的诊断日志）"""
+    now = time.time()
+    clients = [
+        {
+            "client_id": c.client_id,
+            "roles": sorted(c.client_types),
+            "client_type": c.client_type,
+            "workspace": c.metadata.get('workspace'),
+            "registered_for": round(now - c.registered_at, 1),
+            "last_heartbeat_ago": round(now - c.last_heartbeat, 1),
+            "heartbeat_timeout": c.heartbeat_timeout,
+            "rtt_ms": c.rtt_ms,
+            "js_latency_ms": c.js_latency_ms,
+            "throttled": c.throttled,
+            "worker": c.worker if c.remote else CLUSTER_WORKER_ID,
+            "outbox_depth": c.outbox_depth,
+            **{f"outbox_{k}": v for k, v in c.outbox_stats.items()},
+        }
+        for c in registry.clients.values()
+    ]
+    result = MessageBuilder.server_diagnostics_result(
+        to_id=client_info.client_id,
+        stats=registry.get_stats(),
+        clients=clients,
+        request_id=message.payload.get('request_id'),
+        outbox=dict(outbox_counters),
+        handlers=handler_stats_snapshot(),
+        pending=pending_requests.snapshot(),
+        routing=conversation_windows.snapshot(),
+        sessions={
+            **session_manager.snapshot(),
+            **({f"log_{k}": v for k, v in session_log.stats.items()} if session_log else {}),
+        },
+        heartbeat=heartbeat_scheduler.snapshot(),
+        cluster=cluster_link.snapshot() if cluster_link else None,
+        discovery=conversation_directory.snapshot(),
+    )
+    client_info.send_message(result)
+    logger.info(f"🩺 [诊断] 已返回 {len(clients)} 个客户端的状态 → {client_info.client_id}")
 
 
 async def handle_get_conversation_id(client_info: ClientInfo, message: Message):
     """
     处理 GET_CONVERSATION_ID 请求（V11.3 正确实现）
-    通过生成 JavaScript 代码来查询所有窗口的 conversation_id
+    优先用对话目录缓存回复；未命中时生成 JavaScript 代码查询所有窗口的 conversation_id
     """
     from_id = message.from_
     request_id = message.payload.get('request_id', f"discover_{int(time.time())}")
@@ -621,447 +1930,430 @@ async def handle_get_conversation_id(client_info: ClientInfo, message: Message):
             conversation_id=None,
             error="没有可用的 Cursor inject"
         )
-        await client_info.websocket.send(error_msg.to_json())
+        client_info.send_message(error_msg)
         return
     
-    # 使用第一个 inject 客户端（广播模式）
-    target_inject = inject_clients[0]
-    
-    # 生成在渲染进程 DOM 中执行的 JavaScript 代码（与 cursor_input_text 相同的方式）
-    # 这段代码会被 inject 在每个窗口的渲染进程中执行（广播模式）
-    js_code = """(() => {
-    const el = document.querySelector('[id^="composer-bottom-add-context-"]');
-    if (!el) {
-        return JSON.stringify({ 
-            found: false, 
-            conversationId: null,
-            title: null
-        });
-    }
-    
-    const match = el.id.match(/composer-bottom-add-context-([a-f0-9-]+)/);
-    const conversationId = match ? match[1] : null;
-    
-    // 获取窗口标题
-    let title = document.querySelector('.window-title')?.textContent?.trim();
-    if (!title) {
-        title = document.querySelector('.titlebar-center')?.textContent?.trim();
-    }
-    // 清理标题（移除 "AgentsEditor" 等前缀）
-    if (title) {
-        title = title.replace(/^AgentsEditor\\s*/, '').trim();
-    }
-    if (!title) {
-        title = 'Untitled Conversation';
-    }
-    
-    return JSON.stringify({ 
-        found: true, 
-        conversationId: conversationId,
-        title: title,
-        elementId: el.id
-    });
-})()"""
-    
-    # 通过 EXECUTE_JS 发送
-    execute_msg = MessageBuilder.execute_js(
-        from_id="server",
-        to_id=target_inject.client_id,
-        code=js_code,
-        request_id=f"get_conv_id_{request_id}",
-        window_index=None,
-        conversation_id=None
-    )
-    
-    # 存储原始请求者信息，用于转发结果
-    # 使用 request_id 作为 key，存储发送者信息
-    if not hasattr(handle_get_conversation_id, 'pending_requests'):
-        handle_get_conversation_id.pending_requests = {}
-    
-    handle_get_conversation_id.pending_requests[f"get_conv_id_{request_id}"] = {
-        'requester_id': from_id,
-        'original_request_id': request_id
-    }
+    # 查询所有 inject（每个 inject 一个实例，广播到它的所有窗口）；缓存命中的先回复，
+    # 其余并发查询（各自超时），每个 inject 的结果到达后立即发给请求者
+    sent = 0
+    refreshes: Dict[str, asyncio.Task] = {}
+    for inject in inject_clients:
+        cached = conversation_directory.lookup(inject.client_id)
+        if cached is None:
+            refreshes[inject.client_id] = refresh_conversation_directory(inject)
+            continue
+        logger.info(f"⚡ [Discovery] 缓存命中: {len(cached)} 个对话 (inject={inject.client_id})")
+        if cached:
+            _send_discovery_results(client_info, request_id, cached)
+            sent += len(cached)
+        if conversation_directory.should_refresh_ahead(inject.client_id):
+            refresh_conversation_directory(inject, background=True)
+    
+    if not refreshes:
+        if not sent:
+            _send_discovery_results(client_info, request_id, [])
+        return
     
-    await target_inject.websocket.send(execute_msg.to_json())
-    logger.info(f"📤 [Discovery] 已发送查询脚本到 inject: {target_inject.client_id}")
+    # 在独立任务中等待结果，不阻塞请求者连接的消息循环
+    task = asyncio.create_task(_await_discovery_result(
+        refreshes, from_id, request_id, sent, all_queried=len(refreshes) == len(inject_clients)))
+    _discovery_tasks.add(task)
+    task.add_done_callback(_discovery_tasks.discard)
 
 
-async def handle_execute_js_result_for_discovery(message: Message):
-    """
-    处理 conversation_id 查询的结果
-    返回 True 表示已处理（是 discovery 请求），False 表示不是 discovery 请求
+_discovery_tasks: Set[asyncio.Task] = set()
+
+
+def refresh_conversation_directory(target_inject: ClientInfo, background: bool = False) -> asyncio.Task:
+    """查询 inject 的对话列表并写入目录缓存（同一 inject 的并发查询合并为一次）"""
+    return conversation_directory.refresh(
+        target_inject.client_id, lambda: _query_conversations(target_inject), background=background)
+
+
+def observe_hook_conversation(conversation_id: Optional[str]):
+    """hook 报告的 conversation_id 不在目录中：缓存失效，后台重新查询"""
+    for inject_id in conversation_directory.observe(conversation_id):
+        inject = registry.get_by_id(inject_id)
+        if inject is not None:
+            logger.info(f"🔄 [Discovery] 新对话 {conversation_id}，后台刷新目录 (inject={inject_id})")
+            refresh_conversation_directory(inject, background=True)
+
+
+async def _query_conversations(target_inject: ClientInfo) -> list:
     """
-    request_id = message.payload.get('request_id', '')
+    在 inject 的每个窗口执行查询脚本（广播模式），见 js_templates.GET_CONVERSATION_ID
     
-    # 检查是否是 discovery 请求的结果
-    if not request_id.startswith('get_conv_id_'):
-        return False
-    
-    if not hasattr(handle_get_conversation_id, 'pending_requests'):
-        return False
-    
-    pending = handle_get_conversation_id.pending_requests.get(request_id)
-    if not pending:
-        logger.debug(f"⚠️  [Discovery] 未找到待处理请求: {request_id}")
-        return False
-    
-    # 移除待处理请求
-    del handle_get_conversation_id.pending_requests[request_id]
-    
-    requester_id = pending['requester_id']
-    original_request_id = pending['original_request_id']
-    
-    # 解析结果
-    success = message.payload.get('success', False)
-    result_data = message.payload.get('result', {})
+    Raises:
+        PendingRequestError: 发送失败、超时、inject 断开或脚本执行失败
+    """
+    js_request_id = pending_requests.new_request_id("get_conv_id")
+    execute_msg = build_template_execute(target_inject, GET_CONVERSATION_ID, {}, js_request_id)
     
-    logger.info(f"📨 [Discovery] 收到查询结果: success={success}, type={type(result_data)}")
+    pending_requests.register(js_request_id, target_inject.client_id)
+    if not target_inject.send_message(execute_msg):
+        pending_requests.discard(js_request_id)
+        raise PendingRequestError("Cursor inject 出站队列不可用")
+    logger.info(f"📤 [Discovery] 已发送查询脚本到 inject: {target_inject.client_id}")
     
-    if not success:
-        # 执行失败
-        error_msg = MessageBuilder.get_conversation_id_result(
+    message, elapsed = await pending_requests.wait(js_request_id, DISCOVERY_TIMEOUT)
+    record_inject_latency(target_inject, "discovery", elapsed)
+    logger.info(f"⏱️  [Discovery] {target_inject.client_id} 响应耗时 {elapsed * 1000:.1f}ms")
+    if not message.payload.get('success', False):
+        raise PendingRequestError(message.payload.get('error', '查询失败'))
+    return _parse_discovery_result(message)
+
+
+def _send_discovery_error(requester_id: str, request_id: str, error: str):
+    requester = registry.get_by_id(requester_id)
+    if requester:
+        requester.send_message(MessageBuilder.get_conversation_id_result(
             from_id="server",
             to_id=requester_id,
-            request_id=original_request_id,
+            request_id=request_id,
             success=False,
             conversation_id=None,
-            error=message.payload.get('error', '查询失败')
-        )
-        
+            error=error
+        ))
+
+
+def record_inject_latency(inject: ClientInfo, op: str, elapsed: float):
+    """记录 server → inject 的 execute_js 往返耗时（指标 + 诊断中的 js_latency_ms）"""
+    metric_inject_seconds.observe(elapsed, inject.client_id, op)
+    ms = elapsed * 1000
+    previous = inject.js_latency_ms
+    inject.js_latency_ms = round(ms if previous is None else 0.8 * previous + 0.2 * ms, 1)
+
+
+async def _await_inject_conversations(inject_id: str, refresh: asyncio.Task) -> tuple:
+    """(inject_id, 对话列表或 None, 错误)；请求者断开不应取消其他请求者也在等待的查询"""
+    try:
+        return inject_id, await asyncio.shield(refresh), None
+    except PendingRequestError as e:
+        return inject_id, None, e
+
+
+async def _await_discovery_result(refreshes: Dict[str, asyncio.Task], requester_id: str, original_request_id: str,
+                                  sent: int, all_queried: bool):
+    """
+    等待各 inject 的目录查询（可能与其他请求共享），每个 inject 的结果到达后立即转发给请求者
+    
+    所有 inject 都查询失败时回复错误；部分失败只记录日志（其余 inject 的结果照常返回）
+    """
+    errors = []
+    for next_result in asyncio.as_completed(
+        [_await_inject_conversations(inject_id, task) for inject_id, task in refreshes.items()]
+    ):
+        inject_id, conversations, error = await next_result
+        if error is not None:
+            logger.warning(f"⚠️  [Discovery] {inject_id}: {error}")
+            errors.append(error)
+            continue
         requester = registry.get_by_id(requester_id)
-        if requester:
-            await requester.websocket.send(error_msg.to_json())
-        return True
+        if requester and conversations:
+            _send_discovery_results(requester, original_request_id, conversations)
+            sent += len(conversations)
+    
+    if sent:
+        return
+    if all_queried and len(errors) == len(refreshes):
+        _send_discovery_error(requester_id, original_request_id, str(errors[0]))
+        return
+    requester = registry.get_by_id(requester_id)
+    if requester:
+        _send_discovery_results(requester, original_request_id, [])
+
+
+def _parse_discovery_result(message: Message) -> list:
+    """
+    解析广播模式的查询结果 {窗口索引: 结果}，返回 [{conversation_id, title, window_index}]
+    """
+    result_data = message.payload.get('result', {})
     
     # 🔍 打印原始结果用于调试
     logger.debug(f"🔍 [DEBUG] Inject 返回的原始结果类型: {type(result_data)}")
     logger.debug(f"🔍 [DEBUG] Inject 返回的原始结果: {result_data}")
     
-    # 解析广播模式的结果：{0: result0, 1: result1, ...}
     conversations = []
     total_windows = 0
+    if not isinstance(result_data, dict):
+        logger.warning(f"⚠️  [Discovery] 无法识别的查询结果: {type(result_data)}")
+        return conversations
     
-    try:
-        if isinstance(result_data, dict):
-            # 广播模式：遍历每个窗口的结果
-            for window_idx_str, window_result in result_data.items():
+    # 遍历每个窗口的结果
+    for window_idx_str, window_result in result_data.items():
+        try:
+            window_idx = int(window_idx_str)
+            total_windows += 1
+            
+            logger.debug(f"  🔍 Window [{window_idx}]: {window_result}")
+            
+            # 检查是否是错误
+            if isinstance(window_result, dict) and 'error' in window_result:
+                logger.debug(f"    ❌ 错误: {window_result['error']}")
+                continue
+            
+            # 尝试解析窗口结果
+            if isinstance(window_result, str):
                 try:
-                    window_idx = int(window_idx_str)
-                    total_windows += 1
-                    
-                    logger.debug(f"  🔍 Window [{window_idx}]: {window_result}")
-                    
-                    # 检查是否是错误
-                    if isinstance(window_result, dict) and 'error' in window_result:
-                        logger.debug(f"    ❌ 错误: {window_result['error']}")
-                        continue
-                    
-                    # 尝试解析窗口结果
-                    if isinstance(window_result, str):
-                        try:
-                            parsed = json.loads(window_result)
-                        except json.JSONDecodeError:
-                            logger.warning(f"    ⚠️  无法解析 JSON: {window_result}")
-                            continue
-                    else:
-                        parsed = window_result
-                    
-                    # 提取 conversation_id 和 title
-                    if isinstance(parsed, dict):
-                        conv_id = parsed.get('conversationId')
-                        title = parsed.get('title', 'Untitled Conversation')
-                        if conv_id:
-                            conversations.append({
-                                'conversation_id': conv_id,
-                                'title': title,
-                                'window_index': window_idx
-                            })
-                            logger.info(f"    ✅ 找到对话: {title} ({conv_id[:8]}...)")
-                        else:
-                            logger.debug(f"    ⚠️  未找到 conversation_id (found={parsed.get('found')})")
-                    
-                except ValueError:
-                    # 不是数字索引，跳过
-                    continue
-                except Exception as e:
-                    logger.warning(f"    ⚠️  解析窗口 {window_idx_str} 失败: {e}")
+                    parsed = json.loads(window_result)
+                except json.JSONDecodeError:
+                    logger.warning(f"    ⚠️  无法解析 JSON: {window_result}")
                     continue
-        
-        logger.info(f"✅ [Discovery] 找到 {len(conversations)} 个对话（共 {total_windows} 个窗口）")
-        
-        # 为每个 conversation_id 发送一个结果消息
-        requester = registry.get_by_id(requester_id)
-        if requester:
-            if conversations:
-                for conv in conversations:
-                    conv_id = conv.get('conversation_id')
-                    title = conv.get('title', 'Untitled Conversation')
-                    window_index = conv.get('window_index')
-                    
-                    result_msg = MessageBuilder.get_conversation_id_result(
-                        from_id="server",
-                        to_id=requester_id,
-                        request_id=original_request_id,
-                        success=True,
-                        conversation_id=conv_id,
-                        title=title,
-                        window_index=window_index
-                    )
-                    await requester.websocket.send(result_msg.to_json())
-                    logger.info(f"📤 [Discovery] 发送结果: {title} → {requester_id}")
             else:
-                # 没有找到对话，发送空结果
-                empty_msg = MessageBuilder.get_conversation_id_result(
-                    from_id="server",
-                    to_id=requester_id,
-                    request_id=original_request_id,
-                    success=True,
-                    conversation_id=None,
-                    title=None
-                )
-                await requester.websocket.send(empty_msg.to_json())
-                logger.info(f"📤 [Discovery] 发送空结果（无对话）→ {requester_id}")
-        
-    except Exception as e:
-        logger.error(f"❌ [Discovery] 解析结果失败: {e}")
-        import traceback
-        traceback.print_exc()
+                parsed = window_result
+            
+            # 提取 conversation_id 和 title
+            if isinstance(parsed, dict):
+                conv_id = parsed.get('conversationId')
+                title = parsed.get('title', 'Untitled Conversation')
+                if conv_id:
+                    conversations.append({
+                        'conversation_id': conv_id,
+                        'title': title,
+                        'window_index': window_idx,
+                        'inject_id': message.from_
+                    })
+                    conversation_windows.update(conv_id, message.from_, window_idx)
+                    logger.info(f"    ✅ 找到对话: {title} ({conv_id[:8]}...)")
+                else:
+                    logger.debug(f"    ⚠️  未找到 conversation_id (found={parsed.get('found')})")
+            
+        except ValueError:
+            # 不是数字索引，跳过
+            continue
+        except Exception as e:
+            logger.warning(f"    ⚠️  解析窗口 {window_idx_str} 失败: {e}")
+            continue
     
-    return True
+    logger.info(f"✅ [Discovery] {message.from_}: 找到 {len(conversations)} 个对话（共 {total_windows} 个窗口）")
+    return conversations
 
 
-async def handle_cursor_input_text(client_info: ClientInfo, message: Message):
-    """处理从 AITuber 发来的 cursor_input_text 消息
+def _send_discovery_results(requester: ClientInfo, request_id: str, conversations: list):
+    """为每个 conversation_id 发送一个结果消息；没有对话时发送一条空结果"""
+    if not conversations:
+        requester.send_message(MessageBuilder.get_conversation_id_result(
+            from_id="server",
+            to_id=requester.client_id,
+            request_id=request_id,
+            success=True,
+            conversation_id=None,
+            title=None
+        ))
+        logger.info(f"📤 [Discovery] 发送空结果（无对话）→ {requester.client_id}")
+        return
+    
+    for conv in conversations:
+        requester.send_message(MessageBuilder.get_conversation_id_result(
+            from_id="server",
+            to_id=requester.client_id,
+            request_id=request_id,
+            success=True,
+            conversation_id=conv['conversation_id'],
+            title=conv.get('title', 'Untitled Conversation'),
+            inject_id=conv.get('inject_id'),
+            window_index=conv.get('window_index')
+        ))
+    logger.info(f"📤 [Discovery] 发送 {len(conversations)} 条结果 → {requester.client_id}")
+
+
+async def handle_cursor_input_text(client_info: ClientInfo, message: Message) -> dict:
+    """处理从 AITuber 发来的 cursor_input_text 消息（单次尝试）
     
     V11.2 设计：
     - 广播模式：JS 代码发送到所有窗口
     - JS 代码内包含 conversation_id 检查
     - 只有 conversation_id 匹配的窗口会真正执行输入
     - 不匹配的窗口返回 {skipped: true}
+    
+    等待 inject 返回真实的 execute_js_result 后再回复请求者。
+    session worker 直接调用 _dispatch_cursor_input（带重试），这里保留给单次调用。
     """
     from_id = message.from_
-    text = message.payload.get('text', '')
-    conversation_id = message.payload.get('conversation_id')
-    execute = message.payload.get('execute', False)
+    outcome = await _dispatch_cursor_input(
+        text=message.payload.get('text', ''),
+        conversation_id=message.payload.get('conversation_id'),
+        execute=message.payload.get('execute', False),
+        requester_id=from_id,
+    )
+    _send_cursor_input_result(client_info, outcome)
+    return outcome
+
+
+def _send_cursor_input_result(client_info: ClientInfo, outcome: dict):
+    """把 _dispatch_cursor_input 的结果回复给请求者"""
+    client_info.send_message(MessageBuilder.cursor_input_text_result(
+        from_id="server",
+        to_id=client_info.client_id,
+        success=outcome["success"],
+        message=outcome.get("message"),
+        error=outcome.get("error"),
+        latency_ms=outcome.get("latency_ms")
+    ))
+
+
+def _summarize_input_result(message: Message, window_index: Optional[int] = None) -> dict:
+    """
+    解读输入脚本的 execute_js_result，并顺带刷新 conversation → 窗口缓存
+    
+    - 广播模式：result = {窗口索引: JSON 字符串 或 {error}}
+    - 单窗口：result = JSON 字符串（或已解析的对象），window_index 为发送时指定的窗口
+    
+    Returns:
+        {"success", "message" / "error", "retryable", "stale"}
+        stale=True 表示单播的窗口已不是目标对话（映射过期）
+    """
+    payload = message.payload or {}
+    if not payload.get('success'):
+        # 单播时 inject 层面的失败（如窗口索引越界）同样说明映射已过期
+        return {"success": False, "error": payload.get('error') or "inject 执行失败", "retryable": True,
+                "stale": window_index is not None}
+    
+    result = payload.get('result')
+    if isinstance(result, dict) and result and all(str(k).isdigit() for k in result):
+        window_results = [(int(k), v) for k, v in result.items()]
+    else:
+        window_results = [(window_index, result)]
+    
+    applied, applied_index = None, None
+    errors = []
+    for index, window_result in window_results:
+        if isinstance(window_result, str):
+            try:
+                window_result = json.loads(window_result)
+            except json.JSONDecodeError:
+                errors.append(f"无法解析窗口结果: {window_result[:80]}")
+                continue
+        if not isinstance(window_result, dict):
+            continue
+        if window_result.get('skipped'):
+            # 跳过的窗口会报告自己当前的 conversation_id
+            conversation_windows.update(window_result.get('current'), message.from_, index)
+            continue
+        if window_result.get('success'):
+            if applied is None:
+                applied, applied_index = window_result, index
+        else:
+            errors.append(window_result.get('error') or "输入失败")
+    
+    if applied is not None:
+        return {"success": True, "message": applied.get('message') or "文本已输入到 Cursor", "retryable": False,
+                "window_index": applied_index}
+    if errors:
+        return {"success": False, "error": errors[0], "retryable": True}
+    # 所有窗口都跳过：目标对话不在任何窗口中，重试也不会成功
+    return {"success": False, "error": "没有窗口匹配目标 conversation_id", "retryable": False,
+            "stale": window_index is not None, "unmatched": True}
+
+
+async def _dispatch_cursor_input(text: str, conversation_id: Optional[str], execute: bool, requester_id: str) -> dict:
+    """
+    向 inject 发送输入脚本并等待真实结果
     
+    Returns:
+        {"success", "message" / "error", "retryable", "latency_ms"}
+    """
     action_text = "输入并执行" if execute else "输入"
     logger.info(f"📝 [Cursor Input] 收到{action_text}请求: {text[:50]}... (conv: {conversation_id})")
     
+    # 输入脚本见 js_templates.CURSOR_INPUT_TEXT（脚本内含 conversation_id 检查，广播时不匹配的窗口跳过）
+    args = {"text": text, "conversation_id": conversation_id, "execute": bool(execute)}
+    started = time.perf_counter()
+    
+    # 已知对话所在窗口：只发给该窗口
+    cached = conversation_windows.lookup(conversation_id)
+    if cached is not None:
+        inject_id, window_index = cached
+        outcome = await _execute_input_js(registry.get_by_id(inject_id), args, window_index, requester_id)
+        if not outcome.get("stale"):
+            return _finish_cursor_input(outcome, started, conversation_id)
+        conversation_windows.invalidate(conversation_id)
+        logger.info(f"♻️  [Cursor Input] 窗口映射已过期（{inject_id}[{window_index}]），回退到广播")
+    
     # 获取所有 cursor_inject 客户端
     inject_clients = registry.get_by_type('cursor_inject')
     
     if not inject_clients:
         logger.warning(f"⚠️  没有可用的 Cursor inject 客户端")
-        error_msg = MessageBuilder.cursor_input_text_result(
-            from_id="server",
-            to_id=from_id,
-            success=False,
-            error="没有可用的 Cursor inject 客户端"
-        )
-        await client_info.websocket.send(error_msg.to_json())
-        return
+        return {"success": False, "error": "没有可用的 Cursor inject 客户端", "retryable": False}
+    
+    # 广播模式，JS 代码内含 conversation_id 检查：
+    # - 对话目录中已知所在 inject：只发给它（目录过期、没有匹配的窗口时再发给其余 inject）
+    # - 未知：同时发给所有 inject，只有对话所在的窗口会执行
+    # - 没有目标对话：脚本会输入到所有窗口，只发给第一个 inject
+    if not conversation_id:
+        targets, fallback = inject_clients[:1], []
+    else:
+        owner = registry.get_by_id(conversation_directory.owner(conversation_id) or "")
+        if owner is not None and owner.has_role('cursor_inject'):
+            targets, fallback = [owner], [c for c in inject_clients if c is not owner]
+        else:
+            targets, fallback = inject_clients, []
     
-    # 使用第一个可用的 inject（一般情况下只有一个）
-    target_inject = inject_clients[0]
-    window_index = None  # 广播模式（JS 代码内含 conversation_id 检查）
+    outcome = await _execute_input_on_injects(targets, args, requester_id)
+    if outcome.get("unmatched") and fallback:
+        logger.info(f"♻️  [Cursor Input] {targets[0].client_id} 中没有对话 {conversation_id}，发给其余 {len(fallback)} 个 inject")
+        outcome = await _execute_input_on_injects(fallback, args, requester_id)
+    return _finish_cursor_input(outcome, started, conversation_id)
+
+
+async def _execute_input_on_injects(injects: list, args: dict, requester_id: str) -> dict:
+    """
+    把输入脚本（广播模式）同时发给多个 inject，返回第一个成功的结果
     
-    if target_inject:
-        try:
-            # 生成 JavaScript 代码来输入文本
-            # 使用模拟键盘输入的方式，适用于 Lexical 等复杂编辑器
-            # 🔑 广播模式：JS 代码内包含 conversation_id 检查，不匹配则跳过执行
-            import json
-            target_conv_id = json.dumps(conversation_id) if conversation_id else 'null'
-            js_code = f"""
-            (async function() {{
-                try {{
-                    // 🔑 首先检查 conversation_id 是否匹配（广播模式下的过滤）
-                    const targetConversationId = {target_conv_id};
-                    
-                    if (targetConversationId) {{
-                        // 提取当前窗口的 conversation_id
-                        const convEl = document.querySelector('[id^="composer-bottom-add-context-"]');
-                        let currentConvId = null;
-                        if (convEl) {{
-                            const match = convEl.id.match(/composer-bottom-add-context-([a-f0-9-]+)/);
-                            currentConvId = match ? match[1] : null;
-                        }}
-                        
-                        // 如果不匹配，跳过执行
-                        if (currentConvId !== targetConversationId) {{
-                            return JSON.stringify({{
-                                success: true,
-                                skipped: true,
-                                reason: 'conversation_id 不匹配',
-                                target: targetConversationId,
-                                current: currentConvId
-                            }});
-                        }}
-                    }}
-                    
-                    // 查找 Composer 输入框
-                    const inputSelector = 'div[contenteditable="true"][role="textbox"],' +
-                                         'div[contenteditable="true"][aria-label*="composer"],' +
-                                         'textarea[placeholder*="Ask"]';
-                    
-                    const inputElement = document.querySelector(inputSelector);
-                    
-                    if (!inputElement) {{
-                        return JSON.stringify({{
-                            success: false,
-                            error: '找不到 Cursor 输入框'
-                        }});
-                    }}
-                    
-                    // 聚焦输入框
-                    inputElement.focus();
-                    
-                    // 清空现有内容（如果有）
-                    if (inputElement.tagName === 'TEXTAREA' || inputElement.tagName === 'INPUT') {{
-                        inputElement.value = '';
-                    }} else {{
-                        // 对于 contenteditable，选中所有内容并删除
-                        const range = document.createRange();
-                        range.selectNodeContents(inputElement);
-                        const selection = window.getSelection();
-                        selection.removeAllRanges();
-                        selection.addRange(range);
-                        document.execCommand('delete', false);
-                    }}
-                    
-                    // 模拟键盘输入
-                    const textToInput = {json.dumps(text)};
-                    
-                    // 使用 document.execCommand insertText（对 Lexical 等编辑器有效）
-                    document.execCommand('insertText', false, textToInput);
-                    
-                    // 备用方法：逐字符模拟输入事件
-                    if (!inputElement.textContent && !inputElement.value) {{
-                        for (let char of textToInput) {{
-                            const keyboardEvent = new KeyboardEvent('keypress', {{
-                                key: char,
-                                code: 'Key' + char.toUpperCase(),
-                                charCode: char.charCodeAt(0),
-                                keyCode: char.charCodeAt(0),
-                                bubbles: true,
-                                cancelable: true
-                            }});
-                            inputElement.dispatchEvent(keyboardEvent);
-                            
-                            const inputEvent = new InputEvent('input', {{
-                                data: char,
-                                inputType: 'insertText',
-                                bubbles: true,
-                                cancelable: false
-                            }});
-                            inputElement.dispatchEvent(inputEvent);
-                        }}
-                    }}
-                    
-                    // 验证内容是否输入成功
-                    let currentContent = '';
-                    if (inputElement.tagName === 'TEXTAREA' || inputElement.tagName === 'INPUT') {{
-                        currentContent = inputElement.value;
-                    }} else {{
-                        currentContent = inputElement.textContent || inputElement.innerText || '';
-                    }}
-                    
-                    const shouldExecute = {json.dumps(execute)};
-                    
-                    // 如果需要执行，模拟按 Enter 键
-                    if (shouldExecute) {{
-                        // 等待一小段时间确保输入已处理
-                        await new Promise(resolve => setTimeout(resolve, 100));
-                        
-                        // 模拟按下 Enter 键
-                        const enterEvent = new KeyboardEvent('keydown', {{
-                            key: 'Enter',
-                            code: 'Enter',
-                            keyCode: 13,
-                            which: 13,
-                            bubbles: true,
-                            cancelable: true
-                        }});
-                        inputElement.dispatchEvent(enterEvent);
-                        
-                        const enterUpEvent = new KeyboardEvent('keyup', {{
-                            key: 'Enter',
-                            code: 'Enter',
-                            keyCode: 13,
-                            which: 13,
-                            bubbles: true,
-                            cancelable: true
-                        }});
-                        inputElement.dispatchEvent(enterUpEvent);
-                        
-                        // 也尝试查找并点击发送按钮（备用方案）
-                        const sendButton = document.querySelector('button[aria-label*="Send"]') ||
-                                          document.querySelector('button[title*="Send"]') ||
-                                          document.querySelector('button[type="submit"]');
-                        if (sendButton) {{
-                            sendButton.click();
-                        }}
-                    }}
-                    
-                    return JSON.stringify({{
-                        success: currentContent.includes(textToInput) || currentContent.length > 0,
-                        message: shouldExecute ? '文本已输入并执行' : '文本已输入到 Cursor',
-                        executed: shouldExecute,
-                        inputLength: textToInput.length,
-                        currentLength: currentContent.length,
-                        preview: currentContent.substring(0, 50)
-                    }});
-                }} catch (error) {{
-                    return JSON.stringify({{
-                        success: false,
-                        error: error.message
-                    }});
-                }}
-            }})()
-            """
-            
-            # 发送 execute_js 消息给 inject（广播模式，JS 代码内含 conversation_id 检查）
-            execute_msg = MessageBuilder.execute_js(
-                from_id="server",
-                to_id=target_inject.client_id,
-                code=js_code,
-                request_id=f"input_text_{from_id}_{int(time.time())}",
-                window_index=window_index
-            )
-            
-            await target_inject.websocket.send(execute_msg.to_json())
-            logger.info(f"📤 [Cursor Input] JS 代码已发送(广播): server → {target_inject.client_id} (目标 conv_id={conversation_id}, JS 内含过滤逻辑)")
-            
-            # 注意：这里不等待结果，直接返回成功（异步模式）
-            # 如果需要等待结果，需要实现一个回调机制
-            success_msg = MessageBuilder.cursor_input_text_result(
-                from_id="server",
-                to_id=from_id,
-                success=True,
-                message="输入请求已发送"
-            )
-            await client_info.websocket.send(success_msg.to_json())
-            
-        except Exception as e:
-            logger.error(f"❌ [Cursor Input] 处理失败: {e}")
-            # 发送失败响应
-            error_msg = MessageBuilder.cursor_input_text_result(
-                from_id="server",
-                to_id=from_id,
-                success=False,
-                error=str(e)
-            )
-            await client_info.websocket.send(error_msg.to_json())
+    都没有成功时优先返回可重试的失败（某个 inject 超时 / 出错），否则返回「没有匹配的窗口」
+    """
+    if len(injects) == 1:
+        return await _execute_input_js(injects[0], args, None, requester_id)
+    outcomes = []
+    for next_outcome in asyncio.as_completed(
+        [_execute_input_js(inject, args, None, requester_id) for inject in injects]
+    ):
+        outcome = await next_outcome
+        if outcome["success"]:
+            # 其余 inject 中没有该对话（会返回 skipped），不必等待
+            return outcome
+        outcomes.append(outcome)
+    return next((o for o in outcomes if o.get("retryable")), outcomes[0])
+
+
+async def _execute_input_js(target_inject: ClientInfo, args: dict, window_index: Optional[int], requester_id: str) -> dict:
+    """发送输入脚本（window_index=None 为广播）并等待 inject 的结果"""
+    request_id = pending_requests.new_request_id(f"input_text_{requester_id}")
+    execute_msg = build_template_execute(target_inject, CURSOR_INPUT_TEXT, args, request_id, window_index)
+    
+    pending_requests.register(request_id, target_inject.client_id, requester_id=requester_id)
+    if not target_inject.send_message(execute_msg):
+        pending_requests.discard(request_id)
+        return {"success": False, "error": "Cursor inject 出站队列不可用", "retryable": True}
+    if window_index is None:
+        logger.info(f"📤 [Cursor Input] JS 代码已发送(广播): server → {target_inject.client_id}")
     else:
-        logger.warning(f"⚠️  找不到目标 inject")
-        error_msg = MessageBuilder.cursor_input_text_result(
-            from_id="server",
-            to_id=from_id,
-            success=False,
-            error="找不到目标 Cursor inject"
-        )
-        await client_info.websocket.send(error_msg.to_json())
+        logger.info(f"📤 [Cursor Input] JS 代码已发送(单播): server → {target_inject.client_id}[{window_index}]")
+    
+    # 等待 inject 返回真实结果
+    try:
+        result_msg, elapsed = await pending_requests.wait(request_id, EXECUTE_JS_TIMEOUT)
+    except PendingRequestError as e:
+        logger.warning(f"⚠️  [Cursor Input] {e}")
+        return {"success": False, "error": str(e), "retryable": True}
+    record_inject_latency(target_inject, "input", elapsed)
+    
+    outcome = _summarize_input_result(result_msg, window_index)
+    if outcome["success"]:
+        outcome["inject_id"] = target_inject.client_id
+    return outcome
+
+
+def _finish_cursor_input(outcome: dict, started: float, conversation_id: Optional[str]) -> dict:
+    """记录端到端耗时，并把命中的窗口写回缓存"""
+    outcome["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    if outcome["success"]:
+        conversation_windows.update(conversation_id, outcome["inject_id"], outcome.get("window_index"))
+        logger.info(f"✅ [Cursor Input] {outcome['message']} ({outcome['latency_ms']}ms)")
+    else:
+        logger.warning(f"⚠️  [Cursor Input] 失败: {outcome['error']} ({outcome['latency_ms']}ms)")
+    return outcome
 
 
 def _resolve_session_id(from_client: ClientInfo, payload: dict) -> str:
@@ -1091,14 +2383,66 @@ async def _broadcast_session_event(session_id: str, seq: int, event_name: str, e
         event_payload=event_payload,
         source_client_id=source_client_id
     )
-    msg_json = msg.to_json()
+
+    # 先写日志（批量异步提交），重连的客户端可以通过 session_resume 补齐
+    if session_log is not None:
+        session_log.append(session_id, seq, event_name, event_payload, source_client_id)
 
     # 仅发给 session 成员
     targets = [registry.get_by_id(cid) for cid in s.members]
     targets = [t for t in targets if t is not None]
     if not targets:
         return
-    await asyncio.gather(*[t.websocket.send(msg_json) for t in targets], return_exceptions=True)
+    fanout_message(targets, msg)
+
+
+async def handle_session_resume(client_info: ClientInfo, message: Message):
+    """
+    处理 SESSION_RESUME：先加入 session（之后的事件实时推送），再一次性返回 seq > last_seq 的事件
+    
+    实时事件可能与补齐结果重叠，客户端按 (seq, event_name) 去重
+    """
+    payload = message.payload or {}
+    session_id = _resolve_session_id(client_info, payload)
+    try:
+        last_seq = max(0, int(payload.get('last_seq') or 0))
+        # limit <= 0 会变成 SQLite 的 LIMIT -N（不限条数），必须夹在 [1, 上限] 之间
+        limit = max(1, min(int(payload.get('limit') or SESSION_RESUME_MAX_EVENTS), SESSION_RESUME_MAX_EVENTS))
+    except (TypeError, ValueError):
+        error = f"last_seq / limit 必须是整数: last_seq={payload.get('last_seq')!r}, limit={payload.get('limit')!r}"
+        logger.warning(f"⚠️  [SessionResume] {client_info.client_id}: {error}")
+        client_info.send_message(MessageBuilder.session_resume_result(
+            to_id=client_info.client_id,
+            session_id=session_id,
+            events=[],
+            head_seq=0,
+            durable=session_log is not None,
+            request_id=payload.get('request_id'),
+            error=error
+        ))
+        return
+    
+    session_manager.join(session_id, client_info.client_id)
+    s = session_manager.get_or_create(session_id)
+    
+    events = []
+    has_more = False
+    if session_log is not None and last_seq < s.seq:
+        events = await session_log.read_since(session_id, last_seq, limit + 1)
+        has_more = len(events) > limit
+        events = events[:limit]
+    
+    result = MessageBuilder.session_resume_result(
+        to_id=client_info.client_id,
+        session_id=session_id,
+        events=events,
+        head_seq=s.seq,
+        has_more=has_more,
+        durable=session_log is not None,
+        request_id=payload.get('request_id')
+    )
+    client_info.send_message(result)
+    logger.info(f"⏪ [SessionResume] {client_info.client_id}: session={session_id}, last_seq={last_seq} → {len(events)} 条事件 (head={s.seq})")
 
 
 async def handle_input_submit(client_info: ClientInfo, message: Message):
@@ -1113,7 +2457,7 @@ async def handle_input_submit(client_info: ClientInfo, message: Message):
 
     # 幂等去重
     if client_event_id in s.dedupe:
-        seq = s.event_id_to_seq.get(client_event_id, s.seq)
+        seq = s.dedupe.get(client_event_id, s.seq)
         ack = MessageBuilder.input_ack(
             from_id="server",
             to_id=client_info.client_id,
@@ -1122,13 +2466,15 @@ async def handle_input_submit(client_info: ClientInfo, message: Message):
             seq=seq,
             duplicate=True
         )
-        await client_info.websocket.send(ack.to_json())
+        client_info.send_message(ack)
+        return
+
+    if not admit_session(client_info, message, s):
         return
 
     # 分配 seq（权威顺序）
     seq = s.next_seq()
-    s.dedupe.add(client_event_id)
-    s.event_id_to_seq[client_event_id] = seq
+    s.remember_event(client_event_id, seq)
 
     # 先 ack（尽快反馈已接收）
     ack = MessageBuilder.input_ack(
@@ -1139,7 +2485,7 @@ async def handle_input_submit(client_info: ClientInfo, message: Message):
         seq=seq,
         duplicate=False
     )
-    await client_info.websocket.send(ack.to_json())
+    client_info.send_message(ack)
 
     # 广播“输入已进入会话事件流”
     await _broadcast_session_event(
@@ -1155,23 +2501,26 @@ async def handle_input_submit(client_info: ClientInfo, message: Message):
         source_client_id=client_info.client_id
     )
 
-    # 入队：后续串行驱动下游（Cursor inject）
-    await s.queue.put({
+    # 入队：后续串行驱动下游（Cursor inject），按优先级分道
+    s.queue.put_nowait({
         "kind": "cursor_input_text",
         "seq": seq,
+        "client_event_id": client_event_id,
         "from_client_id": client_info.client_id,
         "payload": payload
-    })
+    }, _input_lane(client_info, payload))
 
-    # 确保 worker 启动
-    if not s.worker_task or s.worker_task.done():
+    # 确保 worker 启动（队列排空后 worker 会退出）
+    if not s.worker_running:
         s.worker_task = asyncio.create_task(_session_worker(s))
+        session_manager.stats["workers_started"] += 1
 
 
 async def handle_client_event_submit(client_info: ClientInfo, message: Message):
     """处理 CLIENT_EVENT_SUBMIT：通用扩展事件入口（只入会话事件流并广播，不触达 inject）"""
     payload = message.payload or {}
-    session_id = payload.get('session_id') or 'default'
+    # 与多进程模式选择 home worker 时的解析一致，保证同一 session 只在一个 worker 上分配 seq
+    session_id = _resolve_session_id(client_info, payload)
     client_event_id = payload.get('client_event_id') or f"evt_{message.from_}_{int(time.time()*1000)}"
     event_name = payload.get('event_name') or 'unknown'
     event_payload = payload.get('event_payload') or {}
@@ -1181,9 +2530,11 @@ async def handle_client_event_submit(client_info: ClientInfo, message: Message):
 
     if client_event_id in s.dedupe:
         return
+    if not admit_session(client_info, message, s):
+        return
 
     seq = s.next_seq()
-    s.dedupe.add(client_event_id)
+    s.remember_event(client_event_id)
 
     await _broadcast_session_event(
         session_id=session_id,
@@ -1220,59 +2571,143 @@ async def handle_cursor_input_text_enqueued(client_info: ClientInfo, message: Me
     await handle_input_submit(client_info, submit_msg)
 
 
-async def _session_worker(s: SessionState):
-    """串行消费 session 队列，驱动下游（inject 白名单指令）"""
-    logger.info(f"🧵 [SessionWorker] started: session={s.session_id}")
+# ----------------------------------------------------------------------------
+# 输入合并（可选）：同一对话连续的纯输入（execute=False）在时间窗口内合并为一次注入
+#   ORTENSIA_INPUT_COALESCE_MS    合并窗口（毫秒，默认 0 = 关闭）
+#   ORTENSIA_INPUT_COALESCE_MODE  replace（默认）：只输入最后一条文本，
+#                                 与逐条执行的最终结果相同（输入脚本每次都会先清空输入框）
+#                                 append：按顺序拼接所有片段（适用于流式发送增量片段的客户端）
+# 每条原始输入仍各自有 seq / client_event_id、dispatching / dispatched 事件和结果回执
+# ----------------------------------------------------------------------------
+INPUT_COALESCE_WINDOW = max(0.0, float(os.environ.get("ORTENSIA_INPUT_COALESCE_MS", "0")) / 1000)
+INPUT_COALESCE_MODE = os.environ.get("ORTENSIA_INPUT_COALESCE_MODE", "replace").strip().lower()
+
+
+def _can_coalesce(item: dict) -> bool:
+    return (
+        INPUT_COALESCE_WINDOW > 0
+        and item.get("kind") == "cursor_input_text"
+        and not (item.get("payload") or {}).get("execute", False)
+    )
+
+
+async def _collect_input_batch(s: SessionState, batch: list) -> Optional[dict]:
+    """
+    在合并窗口内继续从队列取可合并的输入追加到 batch
+    
+    Returns:
+        取出但不能合并的下一条（由 worker 下一轮处理），没有则为 None
+    """
+    conversation_id = (batch[0].get("payload") or {}).get("conversation_id")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + INPUT_COALESCE_WINDOW
     while True:
-        item = await s.queue.get()
-        try:
-            kind = item.get("kind")
-            seq = item.get("seq")
-            payload = item.get("payload") or {}
-            from_client_id = item.get("from_client_id")
-
-            if kind == "cursor_input_text":
-                # 复用现有逻辑：构造一个临时 ClientInfo 以便复用响应路径
-                sender = registry.get_by_id(from_client_id)
-                if not sender:
-                    continue
+        if s.queue.empty():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                item = await asyncio.wait_for(s.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+        else:
+            item = s.queue.get_nowait()
+        if _can_coalesce(item) and (item.get("payload") or {}).get("conversation_id") == conversation_id:
+            batch.append(item)
+        else:
+            return item
 
-                # 广播：开始下游派发
-                await _broadcast_session_event(
-                    session_id=s.session_id,
-                    seq=seq,
-                    event_name="cursor_input_dispatching",
-                    event_payload={
-                        "conversation_id": payload.get("conversation_id"),
-                        "execute": payload.get("execute", False)
-                    },
-                    source_client_id=from_client_id
-                )
-
-                # 直接调用原来的执行函数（它会给 sender 回 cursor_input_text_result）
-                msg = Message(
-                    type=MessageType.CURSOR_INPUT_TEXT,
-                    from_=from_client_id,
-                    to="server",
-                    timestamp=int(time.time()),
-                    payload={
-                        "text": payload.get("text", ""),
-                        "conversation_id": payload.get("conversation_id"),
-                        "execute": payload.get("execute", False)
-                    }
-                )
-                await handle_cursor_input_text(sender, msg)
-
-                await _broadcast_session_event(
-                    session_id=s.session_id,
-                    seq=seq,
-                    event_name="cursor_input_dispatched",
-                    event_payload={},
-                    source_client_id=from_client_id
-                )
-        finally:
-            s.queue.task_done()
 
+async def _drive_cursor_input(s: SessionState, batch: list):
+    """把一批（通常只有一条）输入注入 Cursor，并为每条原始输入回执和广播事件"""
+    # 发送者已断开：不再驱动下游
+    batch = [item for item in batch if registry.get_by_id(item.get("from_client_id"))]
+    if not batch:
+        return
+    
+    last = batch[-1]
+    payload = last.get("payload") or {}
+    if len(batch) > 1 and INPUT_COALESCE_MODE == "append":
+        text = "".join((item.get("payload") or {}).get("text", "") for item in batch)
+    else:
+        text = payload.get("text", "")
+    seqs = [item.get("seq") for item in batch]
+    if len(batch) > 1:
+        logger.info(f"🧩 [SessionWorker] 合并 {len(batch)} 条输入 → 1 次注入 (session={s.session_id}, seq={seqs[0]}..{seqs[-1]})")
+    
+    # 广播：开始下游派发
+    for item in batch:
+        await _broadcast_session_event(
+            session_id=s.session_id,
+            seq=item.get("seq"),
+            event_name="cursor_input_dispatching",
+            event_payload={
+                "conversation_id": payload.get("conversation_id"),
+                "execute": payload.get("execute", False),
+                "client_event_id": item.get("client_event_id"),
+                "coalesced_seqs": seqs if len(batch) > 1 else None
+            },
+            source_client_id=item.get("from_client_id")
+        )
+    
+    # 等待 inject 的真实结果；只有纯输入（execute=False）可以安全重试，
+    # 执行类请求只尝试一次，避免重复提交 prompt
+    execute = payload.get("execute", False)
+    max_attempts = 1 if execute else INPUT_MAX_ATTEMPTS
+    attempt = 0
+    while True:
+        attempt += 1
+        outcome = await _dispatch_cursor_input(
+            text=text,
+            conversation_id=payload.get("conversation_id"),
+            execute=execute,
+            requester_id=last.get("from_client_id"),
+        )
+        if outcome["success"] or not outcome.get("retryable") or attempt >= max_attempts:
+            break
+        logger.info(f"🔁 [SessionWorker] 第 {attempt} 次输入失败，重试: {outcome.get('error')}")
+        await asyncio.sleep(INPUT_RETRY_BACKOFF * attempt)
+    
+    for item in batch:
+        # sender 可能在等待期间断开
+        sender = registry.get_by_id(item.get("from_client_id"))
+        if sender:
+            _send_cursor_input_result(sender, outcome)
+        
+        await _broadcast_session_event(
+            session_id=s.session_id,
+            seq=item.get("seq"),
+            event_name="cursor_input_dispatched",
+            event_payload={
+                "success": outcome["success"],
+                "error": outcome.get("error"),
+                "latency_ms": outcome.get("latency_ms"),
+                "attempts": attempt,
+                "client_event_id": item.get("client_event_id"),
+                "coalesced_seqs": seqs if len(batch) > 1 else None
+            },
+            source_client_id=item.get("from_client_id")
+        )
+
+
+async def _session_worker(s: SessionState):
+    """串行消费 session 队列，驱动下游（inject 白名单指令）；队列排空后退出"""
+    logger.debug(f"🧵 [SessionWorker] started: session={s.session_id}")
+    carry = None  # 合并时多取出的一条
+    while carry is not None or not s.queue.empty():
+        item = carry if carry is not None else s.queue.get_nowait()
+        carry = None
+        batch = [item]
+        try:
+            if item.get("kind") == "cursor_input_text":
+                if _can_coalesce(item):
+                    carry = await _collect_input_batch(s, batch)
+                await _drive_cursor_input(s, batch)
+        except Exception as e:
+            logger.error(f"❌ [SessionWorker] 处理失败: session={s.session_id}, {e}")
+        finally:
+            s.touch()
+    logger.debug(f"🧵 [SessionWorker] stopped (queue drained): session={s.session_id}")
 
 
 async def route_message(message: Message):
@@ -1289,6 +2724,7 @@ async def route_message(message: Message):
     target_client = registry.get_by_id(target_id)
     
     if not target_client:
+        metric_route_misses.inc(message.type.value)
         logger.warning(f"⚠️  目标客户端不存在: {target_id}")
         logger.debug(f"    当前已注册客户端: {list(registry.clients.keys())}")
         
@@ -1304,14 +2740,15 @@ async def route_message(message: Message):
             
             sender = registry.get_by_id(message.from_)
             if sender:
-                await sender.websocket.send(error_msg.to_json())
+                sender.send_message(error_msg)
         
         return
     
     # 发送消息
     try:
-        msg_json = message.to_json()
-        await target_client.websocket.send(msg_json)
+        if not target_client.send_message(message):
+            logger.warning(f"⚠️  目标客户端出站队列不可用，消息未投递: {target_id}")
+            return
         logger.info(f"📤 [发包] {message.type.value}: {message.from_} → {target_id}")
         logger.debug(f"    payload: {str(message.payload)[:200]}...")
     except Exception as e:
@@ -1335,21 +2772,9 @@ async def broadcast_event(message: Message):
     
     logger.debug(f"    目标客户端: {[c.client_id for c in targets]}")
     
-    message_json = message.to_json()
-    
-    # 发送到所有目标
-    results = await asyncio.gather(
-        *[client.websocket.send(message_json) for client in targets],
-        return_exceptions=True
-    )
-    
-    success_count = sum(1 for r in results if not isinstance(r, Exception))
+    # 只编码一次，放入各目标的出站队列（慢客户端不会阻塞广播）
+    success_count = fanout_message(targets, message)
     logger.info(f"📡 [广播] {message.type.value} → {success_count}/{len(targets)} 客户端")
-    
-    # 记录失败的发送
-    for i, result in enumerate(results):
-        if isinstance(result, Exception):
-            logger.error(f"    ❌ 发送到 {targets[i].client_id} 失败: {result}")
 
 
 async def handle_legacy_message(websocket, data: dict):
@@ -1357,8 +2782,7 @@ async def handle_legacy_message(websocket, data: dict):
     logger.info(f"📨 [旧协议] 收到消息: {data.get('type', 'unknown')}")
     
     # 广播给所有 AITuber 客户端（旧协议）
-    aituber_clients = [c for c in registry.clients.values() 
-                       if c.client_type == 'aituber_legacy']
+    aituber_clients = registry.get_by_type('aituber_legacy')
     
     message_json = json.dumps(data)
     
@@ -1366,15 +2790,209 @@ async def handle_legacy_message(websocket, data: dict):
     targets = [c for c in aituber_clients if c.websocket != websocket]
     
     if targets:
-        results = await asyncio.gather(
-            *[client.websocket.send(message_json) for client in targets],
-            return_exceptions=True
-        )
-        
-        success_count = sum(1 for r in results if not isinstance(r, Exception))
+        success_count = sum(1 for client in targets if client.send_frame(message_json))
         logger.info(f"📤 广播旧协议消息: {success_count}/{len(targets)} 客户端")
 
 
+# ============================================================================
+# 分发表注册
+# ============================================================================
+
+async def _route_only(client_info: ClientInfo, message: Message):
+    """只做转发的消息类型"""
+    await route_message(message)
+
+
+async def _broadcast_hook_event(client_info: ClientInfo, message: Message):
+    """hook 的 agent 状态事件：广播，并用其中的 conversation_id 校验对话目录缓存"""
+    observe_hook_conversation((message.payload or {}).get('conversation_id') or registry._conversation_key(client_info))
+    await broadcast_event(message)
+
+
+async def _reject_external_execute_js(client_info: ClientInfo, message: Message):
+    """🔒 白名单：禁止外部客户端直接请求 execute_js（防止绕过仲裁）"""
+    logger.warning(f"⛔ 拒绝外部 EXECUTE_JS 请求: from={message.from_}")
+
+
+async def _handle_execute_js_result(client_info: ClientInfo, message: Message):
+    """execute_js 结果：server 发出的请求交给待响应表，其余转发给请求者"""
+    if pending_requests.resolve(message):
+        return
+    if message.to == "server" and forward_result_to_owner(message):
+        return
+    if message.to == "server":
+        # 等待方已超时放弃
+        pending_requests.stats["late"] += 1
+        logger.debug(f"⌛ 丢弃迟到的 execute_js_result: {message.payload.get('request_id')}")
+        return
+    await route_message(message)
+
+
+for _msg_type, _handler in (
+    (MessageType.REGISTER, handle_register),
+    (MessageType.HEARTBEAT, handle_heartbeat),
+    (MessageType.DISCONNECT, handle_disconnect),
+    
+    (MessageType.COMPOSER_SEND_PROMPT, handle_composer_send_prompt),
+    (MessageType.COMPOSER_QUERY_STATUS, handle_composer_query_status),
+    (MessageType.COMPOSER_SEND_PROMPT_RESULT, _route_only),
+    (MessageType.COMPOSER_STATUS_RESULT, _route_only),
+    
+    # 语义操作（V9 新增）
+    (MessageType.AGENT_EXECUTE_PROMPT, handle_agent_execute_prompt),
+    (MessageType.AGENT_EXECUTE_PROMPT_RESULT, _route_only),
+    (MessageType.AGENT_STOP_EXECUTION, handle_agent_stop_execution),
+    (MessageType.AGENT_STOP_EXECUTION_RESULT, _route_only),
+    (MessageType.AGENT_STATUS_CHANGED, _broadcast_hook_event),
+    (MessageType.AGENT_COMPLETED, _broadcast_hook_event),
+    (MessageType.AGENT_ERROR, _broadcast_hook_event),
+    
+    # AITuber 操作
+    (MessageType.AITUBER_RECEIVE_TEXT, handle_aituber_receive_text),
+    (MessageType.AITUBER_SPEAK, _route_only),
+    (MessageType.AITUBER_EMOTION, _route_only),
+    (MessageType.AITUBER_STATUS, _route_only),
+    
+    # Cursor 输入操作（VNext: 不直接执行，统一进入 session 队列串行化，避免多端并发交错）
+    (MessageType.CURSOR_INPUT_TEXT, handle_cursor_input_text_enqueued),
+    (MessageType.CURSOR_INPUT_TEXT_RESULT, _route_only),  # 结果转发回发送者
+    
+    # VNext: 输入仲裁（文本事件）与通用扩展事件入口（不触达 inject）
+    (MessageType.INPUT_SUBMIT, handle_input_submit),
+    (MessageType.INPUT_ACK, _route_only),
+    (MessageType.CLIENT_EVENT_SUBMIT, handle_client_event_submit),
+    # SESSION_EVENT 只应由 server 产生，这里默认转发以兼容测试工具
+    (MessageType.SESSION_EVENT, _route_only),
+    (MessageType.SESSION_RESUME, handle_session_resume),
+    
+    # 🆕 Conversation ID 查询（V10）
+    (MessageType.GET_CONVERSATION_ID, handle_get_conversation_id),
+    (MessageType.GET_CONVERSATION_ID_RESULT, _route_only),  # 转发给请求者
+    
+    # 通用 JavaScript 执行
+    (MessageType.EXECUTE_JS, _reject_external_execute_js),
+    (MessageType.EXECUTE_JS_RESULT, _handle_execute_js_result),
+    
+    # 运维诊断
+    (MessageType.SERVER_DIAGNOSTICS, handle_server_diagnostics),
+):
+    register_handler(_msg_type, _handler)
+
+
+# ============================================================================
+# 多进程模式（cluster.py）
+# ============================================================================
+#
+# worker 之间共享的只有客户端目录：本 worker 注册的客户端通过 claim / release 通知其他 worker，
+# 其他 worker 上的客户端以 RemoteClientInfo 出现在本地注册表中。
+# session 状态（seq / 输入队列 / 成员）只存在于 session 的 home worker。
+
+CLUSTER_WORKER_ID: Optional[int] = int(os.environ[WORKER_ID_ENV]) if os.environ.get(WORKER_ID_ENV) else None
+
+# 在 session 的 home worker 上处理的消息类型
+SESSION_MESSAGE_TYPES = frozenset({
+    MessageType.INPUT_SUBMIT,
+    MessageType.CLIENT_EVENT_SUBMIT,
+    MessageType.CURSOR_INPUT_TEXT,
+    MessageType.SESSION_RESUME,
+})
+
+# 与 broker 的连接（main() 中按环境变量建立；单进程模式为 None）
+cluster_link: Optional[ClusterLink] = None
+# 每个来源客户端最后一个转发消息的处理任务（同一客户端的消息按到达顺序处理）
+_forward_chains: Dict[str, asyncio.Task] = {}
+
+
+def is_session_home(session_id: str) -> bool:
+    return cluster_link is None or cluster_link.home_worker(session_id) == cluster_link.worker_id
+
+
+def publish_client(client_info: ClientInfo):
+    """注册 / 角色变化后把客户端目录条目通知其他 worker"""
+    if cluster_link is not None:
+        cluster_link.claim(client_info.client_id, client_info.client_types, client_info.metadata)
+
+
+def forward_result_to_owner(message: Message) -> bool:
+    """其他 worker 发起的 execute_js 请求的结果：转回发起方，返回是否已转发"""
+    if cluster_link is None:
+        return False
+    owner = request_owner(message.payload.get('request_id'))
+    if owner is None or owner == cluster_link.worker_id:
+        return False
+    return cluster_link.forward_result(owner, message.encode(TEXT_CODEC))
+
+
+def _apply_remote_claim(worker: int, client_id: str, roles, metadata: dict):
+    client_info = registry.clients.get(client_id)
+    if client_info is not None and not client_info.remote:
+        return  # 同一 ID 也连在本 worker 上：以本地连接为准
+    if client_info is None:
+        client_info = RemoteClientInfo(client_id, worker, roles)
+        registry._add(client_info)
+    else:
+        client_info.worker = worker
+        client_info.set_roles(roles)
+    registry.update_metadata(client_info, metadata)
+    session_id = metadata.get('session_id')
+    if session_id and is_session_home(session_id):
+        session_manager.join(session_id, client_id)
+
+
+def _forget_remote_client(client_id: str):
+    client_info = registry.remove_client(client_id)
+    if client_info is None:
+        return
+    session_manager.leave_all(client_id)
+    pending_requests.fail_target(client_id, f"目标客户端已断开: {client_id}")
+    conversation_windows.drop_inject(client_id)
+    conversation_directory.drop_inject(client_id)
+
+
+async def _handle_forwarded_message(origin_id: str, frame: str, previous: Optional[asyncio.Task]):
+    if previous is not None:
+        await asyncio.wait([previous])
+    sender = registry.get_by_id(origin_id)
+    if sender is None:
+        logger.warning(f"⚠️  [Cluster] 转发消息的来源客户端不存在: {origin_id}")
+        return
+    await handle_new_protocol_message(sender, Message.from_dict(TEXT_CODEC.decode(frame)))
+
+
+async def handle_cluster_message(op: str, source: int, body: dict):
+    """broker 转来的一帧"""
+    if op == OP_DELIVER:
+        to = body["to"]
+        frame, msg_type = body["frame"], body.get("msg_type")
+        for client_id in (to if isinstance(to, list) else (to,)):
+            target = registry.get_by_id(client_id)
+            if target is None or target.remote:
+                logger.warning(f"⚠️  [Cluster] 目标客户端不在本 worker: {client_id}")
+                continue
+            if target.codec.binary:
+                target.send_frame(target.codec.encode(TEXT_CODEC.decode(frame)), msg_type)
+            else:
+                target.send_frame(frame, msg_type)
+    elif op == OP_CLAIM:
+        _apply_remote_claim(source, body["client_id"], body.get("roles") or (), body.get("metadata") or {})
+    elif op == OP_RELEASE:
+        client_info = registry.clients.get(body["client_id"])
+        if client_info is not None and client_info.remote and client_info.worker == source:
+            _forget_remote_client(client_info.client_id)
+    elif op == OP_MESSAGE:
+        # 交给独立任务，慢 handler 不阻塞 broker 连接；同一来源的消息串行处理
+        origin = body["origin"]
+        task = asyncio.create_task(_handle_forwarded_message(origin, body["frame"], _forward_chains.get(origin)))
+        _forward_chains[origin] = task
+        task.add_done_callback(lambda t: _forward_chains.pop(origin, None) if _forward_chains.get(origin) is t else None)
+    elif op == OP_RESULT:
+        message = Message.from_dict(TEXT_CODEC.decode(body["frame"]))
+        if not pending_requests.resolve(message):
+            pending_requests.stats["late"] += 1
+    else:
+        logger.warning(f"⚠️  [Cluster] 未知操作: {op}")
+
+
 # ============================================================================
 # 客户端连接处理
 # ============================================================================
@@ -1391,18 +3009,29 @@ async def handle_client(websocket):
     client_info = ClientInfo(websocket, temp_id, {"unknown"})  # 🆕 使用 set 而不是字符串
     
     # 临时注册
-    registry.clients[temp_id] = client_info
+    registry._add(client_info)
     registry.ws_to_id[websocket] = temp_id
+    heartbeat_scheduler.track(client_info)
     
     is_new_protocol = False  # 标记是否使用新协议
     
     try:
         async for message_str in websocket:
+            client_info.last_heartbeat = time.time()  # 任何入站帧都视为存活
             try:
                 # 🔧 记录原始消息（调试用）
                 logger.debug(f"📥 [原始] 收到消息: {message_str[:300]}...")
                 
-                data = json.loads(message_str)
+                # 快速路径：已注册客户端发来的纯转发消息，只读 type/from/to，原样转发
+                if client_info.client_type != "unknown":
+                    route = peek_route(message_str)
+                    if route is not None and route[0] in relay_fast_path and admit_relay(client_info, route[0]):
+                        started = time.perf_counter()
+                        if relay_raw_frame(route, message_str):
+                            record_handler_time(route[0], time.perf_counter() - started, path="relay")
+                            continue
+                
+                data = decode_frame(message_str)
                 
                 # 检测协议类型
                 if 'type' in data and 'from' in data and 'payload' in data:
@@ -1415,16 +3044,18 @@ async def handle_client(websocket):
                         # 转换为旧协议处理
                         is_new_protocol = False
                         await handle_legacy_message(websocket, data)
-                    else:
+                    elif admit(client_info, message):
                         await handle_new_protocol_message(client_info, message)
                 
                 else:
                     # 旧协议（AITuber Kit）
+                    metric_frames_in.inc("legacy", "legacy")
                     if client_info.client_type == "unknown":
                         # 首次识别为旧协议客户端
-                        client_info.client_type = "aituber_legacy"
-                        client_info.client_id = f"aituber-{id(websocket)}"
+                        client_info.set_roles({"aituber_legacy"})
+                        registry.rename(client_info, f"aituber-{pending_requests.node}{id(websocket)}")
                         logger.info(f"🔄 识别为旧协议客户端: {client_info.client_id}")
+                        publish_client(client_info)
                     
                     await handle_legacy_message(websocket, data)
             
@@ -1444,6 +3075,7 @@ async def handle_client(websocket):
     finally:
         # 清理注册
         registry.unregister(websocket)
+        client_info.close_outbox()
         logger.info(f"👋 客户端断开: {client_addr}")
         logger.info(f"📊 当前连接: {registry.get_stats()}")
 
@@ -1452,35 +3084,195 @@ async def handle_client(websocket):
 # 心跳检测
 # ============================================================================
 
+# ----------------------------------------------------------------------------
+# 按截止时间排序的存活检测：每个客户端在最小堆中有一个 (deadline, seq, client) 条目，
+# 监控协程只在最早的截止时间到达（或有更早的截止时间加入）时醒来，不再定期全量扫描。
+# 收到帧只更新 last_heartbeat，不动堆；条目到期时再按 last_heartbeat 重新排期，
+# 真正超时才断开。关闭连接并发执行且有上限，单个卡住的 close 不会拖住其他连接。
+#
+# 环境变量：
+#   ORTENSIA_HEARTBEAT_TIMEOUT   默认超时（秒，默认 120）
+#   ORTENSIA_HEARTBEAT_TIMEOUTS  按角色覆盖，例如 "agent_hook=30,cursor_inject=300"
+#   ORTENSIA_PING_INTERVAL       websockets 协议层 ping 间隔（秒，默认 20，0 关闭；也用于测量 RTT）
+# ----------------------------------------------------------------------------
+HEARTBEAT_TIMEOUT = float(os.environ.get("ORTENSIA_HEARTBEAT_TIMEOUT", "120"))
+HEARTBEAT_ROLE_TIMEOUTS: Dict[str, float] = {}
+HEARTBEAT_CLOSE_TIMEOUT = 5.0  # 单个 close 握手的等待上限（秒），超时直接断开传输层
+HEARTBEAT_MAX_CONCURRENT_CLOSES = 32
+PING_INTERVAL = float(os.environ.get("ORTENSIA_PING_INTERVAL", "20")) or None
+
+
+def _load_heartbeat_timeouts():
+    raw = os.environ.get("ORTENSIA_HEARTBEAT_TIMEOUTS", "")
+    for item in raw.split(","):
+        if "=" not in item:
+            continue
+        role, value = (part.strip() for part in item.split("=", 1))
+        try:
+            HEARTBEAT_ROLE_TIMEOUTS[role] = float(value)
+        except ValueError:
+            logger.warning(f"⚠️  忽略无效的心跳超时配置: {item}")
+
+
+_load_heartbeat_timeouts()
+
+
+class HeartbeatScheduler:
+    """客户端存活截止时间的最小堆"""
+
+    def __init__(self):
+        self._heap: list = []  # (deadline, seq, client_info)
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None  # run() 启动后才创建
+        self._close_slots: Optional[asyncio.Semaphore] = None
+        self._closing: Set[asyncio.Task] = set()
+        self.stats = {"timeouts": 0, "close_timeouts": 0, "reschedules": 0}
+
+    def track(self, client_info: ClientInfo):
+        """（重新）为客户端排期；旧条目在出堆时按 _hb_deadline 识别并丢弃"""
+        if self._wakeup is None or client_info.remote:
+            return  # 监控未运行（例如基准测试直接驱动 handler），或连接在其他 worker 上
+        deadline = client_info.last_heartbeat + client_info.heartbeat_timeout
+        client_info._hb_deadline = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), client_info))
+        if self._heap[0][2] is client_info:
+            self._wakeup.set()
+
+    def _expire_due(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, client_info = heapq.heappop(self._heap)
+            if client_info._hb_deadline != deadline:
+                continue  # 已重新排期
+            if registry.clients.get(client_info.client_id) is not client_info:
+                continue  # 已断开或已被合并到其他条目
+            actual = client_info.last_heartbeat + client_info.heartbeat_timeout
+            if actual > now:
+                client_info._hb_deadline = actual
+                heapq.heappush(self._heap, (actual, next(self._seq), client_info))
+                self.stats["reschedules"] += 1
+                continue
+            self._expire(client_info, now)
+
+    def _expire(self, client_info: ClientInfo, now: float):
+        self.stats["timeouts"] += 1
+        client_info._hb_deadline = None
+        logger.warning(
+            f"⚠️  客户端超时: {client_info.client_id} "
+            f"({now - client_info.last_heartbeat:.0f}s 无活动，超时 {client_info.heartbeat_timeout:g}s)"
+        )
+        # 先从注册表移除，路由立即不再选中它；关闭握手在后台完成
+        registry.unregister(client_info.websocket)
+        task = asyncio.create_task(self._close(client_info))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close(self, client_info: ClientInfo):
+        async with self._close_slots:
+            try:
+                await asyncio.wait_for(client_info.websocket.close(), HEARTBEAT_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.stats["close_timeouts"] += 1
+                transport = getattr(client_info.websocket, "transport", None)
+                if transport is not None:
+                    transport.abort()
+            except Exception:
+                pass
+
+    def snapshot(self) -> Dict[str, int]:
+        return {**self.stats, "tracked": len(self._heap), "closing": len(self._closing)}
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        self._close_slots = asyncio.Semaphore(HEARTBEAT_MAX_CONCURRENT_CLOSES)
+        for client_info in list(registry.clients.values()):
+            self.track(client_info)
+
+        while True:
+            try:
+                now = time.time()
+                self._expire_due(now)
+                delay = self._heap[0][0] - now if self._heap else HEARTBEAT_TIMEOUT
+                self._wakeup.clear()
+                try:
+                    # 下限避免同一时刻的大量条目导致忙等
+                    await asyncio.wait_for(self._wakeup.wait(), max(delay, 0.05))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ 心跳监控错误: {e}")
+                await asyncio.sleep(1)
+
+
+heartbeat_scheduler = HeartbeatScheduler()
+
+
 async def heartbeat_monitor():
     """心跳监控协程"""
-    logger.info("💓 心跳监控已启动")
+    roles = ", ".join(f"{k}={v:g}s" for k, v in HEARTBEAT_ROLE_TIMEOUTS.items())
+    logger.info(f"💓 心跳监控已启动（默认超时 {HEARTBEAT_TIMEOUT:g}s{'，' + roles if roles else ''}）")
+    await heartbeat_scheduler.run()
+
+
+SESSION_LOG_PRUNE_INTERVAL = 3600  # 秒
+
+
+async def session_reaper():
+    """定期回收空闲 session，并清理超过保留期的事件日志"""
+    logger.info(f"🧹 Session 回收已启动（TTL {SESSION_IDLE_TTL:g}s）")
+    last_prune = 0.0
     
     while True:
         try:
-            await asyncio.sleep(60)  # 每分钟检查一次
-            
-            # 检查所有客户端
-            dead_clients = []
-            
-            for client_id, client_info in registry.clients.items():
-                if not client_info.is_alive(timeout=120):
-                    dead_clients.append(client_id)
-            
-            # 移除死连接
-            for client_id in dead_clients:
-                client_info = registry.clients.get(client_id)
-                if client_info:
-                    logger.warning(f"⚠️  客户端超时: {client_id}")
-                    try:
-                        await client_info.websocket.close()
-                    except:
-                        pass
-                    registry.unregister(client_info.websocket)
-        
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            evicted = session_manager.evict_idle(SESSION_IDLE_TTL)
+            if evicted:
+                logger.info(f"🧹 回收 {len(evicted)} 个空闲 session，剩余 {len(session_manager.sessions)}")
+            if session_log is not None and time.monotonic() - last_prune >= SESSION_LOG_PRUNE_INTERVAL:
+                last_prune = time.monotonic()
+                removed = await session_log.prune()
+                if removed:
+                    logger.info(f"🧹 [SessionLog] 清理 {removed} 条过期事件")
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"❌ 心跳监控错误: {e}")
-            await asyncio.sleep(1)
+            logger.error(f"❌ Session 回收错误: {e}")
+
+
+# ============================================================================
+# 指标注册（抓取时计算的 gauge，以及由已有计数字典导出的 counter）
+# ============================================================================
+
+def _local_clients():
+    return (c for c in registry.clients.values() if not c.remote)
+
+
+def _write_buffer_size(client_info: ClientInfo) -> int:
+    transport = getattr(client_info.websocket, "transport", None)
+    return transport.get_write_buffer_size() if transport is not None else 0
+
+
+METRICS.gauge("ortensia_clients", "已连接客户端数（按主要角色）", ("role",),
+              lambda: [((role,), n) for role, n in registry.get_stats().items()])
+METRICS.gauge("ortensia_client_outbox_depth", "各客户端出站队列中等待写出的帧数", ("client_id", "role"),
+              lambda: [((c.client_id, c.client_type), c.outbox_depth) for c in _local_clients()])
+METRICS.gauge("ortensia_client_write_buffer_bytes", "各客户端传输层写缓冲区中尚未发出的字节数", ("client_id",),
+              lambda: [((c.client_id,), _write_buffer_size(c)) for c in _local_clients()])
+METRICS.counter_callback("ortensia_outbox_events_total", "出站队列事件（enqueued / sent / send_errors / dropped / overflow_disconnects）", ("event",),
+                         lambda: [((k,), v) for k, v in outbox_counters.items()])
+METRICS.gauge("ortensia_session_queue_depth", "各 session 输入队列中等待处理的条目数", ("session_id",),
+              lambda: [((sid,), s.queue.qsize()) for sid, s in session_manager.sessions.items()])
+METRICS.gauge("ortensia_sessions", "内存中的 session 数", (),
+              lambda: [((), len(session_manager.sessions))])
+METRICS.gauge("ortensia_pending_requests", "等待 execute_js_result 的请求数", (),
+              lambda: [((), len(pending_requests))])
+METRICS.counter_callback("ortensia_pending_requests_total", "server 发出的请求（registered / resolved / timeouts / failed / late）", ("outcome",),
+                         lambda: [((k,), v) for k, v in pending_requests.stats.items()])
+METRICS.counter_callback("ortensia_routing_cache_total", "conversation → 窗口缓存查询（hits / misses / stale）", ("result",),
+                         lambda: [((k,), v) for k, v in conversation_windows.stats.items()])
+METRICS.counter_callback("ortensia_heartbeat_timeouts_total", "因心跳超时断开的客户端数", (),
+                         lambda: [((), heartbeat_scheduler.stats["timeouts"])])
 
 
 # ============================================================================
@@ -1489,8 +3281,31 @@ async def heartbeat_monitor():
 
 async def main():
     """主函数"""
+    global session_log, cluster_link
     host = os.environ.get("ORTENSIA_HOST", "0.0.0.0")
     port = int(os.environ.get("ORTENSIA_PORT", "8765"))
+    workers = max(1, int(os.environ.get(WORKERS_ENV, "1")))
+    socket_path = os.environ.get(SOCKET_ENV) or default_socket_path(port)
+    
+    if workers > 1 and not cluster_supported():
+        logger.warning("⚠️  当前平台不支持 SO_REUSEPORT，忽略 ORTENSIA_WORKERS，以单进程运行")
+        workers = 1
+    if workers > 1 and CLUSTER_WORKER_ID is None:
+        # supervisor：只运行 broker 并管理 worker 进程，不接受 WebSocket 连接
+        await run_supervisor([sys.executable, os.path.abspath(__file__)], workers, socket_path)
+        return
+    if CLUSTER_WORKER_ID is not None:
+        cluster_link = ClusterLink(CLUSTER_WORKER_ID, workers, socket_path)
+        await cluster_link.connect(handle_cluster_message)
+        pending_requests.node = f"w{CLUSTER_WORKER_ID}"
+    
+    session_log = open_session_log_from_env()
+    metrics_server = None
+    metrics_port = int(os.environ.get("ORTENSIA_METRICS_PORT") or 0)
+    if metrics_port:
+        metrics_port += CLUSTER_WORKER_ID or 0
+        metrics_host = os.environ.get("ORTENSIA_METRICS_HOST", "127.0.0.1")
+        metrics_server = await serve_metrics(metrics_host, metrics_port)
 
     logger.info("=" * 70)
     logger.info("  🌸 Ortensia 中央 WebSocket Server v2.0")
@@ -1503,15 +3318,25 @@ async def main():
     logger.info("    • Cursor Hook")
     logger.info("    • Command Client")
     logger.info("    • AITuber Client (新/旧)")
+    logger.info(f"  - Session 事件日志: {session_log.path if session_log else '关闭'}")
+    if metrics_server is not None:
+        logger.info(f"  - 指标: http://{metrics_host}:{metrics_port}/metrics")
+    if cluster_link is not None:
+        logger.info(f"  - 多进程模式: worker {CLUSTER_WORKER_ID}/{workers}（broker: {socket_path}）")
     logger.info("")
     logger.info("=" * 70)
     logger.info("")
     
-    # 启动心跳监控
+    # 启动心跳监控与 session 回收
     heartbeat_task = asyncio.create_task(heartbeat_monitor())
+    reaper_task = asyncio.create_task(session_reaper())
     
     # 启动 WebSocket 服务器
-    async with websockets.serve(handle_client, host, port):
+    async with websockets.serve(
+        handle_client, host, port,
+        ping_interval=PING_INTERVAL,
+        reuse_port=cluster_link is not None,
+    ):
         logger.info(f"✅ WebSocket 服务器已启动: ws://{host}:{port}")
         logger.info("")
         logger.info("等待客户端连接...")
@@ -1522,11 +3347,18 @@ async def main():
             await asyncio.Future()
         except asyncio.CancelledError:
             logger.info("🛑 正在关闭服务器...")
-            heartbeat_task.cancel()
-            try:
-                await heartbeat_task
-            except asyncio.CancelledError:
-                pass
+            for task in (heartbeat_task, reaper_task):
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            if session_log is not None:
+                session_log.close()
+            if cluster_link is not None:
+                await cluster_link.close()
+            if metrics_server is not None:
+                metrics_server.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Hook 启动开销对比：cold（每次启动解释器）vs warm（交给常驻 hook daemon）
+
+- cold:    python hooks/<hook>.py                  —— 原来的执行方式
+- runner:  python -S run_hook.py hooks/<hook>.py   —— 实际部署路径（warm 模式）
+- socket:  直接向 daemon 发 run 请求               —— 排除 runner 自身解释器启动后的下限
+
+Usage:
+  python bench_hook_startup.py            # 默认每种方式 20 次
+  HOOK_BENCH_RUNS=50 python bench_hook_startup.py
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+HOOKS_DIR = ROOT / "hooks"
+RUNS = int(os.environ.get("HOOK_BENCH_RUNS", "20"))
+
+CASES = [
+    ("beforeShellExecution", {"command": "git push origin main --force", "conversation_id": "bench"}),
+    ("beforeReadFile", {"file_path": "/repo/.env", "conversation_id": "bench"}),
+    ("beforeSubmitPrompt", {"prompt": "hello", "conversation_id": "bench"}),
+    ("afterAgentResponse", {"text": "done", "conversation_id": "bench"}),
+]
+
+
+def _percentile(samples: list, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def _timed_run(cmd: list, stdin_text: str, env: dict) -> float:
+    start = time.perf_counter()
+    subprocess.run(cmd, input=stdin_text, capture_output=True, text=True, env=env, check=False)
+    return (time.perf_counter() - start) * 1000
+
+
+def _socket_run(sock_path: str, hook: Path, stdin_text: str) -> float:
+    start = time.perf_counter()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(sock_path)
+        request = {"op": "run", "hook": str(hook.resolve()), "input": stdin_text}
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        buf = b""
+        while not buf.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            buf += chunk
+    elapsed = (time.perf_counter() - start) * 1000
+    if "error" in json.loads(buf):
+        raise RuntimeError(buf.decode("utf-8", "replace"))
+    return elapsed
+
+
+def _wait_for_socket(path: str, timeout: float = 10.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"hook daemon 未在 {timeout}s 内就绪: {path}")
+
+
+def main() -> int:
+    if not hasattr(socket, "AF_UNIX"):
+        print("⚠️  当前平台不支持 Unix socket，warm 模式不可用")
+        return 0
+
+    tmp = Path(tempfile.mkdtemp(prefix="hook-bench-"))
+    sock_path = str(tmp / "daemon.sock")
+    env = dict(
+        os.environ,
+        CURSOR_AGENT_HOOKS_LOG=str(tmp / "hooks.log"),
+        ORTENSIA_HOOK_DAEMON_SOCKET=sock_path,
+        ORTENSIA_HOOK_SPOOL=str(tmp / "spool"),
+        WS_SERVER="ws://127.0.0.1:9",  # 不可达：只测本地开销
+        CURSOR_AGENT_PYTHON=sys.executable,
+    )
+
+    daemon = subprocess.Popen(
+        [sys.executable, str(ROOT / "lib" / "hook_daemon.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_for_socket(sock_path)
+        print("=" * 72)
+        print(f"🧪 Hook 启动开销（{RUNS} 次/方式）")
+        print("=" * 72)
+        print(f"{'hook':<24}{'cold p50/p95':>16}{'runner p50/p95':>18}{'socket p50/p95':>18}")
+        for hook_name, input_data in CASES:
+            hook = HOOKS_DIR / f"{hook_name}.py"
+            stdin_text = json.dumps(input_data)
+            cold = [_timed_run([sys.executable, str(hook)], stdin_text, env) for _ in range(RUNS)]
+            runner = [
+                _timed_run([sys.executable, "-S", str(ROOT / "run_hook.py"), str(hook)], stdin_text, env)
+                for _ in range(RUNS)
+            ]
+            direct = [_socket_run(sock_path, hook, stdin_text) for _ in range(RUNS)]
+            print(
+                f"{hook_name:<24}"
+                f"{_percentile(cold, 0.5):>8.1f}/{_percentile(cold, 0.95):<7.1f}"
+                f"{_percentile(runner, 0.5):>10.1f}/{_percentile(runner, 0.95):<7.1f}"
+                f"{_percentile(direct, 0.5):>10.1f}/{_percentile(direct, 0.95):<7.1f}"
+            )
+        print("（单位 ms）")
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=5)
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
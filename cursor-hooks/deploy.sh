@@ -28,6 +28,16 @@ echo -e "${BLUE}📁 源目录:${NC} ${SOURCE_DIR}"
 echo -e "${BLUE}📁 目标目录:${NC} ${TARGET_DIR}"
 echo ""
 
+# 停止常驻 hook daemon：它缓存了旧的 hook 代码和权限规则
+STOP_PY="$TARGET_DIR/venv/bin/python"
+if [ ! -x "$STOP_PY" ]; then
+    STOP_PY="${PYTHON_BIN:-python3}"
+fi
+if command -v "$STOP_PY" >/dev/null 2>&1; then
+    echo -e "${GREEN}🛑 停止正在运行的 hook daemon...${NC}"
+    "$STOP_PY" "$SOURCE_DIR/lib/hook_daemon.py" --stop 2>/dev/null || true
+fi
+
 # 检查目标目录
 if [ -d "$TARGET_DIR" ]; then
     echo -e "${YELLOW}⚠️  目标目录 ~/.cursor-agent/ 已存在${NC}"
@@ -65,6 +75,10 @@ if [ -f "$SOURCE_DIR/run_hook.sh" ]; then
     echo -e "${GREEN}📦 复制包装脚本...${NC}"
     cp "$SOURCE_DIR/run_hook.sh" "$TARGET_DIR/"
 fi
+if [ -f "$SOURCE_DIR/run_hook.py" ]; then
+    # run_hook.sh 优先通过 run_hook.py 把 hook 交给常驻 daemon（warm 模式）
+    cp "$SOURCE_DIR/run_hook.py" "$TARGET_DIR/"
+fi
 
 # 创建独立虚拟环境（保证不同机器可用，不依赖仓库路径）
 echo -e "${GREEN}🐍 创建 Python 虚拟环境...${NC}"
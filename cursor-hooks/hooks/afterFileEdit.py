@@ -16,6 +16,9 @@ from agent_hook_handler import AuditHook
 class AfterFileEditHook(AuditHook):
     """文件编辑后的处理"""
     
+    # 格式化工具按调用方的 PATH 查找，不在 daemon 内执行
+    warm_capable = False
+    
     def __init__(self):
         super().__init__("afterFileEdit")
     
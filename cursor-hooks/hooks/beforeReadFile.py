@@ -5,12 +5,12 @@ beforeReadFile Hook
 """
 
 import sys
-import re
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent.parent / "lib"))
 
 from agent_hook_handler import PermissionHook
+from policy_engine import PolicyConfigError, get_policy_engine
 
 
 class BeforeReadFileHook(PermissionHook):
@@ -19,21 +19,7 @@ class BeforeReadFileHook(PermissionHook):
     def __init__(self):
         super().__init__("beforeReadFile")
     
-    # 敏感文件模式
-    SENSITIVE_PATTERNS = [
-        r'\.env',
-        r'\.env\..*',
-        r'id_rsa',
-        r'\.pem$',
-        r'\.key$',
-        r'password',
-        r'secret',
-        r'token',
-        r'credentials',
-        r'\.ssh/',
-        r'\.aws/',
-        r'\.kube/config',
-    ]
+    # 敏感文件规则见 lib/permission_rules.json（规则集 "read_file"）
     
     def make_decision(self) -> tuple[str, str, str]:
         """决定是否允许读取文件"""
@@ -46,19 +32,46 @@ class BeforeReadFileHook(PermissionHook):
         file_name = Path(file_path).name
         file_path_lower = file_path.lower()
         
-        for pattern in self.SENSITIVE_PATTERNS:
-            if re.search(pattern, file_path_lower):
-                # 敏感文件需要确认
-                self.send_to_ortensia(
-                    f"Agent 要读取敏感文件：{file_name}，需要确认",
-                    emotion="surprised"
-                )
-                
-                return (
-                    "ask",
-                    f"⚠️  Agent 要读取敏感文件：{file_name}\n是否允许？",
-                    None
-                )
+        try:
+            match = get_policy_engine().evaluate("read_file", file_path)
+        except PolicyConfigError as e:
+            # 规则配置坏了也要给出明确的判定，交给用户确认
+            self.logger.error(f"❌ 权限规则加载失败，改为询问: {e}")
+            self.send_to_ortensia(
+                f"权限规则加载失败，读取 {file_name} 需要确认",
+                emotion="surprised"
+            )
+            return (
+                "ask",
+                f"⚠️  权限规则无法加载，Agent 要读取文件：{file_name}\n是否允许？",
+                None
+            )
+        
+        if match.verdict == "deny":
+            self.logger.warning(f"🚫 拒绝读取敏感文件: {file_path} (规则 {match.rule.name})")
+            self.send_to_ortensia(
+                f"Agent 要读取敏感文件：{file_name}，已阻止",
+                emotion="angry"
+            )
+            
+            return (
+                "deny",
+                f"🚫 敏感文件已被阻止读取：{file_name}",
+                f"文件 '{file_name}' 被安全策略阻止读取"
+            )
+        
+        if match.verdict == "ask":
+            # 敏感文件需要确认
+            self.send_to_ortensia(
+                f"Agent 要读取敏感文件：{file_name}，需要确认",
+                emotion="surprised"
+            )
+            
+            return (
+                "ask",
+                f"⚠️  Agent 要读取敏感文件：{file_name}\n是否允许？",
+                None
+            )
         
         # 普通文件
         # 只对重要操作发送通知
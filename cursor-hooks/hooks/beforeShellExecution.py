@@ -5,41 +5,19 @@ beforeShellExecution Hook
 """
 
 import sys
-import re
 from pathlib import Path
 
 # 添加 lib 到路径
 sys.path.insert(0, str(Path(__file__).parent.parent / "lib"))
 
 from agent_hook_handler import PermissionHook
+from policy_engine import PolicyConfigError, get_policy_engine
 
 
 class BeforeShellExecutionHook(PermissionHook):
     """Shell 命令执行前的权限检查"""
     
-    # 危险命令模式列表
-    DANGEROUS_PATTERNS = [
-        r'rm\s+-rf\s+/',  # rm -rf /
-        r'rm\s+-rf\s+\*',  # rm -rf *
-        r':\(\)\{.*;\};',  # Fork bomb
-        r'>\s*/dev/sd[a-z]',  # 直接写入磁盘
-        r'dd\s+if=.*of=/dev/',  # dd 写入磁盘
-        r'mkfs\.',  # 格式化文件系统
-        r'chmod\s+-R\s+777\s+/',  # 递归修改根目录权限
-        r'curl.*\|\s*sh',  # 管道执行远程脚本
-        r'wget.*\|\s*sh',  # 管道执行远程脚本
-    ]
-    
-    # 需要确认的命令模式
-    RISKY_PATTERNS = [
-        r'rm\s+-rf',  # rm -rf
-        r'DROP\s+DATABASE',  # SQL: DROP DATABASE
-        r'DROP\s+TABLE',  # SQL: DROP TABLE
-        r'DELETE\s+FROM.*WHERE\s+1=1',  # SQL: 删除所有数据
-        r'git\s+push\s+.*--force',  # Git force push
-        r'npm\s+publish',  # npm 发布
-        r'docker\s+rm\s+-f',  # 强制删除容器
-    ]
+    # 危险/风险命令规则见 lib/permission_rules.json（规则集 "shell"）
     
     def __init__(self):
         super().__init__("beforeShellExecution")
@@ -59,50 +37,55 @@ class BeforeShellExecutionHook(PermissionHook):
             self.logger.warning("⚠️  命令为空，允许执行")
             return ("allow", None, None)
         
-        # 检查危险命令
-        self.logger.info("🔍 步骤 1/3: 检查危险命令模式...")
-        for pattern in self.DANGEROUS_PATTERNS:
-            if re.search(pattern, self.command, re.IGNORECASE):
-                self.logger.warning(f"🚨 匹配到危险命令模式: {pattern}")
-                self.logger.warning(f"🚫 拒绝执行命令: {self.command}")
-                
-                # 发送警告到オルテンシア
-                self.send_to_ortensia(
-                    f"检测到危险命令！已阻止：{self.command[:50]}...",
-                    emotion="angry"
-                )
-                
-                return (
-                    "deny",
-                    f"🚫 危险命令已被阻止：{self.command}",
-                    f"命令 '{self.command}' 被安全策略阻止"
-                )
+        # 单次扫描得到最高严重级别的命中（deny > ask）
+        self.logger.info("🔍 步骤 1/2: 匹配命令权限规则...")
+        try:
+            match = get_policy_engine().evaluate("shell", self.command)
+        except PolicyConfigError as e:
+            # 规则配置坏了也要给出明确的判定，交给用户确认
+            self.logger.error(f"❌ 权限规则加载失败，改为询问: {e}")
+            return (
+                "ask",
+                f"⚠️  权限规则无法加载，命令需要确认：{self.command}",
+                None
+            )
         
-        self.logger.info("✅ 未检测到危险命令")
+        if match.verdict == "deny":
+            self.logger.warning(f"🚨 匹配到危险命令规则: {match.rule.name} ({match.rule.pattern})")
+            self.logger.warning(f"🚫 拒绝执行命令: {self.command}")
+            
+            # 发送警告到オルテンシア
+            self.send_to_ortensia(
+                f"检测到危险命令！已阻止：{self.command[:50]}...",
+                emotion="angry"
+            )
+            
+            return (
+                "deny",
+                f"🚫 危险命令已被阻止：{self.command}",
+                f"命令 '{self.command}' 被安全策略阻止"
+            )
         
-        # 检查风险命令
-        self.logger.info("🔍 步骤 2/3: 检查风险命令模式...")
-        for pattern in self.RISKY_PATTERNS:
-            if re.search(pattern, self.command, re.IGNORECASE):
-                self.logger.warning(f"⚠️  匹配到风险命令模式: {pattern}")
-                self.logger.warning(f"❓ 需要用户确认: {self.command}")
-                
-                # 发送警告到オルテンシア
-                self.send_to_ortensia(
-                    f"检测到风险命令，需要确认：{self.command[:50]}...",
-                    emotion="surprised"
-                )
-                
-                return (
-                    "ask",
-                    f"⚠️  风险命令需要确认：{self.command}",
-                    None
-                )
+        if match.verdict == "ask":
+            self.logger.warning(f"⚠️  匹配到风险命令规则: {match.rule.name} ({match.rule.pattern})")
+            self.logger.warning(f"❓ 需要用户确认: {self.command}")
+            
+            # 发送警告到オルテンシア
+            self.send_to_ortensia(
+                f"检测到风险命令，需要确认：{self.command[:50]}...",
+                emotion="surprised"
+            )
+            
+            return (
+                "ask",
+                f"⚠️  风险命令需要确认：{self.command}",
+                None
+            )
         
-        self.logger.info("✅ 未检测到风险命令")
+        self.logger.info("✅ 未检测到危险或风险命令")
         
         # 普通命令 - 通知オルテンシア（所有命令都通知）
-        self.logger.info("🔍 步骤 3/3: 发送命令通知...")
+        self.logger.info("🔍 步骤 2/2: 发送命令通知...")
         
         # 生成简洁的消息
         cmd_preview = self.command[:40] + "..." if len(self.command) > 40 else self.command
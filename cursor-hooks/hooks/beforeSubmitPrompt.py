@@ -16,6 +16,9 @@ from agent_hook_handler import AgentHookHandler
 class BeforeSubmitPromptHook(AgentHookHandler):
     """Prompt 提交前的审核"""
     
+    # Cursor 等待 {"continue": ...} 才会提交 Prompt，通知延后投递
+    defer_notifications = True
+    
     def __init__(self):
         super().__init__("beforeSubmitPrompt")
     
@@ -11,12 +11,28 @@ import asyncio
 import time
 import hashlib
 import os
+import socket
+import subprocess
 import tempfile
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Callable, Optional, TextIO
 from datetime import datetime
 
 # 设置日志
+#
+# 环境变量：
+#   CURSOR_AGENT_HOOKS_LOG              日志文件路径（默认系统临时目录下的 cursor-agent-hooks.log）
+#   CURSOR_AGENT_HOOKS_LOG_PROFILE      verbose（默认，逐字段记录输入/输出）| quiet（生产模式，只记录告警和错误）
+#   CURSOR_AGENT_HOOKS_LOG_LEVEL        覆盖日志级别（verbose 默认 DEBUG，quiet 默认 WARNING）
+#   CURSOR_AGENT_HOOKS_LOG_MAX_BYTES    单个日志文件上限（默认 5MB，超过后由 hook daemon 轮转）
+#   CURSOR_AGENT_HOOKS_LOG_BACKUPS      保留的轮转文件个数（默认 3）
+#
+# 日志文件由所有 hook 进程和 daemon 共用。RotatingFileHandler 不能跨进程使用（各进程各自改名，
+# 会写进已轮转的文件、覆盖备份），所以只有单实例的 hook daemon 负责轮转（enable_log_rotation）；
+# 冷启动的 hook 进程用 WatchedFileHandler 追加写入，发现文件被轮转后重新打开。
+#
+# 消息在调用线程中格式化（QueueHandler.prepare），然后放进内存队列；文件/stderr 写入由
+# QueueListener 的后台线程完成，进程退出时（atexit）再把队列中剩余的记录写完。
 _log_env = os.environ.get("CURSOR_AGENT_HOOKS_LOG")
 if _log_env:
     log_file = Path(_log_env).expanduser()
@@ -24,22 +40,103 @@ else:
     # Cross-platform default (Windows: %TEMP%, macOS/Linux: /tmp or equivalent)
     log_file = Path(tempfile.gettempdir()) / "cursor-agent-hooks.log"
 
-# Ensure parent directory exists before FileHandler opens the file
-try:
-    log_file.parent.mkdir(parents=True, exist_ok=True)
-except Exception:
-    # If we can't create the directory for any reason, logging.FileHandler will surface the error.
-    pass
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='[%(asctime)s] [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler(log_file, encoding="utf-8"),
-        logging.StreamHandler(sys.stderr)  # 错误输出到 stderr
-    ]
-)
-logger = logging.getLogger(__name__)
+LOG_PROFILE = os.environ.get("CURSOR_AGENT_HOOKS_LOG_PROFILE", "verbose").strip().lower()
+LOG_QUIET = LOG_PROFILE == "quiet"
+
+
+def _setup_logging() -> logging.Logger:
+    import atexit
+    import queue
+    from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+    default_level = "WARNING" if LOG_QUIET else "DEBUG"
+    level_name = os.environ.get("CURSOR_AGENT_HOOKS_LOG_LEVEL", default_level).strip().upper()
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        level = logging.getLevelName(default_level)
+
+    formatter = logging.Formatter('[%(asctime)s] [%(levelname)s] %(message)s')
+    handlers = []
+
+    # Ensure parent directory exists before the file handler opens the file
+    try:
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+    except Exception:
+        # If we can't create the directory for any reason, the file handler will surface the error.
+        pass
+    try:
+        file_handler = WatchedFileHandler(log_file, encoding="utf-8", delay=True)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+    except OSError as e:
+        print(f"agent_hook_handler: 无法打开日志文件 {log_file}: {e}", file=sys.stderr)
+
+    stderr_handler = logging.StreamHandler(sys.stderr)  # 错误输出到 stderr
+    stderr_handler.setFormatter(formatter)
+    handlers.append(stderr_handler)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    global _log_listener
+    _log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+    return logging.getLogger(__name__)
+
+
+_log_listener = None
+logger = _setup_logging()
+
+
+def enable_log_rotation() -> None:
+    """改为按大小轮转日志文件；只能在单实例的 hook daemon 中调用（同一时刻只有它会轮转）"""
+    from logging.handlers import RotatingFileHandler, WatchedFileHandler
+
+    listener = _log_listener
+    if listener is None:
+        return
+    try:
+        rotating = RotatingFileHandler(
+            log_file,
+            maxBytes=int(os.environ.get("CURSOR_AGENT_HOOKS_LOG_MAX_BYTES", str(5 * 1024 * 1024))),
+            backupCount=int(os.environ.get("CURSOR_AGENT_HOOKS_LOG_BACKUPS", "3")),
+            encoding="utf-8",
+            delay=True,
+        )
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️  无法启用日志轮转: {e}")
+        return
+    listener.stop()  # 先写完队列中的记录，再替换 handler
+    handlers = []
+    for handler in listener.handlers:
+        if isinstance(handler, WatchedFileHandler):
+            rotating.setFormatter(handler.formatter)
+            handler.close()
+            handlers.append(rotating)
+        else:
+            handlers.append(handler)
+    listener.handlers = tuple(handlers)
+    listener.start()
+
+
+def _log_details_enabled() -> bool:
+    """是否记录逐字段明细（quiet 模式或级别高于 INFO 时直接跳过，不做任何格式化）"""
+    return not LOG_QUIET and logger.isEnabledFor(logging.INFO)
+
+
+def _log_fields(title: str, data: Dict[str, Any]) -> None:
+    """逐字段记录 dict（长字符串截断到 100 字符）"""
+    if not _log_details_enabled():
+        return
+    logger.info(title)
+    for key, value in data.items():
+        if isinstance(value, str) and len(value) > 100:
+            logger.info("   • %s: %s...", key, value[:100])
+        else:
+            logger.info("   • %s: %s", key, value)
 
 def _read_ortensia_server_from_file() -> Optional[str]:
     """
@@ -79,35 +176,189 @@ def _read_ortensia_server_from_file() -> Optional[str]:
     return None
 
 
+def _resolve_ws_server() -> str:
+    """解析中央服务器地址（环境变量 > 配置文件 > 默认值）"""
+    return (
+        os.environ.get("WS_SERVER")
+        or os.environ.get("ORTENSIA_SERVER")
+        or _read_ortensia_server_from_file()
+        or "ws://localhost:8765"
+    )
+
+
+# ============================================================================
+# Hook Daemon 客户端（常驻进程复用一条已注册的 WebSocket 连接）
+# ============================================================================
+#
+# ORTENSIA_HOOK_DAEMON:
+#   - auto（默认）：优先交给本地 hook daemon；daemon 未运行时自动拉起，本次直连发送
+#   - off：始终直连中央服务器（旧行为）
+
+def _hook_daemon_mode() -> str:
+    return os.environ.get("ORTENSIA_HOOK_DAEMON", "auto").strip().lower()
+
+
+def hook_daemon_socket_path() -> Path:
+    """hook daemon 的 Unix socket 路径（每个用户一个）"""
+    override = os.environ.get("ORTENSIA_HOOK_DAEMON_SOCKET")
+    if override:
+        return Path(override).expanduser()
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return Path(tempfile.gettempdir()) / f"ortensia-hook-daemon-{uid}.sock"
+
+
+# 在 hook daemon 进程内运行 hook 时，通知直接交给 daemon 的发送队列（不再经过 socket）
+_event_sink: Optional[Callable[[Dict[str, Any]], None]] = None
+
+
+def set_event_sink(sink: Optional[Callable[[Dict[str, Any]], None]]) -> None:
+    """设置进程内的通知接收者（由 hook daemon 调用）"""
+    global _event_sink
+    _event_sink = sink
+
+
+def submit_to_hook_daemon(request: Dict[str, Any], timeout: float = 0.2) -> bool:
+    """
+    把一条请求（一行 JSON）交给 hook daemon，不等待任何响应。
+
+    Returns:
+        True 表示 daemon 已接收；False 表示 daemon 不可用（调用方应回退）
+    """
+    if _event_sink is not None and request.get("op") == "event":
+        _event_sink(request["message"])
+        return True
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(hook_daemon_socket_path()))
+            sock.sendall(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        return True
+    except OSError:
+        return False
+
+
+def hook_spool_dir() -> Path:
+    """daemon 不可用时暂存通知的目录（由 daemon 或一次性 flusher 补发）"""
+    override = os.environ.get("ORTENSIA_HOOK_SPOOL")
+    if override:
+        return Path(override).expanduser()
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return Path(tempfile.gettempdir()) / f"ortensia-hook-spool-{uid}"
+
+
+def spool_message(message: Dict[str, Any]) -> bool:
+    """把一条消息原子地写入 spool 目录（先写临时文件再 rename）"""
+    try:
+        spool = hook_spool_dir()
+        spool.mkdir(parents=True, exist_ok=True)
+        name = f"{time.time_ns()}-{os.getpid()}"
+        tmp = spool / f".{name}.tmp"
+        tmp.write_text(json.dumps(message, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, spool / f"{name}.json")
+        return True
+    except Exception as e:
+        logger.error("❌ 写入 spool 失败: %s", e)
+        return False
+
+
+def drain_spool() -> list:
+    """按写入顺序取出并删除 spool 中的全部消息"""
+    spool = hook_spool_dir()
+    if not spool.is_dir():
+        return []
+    messages = []
+    for path in sorted(spool.glob("*.json")):
+        try:
+            messages.append(json.loads(path.read_text(encoding="utf-8")))
+        except Exception as e:
+            logger.warning("⚠️  丢弃损坏的 spool 文件 %s: %s", path.name, e)
+        try:
+            path.unlink()
+        except OSError:
+            pass
+    return messages
+
+
+_daemon_spawned = False
+
+
+def spawn_hook_daemon() -> None:
+    """后台拉起 hook daemon（重复拉起是安全的：daemon 通过文件锁保证单实例）"""
+    global _daemon_spawned
+    if _daemon_spawned or not hasattr(socket, "AF_UNIX"):
+        return
+    _daemon_spawned = True
+    daemon_script = Path(__file__).parent / "hook_daemon.py"
+    try:
+        subprocess.Popen(
+            [sys.executable, str(daemon_script)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            start_new_session=True,
+        )
+        logger.info("🚀 已在后台拉起 hook daemon")
+    except Exception as e:
+        logger.warning("⚠️  拉起 hook daemon 失败: %s", e)
+
+
+def spawn_spool_flusher() -> None:
+    """没有 Unix socket 的平台（Windows）：拉起一次性进程补发 spool 后退出"""
+    daemon_script = Path(__file__).parent / "hook_daemon.py"
+    flags = 0
+    if os.name == "nt":
+        flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    try:
+        subprocess.Popen(
+            [sys.executable, str(daemon_script), "--drain-spool"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            creationflags=flags,
+        )
+    except Exception as e:
+        logger.warning("⚠️  拉起 spool flusher 失败: %s", e)
+
+
 class AgentHookHandler:
     """Agent Hook 处理器基类"""
     
+    # 为 True 时，process() 期间的通知先缓存，等响应写出后再投递（不阻塞 Cursor 等待决策）
+    defer_notifications = False
+    
+    # 能否在常驻 daemon 内执行（见 hook_daemon.py）。需要调用方 PATH / 环境的 hook
+    # （例如调用外部格式化工具）设为 False，始终由 run_hook.py 冷启动执行
+    warm_capable = True
+    
     def __init__(self, hook_name: str):
         self.hook_name = hook_name
         self.input_data: Dict[str, Any] = {}
+        self._deferred: Optional[list] = None
+        self._stdin: Optional[TextIO] = None
+        self._stdout: Optional[TextIO] = None
         self.logger = logger  # 让子类可以使用 self.logger
         
         # オルテンシア WebSocket 配置
-        self.ws_server = (
-            os.environ.get("WS_SERVER")
-            or os.environ.get("ORTENSIA_SERVER")
-            or _read_ortensia_server_from_file()
-            or "ws://localhost:8765"
-        )
+        self.ws_server = _resolve_ws_server()
         
-        logger.info(f"🎣 [{hook_name}] Agent Hook 启动")
-        logger.info(f"🌐 Ortensia Server: {self.ws_server}")
+        logger.info("🎣 [%s] Agent Hook 启动", hook_name)
+        logger.info("🌐 Ortensia Server: %s", self.ws_server)
     
     def read_input(self) -> Dict[str, Any]:
         """从 stdin 读取 JSON 输入"""
         try:
-            input_text = sys.stdin.read()
+            input_text = (self._stdin or sys.stdin).read()
             
             # 详细日志记录
             logger.info("=" * 70)
-            logger.info(f"📥 [{self.hook_name}] 接收到 Cursor 调用")
+            logger.info("📥 [%s] 接收到 Cursor 调用", self.hook_name)
             logger.info("=" * 70)
-            logger.debug(f"原始输入: {input_text[:500]}...")  # 截断长输入
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("原始输入: %s...", input_text[:500])  # 截断长输入
             
             if not input_text.strip():
                 logger.warning("⚠️  输入为空")
@@ -116,40 +367,30 @@ class AgentHookHandler:
             self.input_data = json.loads(input_text)
             
             # 格式化输出关键信息
-            logger.info(f"📋 输入数据摘要:")
-            for key, value in self.input_data.items():
-                if isinstance(value, str) and len(value) > 100:
-                    logger.info(f"   • {key}: {value[:100]}...")
-                else:
-                    logger.info(f"   • {key}: {value}")
+            _log_fields("📋 输入数据摘要:", self.input_data)
             
-            logger.info(f"✅ 输入数据解析成功")
+            logger.info("✅ 输入数据解析成功")
             return self.input_data
             
         except json.JSONDecodeError as e:
-            logger.error(f"❌ JSON 解析失败: {e}")
-            logger.error(f"   输入内容: {input_text}")
+            logger.error("❌ JSON 解析失败: %s", e)
+            logger.error("   输入内容: %s", input_text)
             return {}
         except Exception as e:
-            logger.error(f"❌ 读取输入失败: {e}")
+            logger.error("❌ 读取输入失败: %s", e)
             return {}
     
     def write_output(self, output: Dict[str, Any]) -> None:
         """输出 JSON 到 stdout"""
         try:
             output_text = json.dumps(output, ensure_ascii=False)
-            print(output_text, flush=True)
+            print(output_text, file=self._stdout or sys.stdout, flush=True)
             
             # 详细日志
-            logger.info("📤 输出响应给 Cursor:")
-            for key, value in output.items():
-                if isinstance(value, str) and len(value) > 100:
-                    logger.info(f"   • {key}: {value[:100]}...")
-                else:
-                    logger.info(f"   • {key}: {value}")
+            _log_fields("📤 输出响应给 Cursor:", output)
             
         except Exception as e:
-            logger.error(f"❌ 输出响应失败: {e}")
+            logger.error("❌ 输出响应失败: %s", e)
     
     def send_to_ortensia(
         self, 
@@ -159,8 +400,6 @@ class AgentHookHandler:
     ) -> None:
         """发送消息到オルテンシア（使用 Ortensia 协议）"""
         try:
-            import websockets
-            
             # ============================================================
             # 使用 conversation_id 作为 hook 的客户端 ID
             # ============================================================
@@ -173,82 +412,133 @@ class AgentHookHandler:
                 workspace = self.input_data.get('workspace_roots', ['unknown'])[0] if self.input_data.get('workspace_roots') else 'unknown'
                 workspace_hash = hashlib.md5(workspace.encode()).hexdigest()[:8]
                 client_id = f"hook-{workspace_hash}"
-                logger.warning(f"⚠️  未找到 conversation_id，使用 workspace hash: {client_id}")
+                logger.warning("⚠️  未找到 conversation_id，使用 workspace hash: %s", client_id)
             else:
                 client_id = f"hook-{conversation_id}"
-                logger.info(f"✅ 使用 conversation_id: {conversation_id}")
+                logger.info("✅ 使用 conversation_id: %s", conversation_id)
             
             # 提取 workspace 名称（用于日志）
             workspace = self.input_data.get('workspace_roots', ['unknown'])[0] if self.input_data.get('workspace_roots') else 'unknown'
             workspace_name = Path(workspace).name if workspace != 'unknown' else 'unknown'
             
             # 详细日志
-            logger.info("💬 准备发送消息到オルテンシア:")
-            logger.info(f"   • Hook ID: {client_id}")
-            logger.info(f"   • Conversation ID: {conversation_id}")
-            logger.info(f"   • Workspace: {workspace_name}")
-            logger.info(f"   • 文本: {text}")
-            logger.info(f"   • 情绪: {emotion}")
-            logger.info(f"   • 事件类型: {event_type or self.hook_name}")
-            logger.info(f"   • WebSocket: {self.ws_server}")
+            if _log_details_enabled():
+                logger.info("💬 准备发送消息到オルテンシア:")
+                logger.info("   • Hook ID: %s", client_id)
+                logger.info("   • Conversation ID: %s", conversation_id)
+                logger.info("   • Workspace: %s", workspace_name)
+                logger.info("   • 文本: %s", text)
+                logger.info("   • 情绪: %s", emotion)
+                logger.info("   • 事件类型: %s", event_type or self.hook_name)
+                logger.info("   • WebSocket: %s", self.ws_server)
             
-            # 使用 asyncio.run 来运行异步代码，带超时机制
-            async def send_message():
-                # 添加 3 秒连接超时
-                async with asyncio.timeout(3):
-                    async with websockets.connect(
-                        self.ws_server,
-                        open_timeout=2,  # 连接超时 2 秒
-                        close_timeout=1   # 关闭超时 1 秒
-                    ) as websocket:
-                        # 1. 发送注册消息（符合 Ortensia 协议格式）
-                        register_msg = {
-                            "type": "register",
-                            "from": client_id,
-                            "to": None,
-                            "timestamp": int(time.time() * 1000),  # 毫秒时间戳（顶层必须字段）
-                            "payload": {
-                                "client_type": "agent_hook"
-                            }
-                        }
-                        await websocket.send(json.dumps(register_msg))
-                        logger.debug(f"已发送注册消息: {json.dumps(register_msg)}")
-                        
-                        # 接收注册确认（1秒超时）
-                        response = await asyncio.wait_for(websocket.recv(), timeout=1.0)
-                        logger.debug(f"注册响应: {response}")
-                        
-                        # 2. 发送 AITuber 消息（使用 AITUBER_RECEIVE_TEXT 类型，符合 Ortensia 协议）
-                        message_data = {
-                            "type": "aituber_receive_text",
-                            "from": client_id,
-                            "to": "aituber",  # 发送给 AITuber 客户端
-                            "timestamp": int(time.time() * 1000),  # 毫秒时间戳（顶层必须字段）
-                            "payload": {
-                                "text": text,
-                                "emotion": emotion,
-                                "source": "hook",
-                                "hook_name": self.hook_name,
-                                "event_type": event_type or self.hook_name,
-                                # 添加 Cursor 会话信息
-                                "workspace": workspace,
-                                "workspace_name": workspace_name,
-                                "conversation_id": conversation_id
-                            }
-                        }
-                        
-                        # 添加输入数据的摘要（避免发送过多数据）
-                        if self.input_data:
-                            message_data["payload"]["event_summary"] = self._summarize_input()
-                        
-                        await websocket.send(json.dumps(message_data))
-                        logger.info(f"✅ 消息已发送到オルテンシア")
+            # AITuber 消息（使用 AITUBER_RECEIVE_TEXT 类型，符合 Ortensia 协议）
+            message_data = {
+                "type": "aituber_receive_text",
+                "from": client_id,
+                "to": "aituber",  # 发送给 AITuber 客户端
+                "timestamp": int(time.time() * 1000),  # 毫秒时间戳（顶层必须字段）
+                "payload": {
+                    "text": text,
+                    "emotion": emotion,
+                    "source": "hook",
+                    "hook_name": self.hook_name,
+                    "event_type": event_type or self.hook_name,
+                    # 添加 Cursor 会话信息
+                    "workspace": workspace,
+                    "workspace_name": workspace_name,
+                    "conversation_id": conversation_id
+                }
+            }
             
-            asyncio.run(send_message())
+            # 添加输入数据的摘要（避免发送过多数据）
+            if self.input_data:
+                message_data["payload"]["event_summary"] = self._summarize_input()
+            
+            self._deliver(message_data)
             
         except Exception as e:
-            logger.error(f"❌ 发送到オルテンシア失败: {e}")
-            logger.debug(f"详细错误信息: {e}", exc_info=True)
+            logger.error("❌ 发送到オルテンシア失败: %s", e)
+            logger.debug("详细错误信息: %s", e, exc_info=True)
+    
+    def _deliver(self, message_data: Dict[str, Any]) -> None:
+        """投递一条已构造好的 Ortensia 消息：优先 hook daemon，失败时直连"""
+        if self._deferred is not None:
+            self._deferred.append(message_data)
+            return
+        
+        if _hook_daemon_mode() != "off":
+            if submit_to_hook_daemon({"op": "event", "message": message_data}):
+                logger.info("✅ 消息已交给 hook daemon")
+                return
+            spawn_hook_daemon()
+        
+        asyncio.run(self._send_direct(message_data))
+        logger.info("✅ 消息已发送到オルテンシア")
+    
+    def _flush_deferred(self) -> None:
+        """
+        投递响应写出前缓存的通知。
+        
+        daemon 可用时直接交给 daemon；否则写入 spool，并拉起 daemon（或一次性 flusher）补发，
+        本进程不再等待任何网络往返。
+        """
+        pending, self._deferred = self._deferred, None
+        if not pending:
+            return
+        
+        if _hook_daemon_mode() == "off":
+            for message_data in pending:
+                try:
+                    self._deliver(message_data)
+                except Exception as e:
+                    logger.error("❌ 发送到オルテンシア失败: %s", e)
+            return
+        
+        spooled = 0
+        for message_data in pending:
+            if submit_to_hook_daemon({"op": "event", "message": message_data}):
+                continue
+            if spool_message(message_data):
+                spooled += 1
+        
+        if spooled:
+            logger.info("📦 daemon 不可用，%s 条通知已写入 spool", spooled)
+            if hasattr(socket, "AF_UNIX") and os.name != "nt":
+                spawn_hook_daemon()
+            else:
+                spawn_spool_flusher()
+    
+    async def _send_direct(self, message_data: Dict[str, Any]) -> None:
+        """直连中央服务器发送（connect → register → send → close）"""
+        import websockets
+        
+        # 添加 3 秒连接超时
+        async with asyncio.timeout(3):
+            async with websockets.connect(
+                self.ws_server,
+                open_timeout=2,  # 连接超时 2 秒
+                close_timeout=1   # 关闭超时 1 秒
+            ) as websocket:
+                # 1. 发送注册消息（符合 Ortensia 协议格式）
+                register_msg = {
+                    "type": "register",
+                    "from": message_data["from"],
+                    "to": None,
+                    "timestamp": int(time.time() * 1000),  # 毫秒时间戳（顶层必须字段）
+                    "payload": {
+                        "client_type": "agent_hook"
+                    }
+                }
+                await websocket.send(json.dumps(register_msg))
+                logger.debug("已发送注册消息: %s", register_msg)
+                
+                # 接收注册确认（1秒超时）
+                response = await asyncio.wait_for(websocket.recv(), timeout=1.0)
+                logger.debug("注册响应: %s", response)
+                
+                # 2. 发送消息
+                await websocket.send(json.dumps(message_data))
     
     def _summarize_input(self) -> Dict[str, Any]:
         """生成输入数据的摘要（避免发送过大数据）"""
@@ -277,36 +567,49 @@ class AgentHookHandler:
         """
         raise NotImplementedError("子类需要实现 process() 方法")
     
-    def run(self) -> int:
+    def run(self, stdin: Optional[TextIO] = None, stdout: Optional[TextIO] = None) -> int:
         """
         运行 hook
         
+        Args:
+            stdin: 输入流（默认 sys.stdin；hook daemon 内运行时传入请求内容）
+            stdout: 输出流（默认 sys.stdout）
+        
         Returns:
             退出码（0 表示成功）
         """
         start_time = datetime.now()
+        self._stdin = stdin
+        self._stdout = stdout
+        
+        # ORTENSIA_HOOK_ASYNC_NOTIFY=0 可关闭延迟投递（通知在决策前同步发送）
+        if self.defer_notifications and os.environ.get("ORTENSIA_HOOK_ASYNC_NOTIFY", "1") != "0":
+            self._deferred = []
         
         try:
             # 读取输入
-            logger.info(f"⏳ 步骤 1/3: 读取输入数据...")
+            logger.info("⏳ 步骤 1/3: 读取输入数据...")
             self.read_input()
             
             # 处理
-            logger.info(f"⏳ 步骤 2/3: 执行 Hook 逻辑...")
+            logger.info("⏳ 步骤 2/3: 执行 Hook 逻辑...")
             output = self.process()
             
             # 输出响应
-            logger.info(f"⏳ 步骤 3/3: 输出响应...")
+            logger.info("⏳ 步骤 3/3: 输出响应...")
             if output:
                 self.write_output(output)
             else:
                 logger.info("   ℹ️  无需返回响应（审计类 hook）")
             
+            # 响应已写出，再投递通知
+            self._flush_deferred()
+            
             # 执行总结
             elapsed = (datetime.now() - start_time).total_seconds()
             logger.info("=" * 70)
-            logger.info(f"✅ [{self.hook_name}] Hook 执行成功")
-            logger.info(f"⏱️  执行耗时: {elapsed:.3f} 秒")
+            logger.info("✅ [%s] Hook 执行成功", self.hook_name)
+            logger.info("⏱️  执行耗时: %.3f 秒", elapsed)
             logger.info("=" * 70)
             logger.info("")  # 空行分隔
             
@@ -315,12 +618,13 @@ class AgentHookHandler:
         except Exception as e:
             elapsed = (datetime.now() - start_time).total_seconds()
             logger.error("=" * 70)
-            logger.error(f"❌ [{self.hook_name}] Hook 执行失败")
-            logger.error(f"⏱️  执行耗时: {elapsed:.3f} 秒")
-            logger.error(f"错误: {e}")
+            logger.error("❌ [%s] Hook 执行失败", self.hook_name)
+            logger.error("⏱️  执行耗时: %.3f 秒", elapsed)
+            logger.error("错误: %s", e)
             logger.exception("详细错误信息:")
             logger.error("=" * 70)
             logger.error("")  # 空行分隔
+            self._flush_deferred()
             return 1
 
 
@@ -328,8 +632,12 @@ class PermissionHook(AgentHookHandler):
     """
     需要返回权限决策的 Hook 基类
     (beforeShellExecution, beforeMCPExecution, beforeReadFile)
+    
+    决策先写到 stdout，通知在之后投递，Cursor 不必等待网络往返。
     """
     
+    defer_notifications = True
+    
     def make_decision(self) -> tuple[str, Optional[str], Optional[str]]:
         """
         做出权限决策（子类需要实现）
@@ -349,12 +657,13 @@ class PermissionHook(AgentHookHandler):
         permission, user_msg, agent_msg = self.make_decision()
         
         # 详细日志
-        logger.info(f"🔐 权限决策结果:")
-        logger.info(f"   • 决策: {permission}")
-        if user_msg:
-            logger.info(f"   • 用户消息: {user_msg}")
-        if agent_msg:
-            logger.info(f"   • Agent 消息: {agent_msg}")
+        if _log_details_enabled():
+            logger.info("🔐 权限决策结果:")
+            logger.info("   • 决策: %s", permission)
+            if user_msg:
+                logger.info("   • 用户消息: %s", user_msg)
+            if agent_msg:
+                logger.info("   • Agent 消息: %s", agent_msg)
         
         output = {"permission": permission}
         
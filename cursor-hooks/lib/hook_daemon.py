@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+"""
+Cursor Agent Hook 常驻 Daemon
+
+每次 hook 调用都新建 WebSocket、发送 register、等待 ack 再发送消息，
+在 Agent 高频调用 hook 时这部分开销占了 hook 耗时的大头。
+
+Daemon 在本地常驻，只维护一条已注册（agent_hook 角色）的中央服务器连接；
+hook 脚本通过 Unix socket 把事件（一行 JSON）交给 daemon 后立即返回。
+daemon 不可用时 hook 会把通知写入 spool 目录，daemon 启动后（及运行期间定期）补发。
+
+Daemon 同时是常驻的 hook worker：hooks/*.py 与权限规则在启动时预先导入/编译，
+run_hook.py 把 hook 的 stdin 转交给 daemon 执行，再把 stdout 原样写回 Cursor，
+省去每次调用时的解释器启动和 websockets/asyncio/logging 等模块导入。
+
+本地协议（每行一个 JSON 请求）：
+    {"op": "event", "message": {<Ortensia 消息>}}           # 不回复
+    {"op": "run", "hook": "<hook 脚本路径>", "input": "<stdin>", "env": {<调用方环境变量>}, "cwd": "<调用方工作目录>"}
+        → {"stdout": "<hook 输出>", "exit_code": 0}         # 或 {"error": "..."}
+        → {"cold": "<原因>"}                                 # 该次调用不适合在 daemon 内执行，由 runner 冷启动
+
+daemon 内执行的 hook 与冷启动的行为保持一致：
+  - hook 读取的环境变量（ORTENSIA_* / CURSOR_AGENT_* / WS_SERVER）与 daemon 启动时的取值不同时
+    （日志配置、服务器地址等在导入时就已确定，无法按次切换），回复 cold
+  - warm_capable = False 的 hook（需要调用方 PATH 的外部工具，如 afterFileEdit）回复 cold
+  - 工作目录按调用方设置；hook 在单个线程中串行执行，切换目录不会互相影响
+
+hooks/、lib/ 下的文件或权限规则文件发生变化（重新部署）时，daemon 不再执行任何 hook：
+当次调用回复 cold，随后 daemon 退出，下一次调用由 runner 拉起加载新代码的 daemon。
+
+Usage:
+  python hook_daemon.py                # 后台常驻（通常由 hook 自动拉起）
+  python hook_daemon.py --drain-spool  # 一次性补发 spool 后退出（Windows 回退路径）
+  python hook_daemon.py --stop         # 停止正在运行的 daemon（deploy.sh 部署前调用）
+
+环境变量：
+  ORTENSIA_HOOK_DAEMON_SOCKET  Unix socket 路径（默认 $TMPDIR/ortensia-hook-daemon-<uid>.sock）
+  ORTENSIA_HOOK_DAEMON_IDLE    空闲多少秒后自动退出（默认 1800，0 表示不退出）
+  ORTENSIA_HOOK_DAEMON_QUEUE   待发送队列上限（默认 1000，满时丢弃最旧的事件）
+"""
+
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import io
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Dict, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from agent_hook_handler import (  # noqa: E402
+    AgentHookHandler,
+    _resolve_ws_server,
+    drain_spool,
+    enable_log_rotation,
+    spool_message,
+    hook_daemon_socket_path,
+    logger,
+    set_event_sink,
+)
+
+LIB_DIR = Path(__file__).resolve().parent
+HOOKS_DIR = LIB_DIR.parent / "hooks"
+
+# hook 会读取的环境变量；调用方与 daemon 的取值不同时该次调用改为冷启动
+HOOK_ENV_PREFIXES = ("ORTENSIA_", "CURSOR_AGENT_")
+HOOK_ENV_VARS = ("WS_SERVER",)
+RUNNER_ONLY_ENV_VARS = ("ORTENSIA_HOOK_WARM", "CURSOR_AGENT_PYTHON")  # 只影响 runner 本身
+
+HEARTBEAT_INTERVAL = 30  # 秒
+SPOOL_POLL_INTERVAL = 2  # 秒
+MAX_RECONNECT_DELAY = 30  # 秒
+
+
+def hook_environment(environ: Dict[str, str]) -> Dict[str, str]:
+    """环境中会影响 hook 行为的部分"""
+    return {
+        key: value
+        for key, value in environ.items()
+        if (key.startswith(HOOK_ENV_PREFIXES) or key in HOOK_ENV_VARS) and key not in RUNNER_ONLY_ENV_VARS
+    }
+
+
+def source_fingerprint() -> Dict[str, int]:
+    """daemon 加载过的代码和规则文件的 mtime（文件增删也会改变结果）"""
+    paths = [*HOOKS_DIR.glob("*.py"), *LIB_DIR.glob("*.py"), *LIB_DIR.glob("*.json")]
+    rules = os.environ.get("CURSOR_AGENT_RULES")
+    if rules:
+        paths.append(Path(rules).expanduser())
+    fingerprint = {}
+    for path in paths:
+        try:
+            fingerprint[str(path)] = path.stat().st_mtime_ns
+        except OSError:
+            fingerprint[str(path)] = -1
+    return fingerprint
+
+
+class HookDaemon:
+    """持有一条到中央服务器的长连接，串行转发 hook 交来的事件"""
+
+    def __init__(
+        self,
+        ws_server: str,
+        socket_path: Path,
+        idle_timeout: float = 1800,
+        queue_size: int = 1000,
+    ):
+        self.ws_server = ws_server
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        # 不能用 "hook-" 前缀：服务端把 hook-<x> 形式的 ID 当作 conversation_id 为 x 的 hook
+        self.client_id = f"hookd-{os.getpid()}"
+
+        self._pending: Deque[Dict[str, Any]] = deque(maxlen=queue_size)
+        self._wakeup = asyncio.Event()
+        self._websocket = None
+        self._last_activity = time.monotonic()
+        self._stopping = asyncio.Event()
+
+        self.stats = {"received": 0, "sent": 0, "dropped": 0, "reconnects": 0, "hook_runs": 0, "cold_redirects": 0}
+        self._hook_classes: Dict[Path, Tuple[int, type]] = {}  # script -> (mtime_ns, hook 类)
+        self._sources = source_fingerprint()
+        self._hook_env = hook_environment(dict(os.environ))
+        # 串行执行 hook：每次调用按调用方切换工作目录，不能并发
+        self._hook_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hook")
+
+    # ------------------------------------------------------------------
+    # 本地 socket
+    # ------------------------------------------------------------------
+
+    def enqueue(self, message: Dict[str, Any]) -> None:
+        """放入待发送队列（满时 deque 自动丢弃最旧的一条）"""
+        if len(self._pending) == self._pending.maxlen:
+            self.stats["dropped"] += 1
+        self._pending.append(message)
+        self.stats["received"] += 1
+        self._last_activity = time.monotonic()
+        self._wakeup.set()
+
+    async def _handle_local(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"⚠️  [daemon] 无法解析本地请求: {e}")
+                    continue
+                await self._dispatch(request, writer)
+        except Exception as e:
+            logger.warning(f"⚠️  [daemon] 本地连接处理失败: {e}")
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
+        op = request.get("op")
+        if op == "event":
+            message = request.get("message")
+            if isinstance(message, dict):
+                self.enqueue(message)
+        elif op == "run":
+            response = await self._run_hook(request)
+            writer.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+            await writer.drain()
+        else:
+            logger.warning(f"⚠️  [daemon] 未知请求: {op}")
+
+    # ------------------------------------------------------------------
+    # 常驻 hook worker
+    # ------------------------------------------------------------------
+
+    def _load_hook_class(self, script: Path) -> type:
+        """导入 hook 脚本并找出其中定义的 AgentHookHandler 子类（按脚本 mtime 缓存）"""
+        mtime = script.stat().st_mtime_ns
+        cached = self._hook_classes.get(script)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        spec = importlib.util.spec_from_file_location(f"ortensia_hook_{script.stem}", script)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        for obj in vars(module).values():
+            if (
+                isinstance(obj, type)
+                and issubclass(obj, AgentHookHandler)
+                and obj.__module__ == module.__name__
+            ):
+                self._hook_classes[script] = (mtime, obj)
+                return obj
+        raise LookupError(f"{script.name} 中没有 hook 类")
+
+    def preload_hooks(self) -> None:
+        """预先导入全部 hook 并编译权限规则，避免第一次调用时的冷启动"""
+        for script in sorted(HOOKS_DIR.glob("*.py")):
+            try:
+                self._load_hook_class(script)
+            except Exception as e:
+                logger.warning(f"⚠️  [daemon] 预加载 {script.name} 失败: {e}")
+        try:
+            from policy_engine import get_policy_engine
+
+            get_policy_engine()
+        except Exception as e:
+            logger.warning(f"⚠️  [daemon] 预编译权限规则失败: {e}")
+        logger.info(f"🔥 [daemon] 已预加载 {len(self._hook_classes)} 个 hook")
+
+    def _check_sources(self) -> bool:
+        """hook 代码或权限规则被改动时让 daemon 退出；返回 True 表示已过期"""
+        if self._stopping.is_set():
+            return True
+        if source_fingerprint() == self._sources:
+            return False
+        logger.info("🔄 [daemon] hook 代码或权限规则已更新，退出以便重新加载")
+        self._stopping.set()
+        return True
+
+    async def _run_hook(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        self._last_activity = time.monotonic()
+        # 已导入的 lib 模块和编译好的规则无法原地替换，过期后一律交给冷启动
+        if self._check_sources():
+            self.stats["cold_redirects"] += 1
+            return {"cold": "hook 代码或权限规则已更新"}
+        try:
+            script = Path(request.get("hook") or "").resolve()
+        except OSError as e:
+            return {"error": str(e)}
+        # 只执行 daemon 自己的 hooks 目录中的脚本
+        if script.parent != HOOKS_DIR or script.suffix != ".py":
+            return {"error": f"不支持的 hook: {script}"}
+
+        try:
+            hook_cls = self._load_hook_class(script)
+        except Exception as e:
+            return {"error": f"加载 hook 失败: {e}"}
+
+        cold_reason = self._cold_reason(hook_cls, script, request.get("env"))
+        if cold_reason:
+            self.stats["cold_redirects"] += 1
+            logger.debug(f"[daemon] {script.name} 改为冷启动: {cold_reason}")
+            return {"cold": cold_reason}
+
+        cwd = request.get("cwd")
+
+        def run_in_thread() -> Dict[str, Any]:
+            previous_cwd = os.getcwd()
+            if cwd:
+                try:
+                    os.chdir(cwd)
+                except OSError as e:
+                    logger.warning(f"⚠️  [daemon] 无法切换到调用方工作目录 {cwd}: {e}")
+            try:
+                stdout = io.StringIO()
+                exit_code = hook_cls().run(stdin=io.StringIO(request.get("input") or ""), stdout=stdout)
+                return {"stdout": stdout.getvalue(), "exit_code": exit_code}
+            finally:
+                # 工作目录是整个进程共享的，执行完恢复
+                os.chdir(previous_cwd)
+
+        self.stats["hook_runs"] += 1
+        return await asyncio.get_running_loop().run_in_executor(self._hook_executor, run_in_thread)
+
+    def _cold_reason(self, hook_cls: type, script: Path, env: Optional[Dict[str, str]]) -> Optional[str]:
+        """该次调用不能在 daemon 内执行的原因（None 表示可以）"""
+        if not getattr(hook_cls, "warm_capable", True):
+            return f"{script.name} 需要调用方的 PATH / 环境"
+        if env is None:  # 旧版 runner 不发送环境
+            return None
+        caller_env = hook_environment(env)
+        changed = sorted(
+            key for key in caller_env.keys() | self._hook_env.keys()
+            if caller_env.get(key) != self._hook_env.get(key)
+        )
+        if changed:
+            return f"环境变量与 daemon 不同: {', '.join(changed)}"
+        return None
+
+    # ------------------------------------------------------------------
+    # 中央服务器连接
+    # ------------------------------------------------------------------
+
+    async def _connect(self):
+        import websockets
+
+        websocket = await websockets.connect(self.ws_server, open_timeout=5, close_timeout=1)
+        register_msg = {
+            "type": "register",
+            "from": self.client_id,
+            "to": None,
+            "timestamp": int(time.time() * 1000),
+            "payload": {
+                "client_type": "agent_hook",
+                "pid": os.getpid(),
+                "daemon": True,
+            },
+        }
+        await websocket.send(json.dumps(register_msg))
+        await asyncio.wait_for(websocket.recv(), timeout=5)
+        logger.info(f"✅ [daemon] 已注册到中央服务器: {self.ws_server} ({self.client_id})")
+        return websocket
+
+    async def _drain_incoming(self, websocket) -> None:
+        """丢弃服务器推送给 daemon 的消息（register_ack / heartbeat_ack / 广播），防止缓冲区堆积"""
+        async for _ in websocket:
+            pass
+
+    async def _heartbeat(self, websocket) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            await websocket.send(json.dumps({
+                "type": "heartbeat",
+                "from": self.client_id,
+                "to": "server",
+                "timestamp": int(time.time()),
+                "payload": {},
+            }))
+
+    async def _sender_loop(self) -> None:
+        delay = 1
+        while not self._stopping.is_set():
+            try:
+                websocket = await self._connect()
+            except Exception as e:
+                logger.warning(f"⚠️  [daemon] 连接中央服务器失败: {e}，{delay}s 后重试")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                self.stats["reconnects"] += 1
+                continue
+
+            delay = 1
+            self._websocket = websocket
+            side_tasks = [
+                asyncio.create_task(self._drain_incoming(websocket)),
+                asyncio.create_task(self._heartbeat(websocket)),
+            ]
+            try:
+                while True:
+                    if not self._pending:
+                        self._wakeup.clear()
+                        waiter = asyncio.create_task(self._wakeup.wait())
+                        done, _ = await asyncio.wait(
+                            [waiter, *side_tasks], return_when=asyncio.FIRST_COMPLETED
+                        )
+                        if waiter not in done:
+                            waiter.cancel()
+                            raise ConnectionError("中央服务器连接已断开")
+                        continue
+
+                    message = self._pending[0]
+                    await websocket.send(json.dumps(message, ensure_ascii=False))
+                    # 发送成功后才出队，断线时保留未发送的事件
+                    self._pending.popleft()
+                    self.stats["sent"] += 1
+            except Exception as e:
+                logger.warning(f"⚠️  [daemon] 连接中断: {e}")
+                self.stats["reconnects"] += 1
+            finally:
+                self._websocket = None
+                for task in side_tasks:
+                    if task.done() and not task.cancelled():
+                        task.exception()  # 取走异常，避免 "never retrieved" 警告
+                    task.cancel()
+                try:
+                    await websocket.close()
+                except Exception:
+                    pass
+
+    async def _spool_loop(self) -> None:
+        """补发 hook 在 daemon 不可用时写入 spool 的通知"""
+        while True:
+            for message in drain_spool():
+                self.enqueue(message)
+            await asyncio.sleep(SPOOL_POLL_INTERVAL)
+
+    async def flush_spool_once(self) -> int:
+        """一次性：连接、发送 spool 中全部通知、断开"""
+        messages = drain_spool()
+        if not messages:
+            return 0
+        sent = 0
+        try:
+            websocket = await self._connect()
+            try:
+                for message in messages:
+                    await websocket.send(json.dumps(message, ensure_ascii=False))
+                    sent += 1
+            finally:
+                await websocket.close()
+        except Exception:
+            # 未发出的通知放回 spool，等下次补发
+            for message in messages[sent:]:
+                spool_message(message)
+            raise
+        logger.info(f"📤 [daemon] 已补发 {len(messages)} 条 spool 通知")
+        return len(messages)
+
+    async def _source_watch(self) -> None:
+        """空闲时也定期检查，部署后尽快退出"""
+        while not self._check_sources():
+            await asyncio.sleep(SPOOL_POLL_INTERVAL)
+
+    async def _idle_watchdog(self) -> None:
+        if not self.idle_timeout:
+            return
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            idle = time.monotonic() - self._last_activity
+            if idle >= self.idle_timeout and not self._pending:
+                logger.info(f"💤 [daemon] 空闲 {int(idle)}s，退出")
+                self._stopping.set()
+                return
+
+    # ------------------------------------------------------------------
+    # 主流程
+    # ------------------------------------------------------------------
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        # daemon 内运行的 hook 发出的通知直接进入发送队列
+        set_event_sink(lambda message: loop.call_soon_threadsafe(self.enqueue, message))
+        loop.add_signal_handler(signal.SIGTERM, self._stopping.set)
+        self.preload_hooks()
+
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        # socket 一创建就必须是 0600：先 bind 再 chmod 会留出其他本地用户连进来提交 run 请求的窗口
+        old_umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self._handle_local, path=str(self.socket_path))
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0o600)
+        logger.info(f"🎧 [daemon] 监听本地 socket: {self.socket_path}")
+
+        tasks = [
+            asyncio.create_task(self._sender_loop()),
+            asyncio.create_task(self._spool_loop()),
+            asyncio.create_task(self._idle_watchdog()),
+            asyncio.create_task(self._source_watch()),
+        ]
+        try:
+            async with server:
+                await self._stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            try:
+                self.socket_path.unlink()
+            except OSError:
+                pass
+            logger.info(f"📊 [daemon] 统计: {self.stats}")
+
+
+def _acquire_single_instance_lock(socket_path: Path):
+    """文件锁保证每个 socket 只有一个 daemon；拿不到锁返回 None。锁文件中记录持有者的 pid"""
+    import fcntl
+
+    # 不能用 "w" 打开：抢锁失败的进程会把正在运行的 daemon 记录的 pid 清空
+    lock_file = open(f"{socket_path}.lock", "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    lock_file.truncate(0)
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    return lock_file
+
+
+def stop_running_daemon(socket_path: Path, timeout: float = 5.0) -> bool:
+    """向持有锁的 daemon 发送 SIGTERM 并等待它释放锁；没有运行中的 daemon 时返回 False"""
+    lock_path = Path(f"{socket_path}.lock")
+    if not lock_path.exists():
+        return False
+    lock = _acquire_single_instance_lock(socket_path)
+    if lock is not None:
+        lock.close()
+        return False
+    try:
+        pid = int(lock_path.read_text().strip() or 0)
+    except (OSError, ValueError):
+        pid = 0
+    if pid <= 0:
+        logger.warning(f"⚠️  无法从 {lock_path} 读取 daemon pid")
+        return False
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return False
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        lock = _acquire_single_instance_lock(socket_path)
+        if lock is not None:
+            lock.close()
+            logger.info(f"🛑 已停止 hook daemon (pid {pid})")
+            return True
+    logger.warning(f"⚠️  hook daemon (pid {pid}) 在 {timeout}s 内没有退出")
+    return True
+
+
+def main(argv: list[str]) -> int:
+    if "--drain-spool" in argv:
+        daemon = HookDaemon(ws_server=_resolve_ws_server(), socket_path=hook_daemon_socket_path())
+        try:
+            asyncio.run(daemon.flush_spool_once())
+        except Exception as e:
+            logger.error(f"❌ 补发 spool 失败: {e}")
+            return 1
+        return 0
+
+    if os.name == "nt":
+        logger.error("❌ hook daemon 依赖 Unix socket，Windows 上请使用直连模式")
+        return 1
+
+    socket_path = hook_daemon_socket_path()
+    if "--stop" in argv:
+        stop_running_daemon(socket_path)
+        return 0
+
+    lock = _acquire_single_instance_lock(socket_path)
+    if lock is None:
+        logger.debug("hook daemon 已在运行，退出")
+        return 0
+    enable_log_rotation()  # 持有单实例锁，日志只由这个进程轮转
+
+    daemon = HookDaemon(
+        ws_server=_resolve_ws_server(),
+        socket_path=socket_path,
+        idle_timeout=float(os.environ.get("ORTENSIA_HOOK_DAEMON_IDLE", "1800")),
+        queue_size=int(os.environ.get("ORTENSIA_HOOK_DAEMON_QUEUE", "1000")),
+    )
+    try:
+        asyncio.run(daemon.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lock.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv))
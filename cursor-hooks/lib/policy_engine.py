@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+权限规则引擎（beforeShellExecution / beforeReadFile 共用）
+
+- 规则从 JSON 配置加载（默认 lib/permission_rules.json，可用 CURSOR_AGENT_RULES 覆盖）
+- 每个规则集编译成一个组合正则，单次扫描即可得到最高严重级别的命中
+- 按输入文本缓存判定结果（LRU），常驻进程中重复的命令/路径不再匹配
+
+组合正则的写法：每条规则包成命名分组 (?P<rN>pattern)，按严重级别从高到低排列成一个分支。
+同一起点上先命中的分支就是该起点最严重的规则；每次命中后从命中起点 +1 继续搜索
+（而不是从命中结尾），这样被低级别长匹配覆盖的高级别规则也不会漏掉；
+遇到最高级别即可提前结束。
+
+包进组合正则后规则内的分组会被重新编号，所以使用编号反向引用（\\1）、条件分组（(?(1)...)）
+或命名分组的 pattern 不参与合并，而是单独编译、在组合扫描之后逐条匹配（结果相同，只是慢一些）。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# 判定严重级别（越大越严格）
+VERDICT_SEVERITY = {"allow": 0, "ask": 1, "deny": 2}
+
+DEFAULT_RULES_FILE = Path(__file__).parent / "permission_rules.json"
+DEFAULT_CACHE_SIZE = 1024
+
+# 依赖分组编号/名称的写法：反向引用 \N（前面的反斜杠为偶数个）、条件分组 (?(N)...)、命名分组/引用 (?P
+# 字符类中的八进制转义 [\1] 也会被当作命中，代价只是该规则单独编译
+_GROUP_DEPENDENT = re.compile(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(|\(\?P")
+
+
+class PolicyConfigError(ValueError):
+    """规则配置无效"""
+
+
+@dataclass(frozen=True)
+class Rule:
+    """单条规则"""
+    name: str
+    pattern: str
+    verdict: str
+    description: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class PolicyMatch:
+    """判定结果；rule 为 None 表示未命中任何规则"""
+    verdict: str
+    rule: Optional[Rule] = None
+
+
+ALLOW = PolicyMatch(verdict="allow")
+
+
+class RuleSet:
+    """一组规则编译成的单个组合匹配器"""
+
+    def __init__(self, name: str, rules: List[Rule], ignore_case: bool = True,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        self.name = name
+        # 稳定排序：同级别保持配置中的顺序
+        self.rules = sorted(rules, key=lambda r: -VERDICT_SEVERITY[r.verdict])
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, PolicyMatch]" = OrderedDict()
+        # hook daemon 在单个线程中串行执行 hook；锁只是让 RuleSet 被多线程共用时缓存不被破坏
+        self._cache_lock = threading.Lock()
+        self._max_severity = VERDICT_SEVERITY[self.rules[0].verdict] if self.rules else 0
+
+        flags = re.IGNORECASE if ignore_case else 0
+        self._combined_rules = [r for r in self.rules if not _GROUP_DEPENDENT.search(r.pattern)]
+        # 不能合并的规则单独编译（保持严重级别顺序）
+        self._standalone = []
+        for rule in self.rules:
+            if _GROUP_DEPENDENT.search(rule.pattern):
+                try:
+                    self._standalone.append((rule, re.compile(rule.pattern, flags)))
+                except re.error as e:
+                    raise PolicyConfigError(f"规则 {name}.{rule.name} 编译失败: {e}") from e
+        if self._combined_rules:
+            combined = "|".join(f"(?P<r{i}>{rule.pattern})" for i, rule in enumerate(self._combined_rules))
+            try:
+                self._matcher = re.compile(combined, flags)
+            except re.error as e:
+                raise PolicyConfigError(f"规则集 {name} 编译失败: {e}") from e
+        else:
+            self._matcher = None
+
+    def evaluate(self, text: str) -> PolicyMatch:
+        """返回 text 命中的最高严重级别规则"""
+        with self._cache_lock:
+            cached = self._cache.get(text)
+            if cached is not None:
+                self._cache.move_to_end(text)
+                return cached
+
+        result = self._scan(text)
+
+        with self._cache_lock:
+            self._cache[text] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def _scan(self, text: str) -> PolicyMatch:
+        if not text:
+            return ALLOW
+        best: Optional[Rule] = None
+        best_severity = -1
+        pos = 0
+        while self._matcher is not None:
+            m = self._matcher.search(text, pos)
+            if m is None:
+                break
+            rule = self._combined_rules[int(m.lastgroup[1:])]
+            severity = VERDICT_SEVERITY[rule.verdict]
+            if severity > best_severity:
+                best, best_severity = rule, severity
+                if severity == self._max_severity:
+                    break
+            pos = m.start() + 1
+        for rule, matcher in self._standalone:
+            if VERDICT_SEVERITY[rule.verdict] <= best_severity:
+                break  # 按严重级别排序，后面的不可能更严重
+            if matcher.search(text):
+                best, best_severity = rule, VERDICT_SEVERITY[rule.verdict]
+                break
+        if best is None:
+            return ALLOW
+        return PolicyMatch(verdict=best.verdict, rule=best)
+
+
+class PolicyEngine:
+    """所有规则集的入口"""
+
+    def __init__(self, rulesets: Dict[str, RuleSet]):
+        self.rulesets = rulesets
+
+    def evaluate(self, ruleset: str, text: str) -> PolicyMatch:
+        rs = self.rulesets.get(ruleset)
+        if rs is None:
+            return ALLOW
+        return rs.evaluate(text)
+
+    @classmethod
+    def from_file(cls, path: Path, cache_size: int = DEFAULT_CACHE_SIZE) -> "PolicyEngine":
+        try:
+            config = json.loads(Path(path).read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:  # JSONDecodeError / UnicodeDecodeError 都是 ValueError
+            raise PolicyConfigError(f"无法读取规则配置 {path}: {e}") from e
+        return cls.from_dict(config, cache_size=cache_size)
+
+    @classmethod
+    def from_dict(cls, config: dict, cache_size: int = DEFAULT_CACHE_SIZE) -> "PolicyEngine":
+        """任何结构或类型错误都以 PolicyConfigError 抛出（hook 只处理这一种异常）"""
+        _expect_type(config, dict, "规则配置")
+        rulesets = {}
+        for rs_name, rs_config in _expect_type(_or_default(config.get("rulesets"), {}), dict, "rulesets").items():
+            _expect_type(rs_config, dict, f"规则集 {rs_name}")
+            rules = []
+            for i, raw in enumerate(_expect_type(_or_default(rs_config.get("rules"), []), list, f"{rs_name}.rules")):
+                _expect_type(raw, dict, f"规则 {rs_name}[{i}]")
+                verdict = raw.get("verdict")
+                if verdict not in VERDICT_SEVERITY:
+                    raise PolicyConfigError(f"规则 {rs_name}[{i}] 的 verdict 无效: {verdict}")
+                if not raw.get("pattern"):
+                    raise PolicyConfigError(f"规则 {rs_name}[{i}] 缺少 pattern")
+                _expect_type(raw["pattern"], str, f"规则 {rs_name}[{i}] 的 pattern")
+                _expect_type(raw.get("name") or "", str, f"规则 {rs_name}[{i}] 的 name")
+                rules.append(Rule(
+                    name=raw.get("name") or f"{rs_name}_{i}",
+                    pattern=raw["pattern"],
+                    verdict=verdict,
+                    description=raw.get("description"),
+                ))
+            rulesets[rs_name] = RuleSet(
+                rs_name,
+                rules,
+                ignore_case=_expect_type(rs_config.get("ignore_case", True), bool, f"{rs_name}.ignore_case"),
+                cache_size=cache_size,
+            )
+        return cls(rulesets)
+
+
+def _expect_type(value, expected: type, what: str):
+    if not isinstance(value, expected):
+        raise PolicyConfigError(f"{what} 应为 {expected.__name__}，实际是 {type(value).__name__}")
+    return value
+
+
+def _or_default(value, default):
+    """缺省（None）时用默认值；不用 `or`，以免把 [] / "" 之类的错误类型当成缺省"""
+    return default if value is None else value
+
+
+_engine: Optional[PolicyEngine] = None
+
+
+def get_policy_engine() -> PolicyEngine:
+    """进程内共享的规则引擎（首次调用时加载并编译）"""
+    global _engine
+    if _engine is None:
+        path = os.environ.get("CURSOR_AGENT_RULES")
+        _engine = PolicyEngine.from_file(Path(path).expanduser() if path else DEFAULT_RULES_FILE)
+    return _engine
@@ -13,15 +13,34 @@ Notes:
 - We forward stdin/stdout/stderr so Cursor can communicate with the hook.
 - You can override the python interpreter via env var:
     CURSOR_AGENT_PYTHON=C:\\Path\\to\\python.exe
+- Warm mode (default where Unix sockets are available): the hook's stdin is
+  handed to the resident hook daemon (lib/hook_daemon.py), which already has
+  the handlers imported and the permission rules compiled, and its stdout is
+  relayed back. This runner itself only imports stdlib modules. If the daemon
+  is not running it is started in the background and this call falls back to
+  spawning the hook interpreter as before.
+  The request carries this process's environment and cwd. The daemon runs the
+  hook in the caller's cwd, and answers "cold" (run it here instead) when the
+  hook-relevant environment (ORTENSIA_* / CURSOR_AGENT_* / WS_SERVER) differs
+  from its own or the hook needs the caller's PATH (e.g. afterFileEdit runs
+  black / prettier).
+    ORTENSIA_HOOK_WARM=0   always spawn the hook interpreter (cold mode)
 """
 
 from __future__ import annotations
 
+import json
 import os
-import subprocess
+import socket
 import sys
+import tempfile
 from pathlib import Path
 
+# 与 lib/agent_hook_handler.py 中的 hook_daemon_socket_path() 保持一致
+# （runner 不导入 handler，避免加载 logging/asyncio 等模块）
+WARM_CONNECT_TIMEOUT = 0.2  # 秒
+WARM_RESPONSE_TIMEOUT = 60  # 秒（afterFileEdit 可能会跑格式化工具）
+
 
 def _pick_python() -> str:
     override = os.environ.get("CURSOR_AGENT_PYTHON") or os.environ.get("VENV_PYTHON")
@@ -30,28 +49,115 @@ def _pick_python() -> str:
     return sys.executable
 
 
-def main(argv: list[str]) -> int:
-    if len(argv) < 2:
-        print("Usage: run_hook.py <hook_script.py>", file=sys.stderr)
-        return 2
+def _daemon_socket_path() -> Path:
+    override = os.environ.get("ORTENSIA_HOOK_DAEMON_SOCKET")
+    if override:
+        return Path(override).expanduser()
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return Path(tempfile.gettempdir()) / f"ortensia-hook-daemon-{uid}.sock"
 
-    hook_script = Path(argv[1]).expanduser()
-    if not hook_script.exists():
-        print(f"run_hook.py: hook script not found: {hook_script}", file=sys.stderr)
-        return 2
 
-    py = _pick_python()
-    cmd = [py, str(hook_script)]
+def _warm_enabled() -> bool:
+    return (
+        hasattr(socket, "AF_UNIX")
+        and os.name != "nt"
+        and os.environ.get("ORTENSIA_HOOK_WARM", "1") != "0"
+        and os.environ.get("ORTENSIA_HOOK_DAEMON", "auto").strip().lower() != "off"
+    )
+
+
+def _run_warm(hook_script: Path, input_text: str) -> dict | None:
+    """
+    把 hook 交给常驻 daemon 执行。
+
+    Returns:
+        daemon 的响应（含 stdout / exit_code，或要求冷启动执行的 cold）；daemon 不可用时返回 None
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except OSError:
+        return None
+    with sock:
+        try:
+            sock.settimeout(WARM_CONNECT_TIMEOUT)
+            sock.connect(str(_daemon_socket_path()))
+        except OSError:
+            return None
 
+        request = {
+            "op": "run",
+            "hook": str(hook_script.resolve()),
+            "input": input_text,
+            "env": dict(os.environ),
+            "cwd": os.getcwd(),
+        }
+        try:
+            sock.settimeout(WARM_RESPONSE_TIMEOUT)
+            sock.sendall(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if chunk.endswith(b"\n"):
+                    break
+            response = json.loads(b"".join(chunks) or b"null")
+        except (OSError, ValueError) as e:
+            print(f"run_hook.py: warm dispatch failed, falling back: {e}", file=sys.stderr)
+            return None
+
+    if not isinstance(response, dict) or "error" in response:
+        error = response.get("error") if isinstance(response, dict) else response
+        print(f"run_hook.py: hook daemon rejected request, falling back: {error}", file=sys.stderr)
+        return None
+    return response
+
+
+def _spawn_daemon(py: str, hook_script: Path) -> None:
+    import subprocess
+
+    daemon_script = hook_script.resolve().parent.parent / "lib" / "hook_daemon.py"
+    if not daemon_script.exists():
+        return
     try:
-        # Important: forward streams unchanged for Cursor hooks protocol.
-        completed = subprocess.run(
-            cmd,
-            stdin=sys.stdin,
-            stdout=sys.stdout,
-            stderr=sys.stderr,
-            check=False,
+        subprocess.Popen(
+            [py, str(daemon_script)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            start_new_session=True,
         )
+    except Exception:
+        pass
+
+
+def _run_cold(py: str, hook_script: Path, input_text: str | None) -> int:
+    import subprocess
+
+    cmd = [py, str(hook_script)]
+    try:
+        if input_text is None:
+            # Important: forward streams unchanged for Cursor hooks protocol.
+            completed = subprocess.run(
+                cmd,
+                stdin=sys.stdin,
+                stdout=sys.stdout,
+                stderr=sys.stderr,
+                check=False,
+            )
+        else:
+            # stdin was already consumed by the warm attempt; replay it.
+            completed = subprocess.run(
+                cmd,
+                input=input_text,
+                stdout=sys.stdout,
+                stderr=sys.stderr,
+                text=True,
+                encoding="utf-8",
+                check=False,
+            )
         return int(completed.returncode or 0)
     except FileNotFoundError:
         print(f"run_hook.py: python interpreter not found: {py}", file=sys.stderr)
@@ -61,6 +167,34 @@ def main(argv: list[str]) -> int:
         return 1
 
 
+def main(argv: list[str]) -> int:
+    if len(argv) < 2:
+        print("Usage: run_hook.py <hook_script.py>", file=sys.stderr)
+        return 2
+
+    hook_script = Path(argv[1]).expanduser()
+    if not hook_script.exists():
+        print(f"run_hook.py: hook script not found: {hook_script}", file=sys.stderr)
+        return 2
+
+    py = _pick_python()
+
+    if not _warm_enabled():
+        return _run_cold(py, hook_script, None)
+
+    input_text = sys.stdin.read()
+    response = _run_warm(hook_script, input_text)
+    if response is not None and "cold" in response:
+        # daemon 在运行，只是这次调用需要调用方的环境
+        return _run_cold(py, hook_script, input_text)
+    if response is not None:
+        sys.stdout.write(response.get("stdout") or "")
+        sys.stdout.flush()
+        return int(response.get("exit_code") or 0)
+
+    _spawn_daemon(py, hook_script)
+    return _run_cold(py, hook_script, input_text)
+
+
 if __name__ == "__main__":
     raise SystemExit(main(sys.argv))
-
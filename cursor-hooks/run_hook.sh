@@ -20,5 +20,13 @@ else
   PYTHON_BIN="python3"
 fi
 
+# warm 模式：run_hook.py 把 hook 交给常驻 hook daemon 执行，
+# daemon 不可用时再退回直接启动 hook 解释器（ORTENSIA_HOOK_WARM=0 可关闭）
+RUNNER="$(dirname "$0")/run_hook.py"
+if [ -f "$RUNNER" ] && [ "${ORTENSIA_HOOK_WARM:-1}" != "0" ]; then
+  export CURSOR_AGENT_PYTHON="$PYTHON_BIN"
+  exec "$PYTHON_BIN" -S "$RUNNER" "$HOOK_SCRIPT" "$@"
+fi
+
 exec "$PYTHON_BIN" "$HOOK_SCRIPT" "$@"
 
@@ -199,12 +199,48 @@
           platform: process.platform,
           pid: process.pid,
           ws_port: 9876,
-          capabilities: ["composer", "editor", "terminal", "conversation_id"],
+          capabilities: ["composer", "editor", "terminal", "conversation_id", "js_templates"],
         },
       };
       sendToCentral(registerMessage);
     }
 
+    // 注入脚本模板（server 注册时下发，见 bridge/js_templates.py）
+    // 每个渲染进程按 hash 缓存编译好的函数：window.__ortensiaTemplates[hash]
+    const jsTemplates = new Map(); // name -> { hash, source }
+    const TEMPLATE_MISSING = "__ortensia_template_missing__";
+
+    function handleTemplateDefine(payload) {
+      for (const t of payload.templates || []) {
+        jsTemplates.set(t.name, { hash: t.hash, source: t.source });
+      }
+      log(`📜 [Template] 已缓存 ${jsTemplates.size} 个脚本模板: ${[...jsTemplates.keys()].join(", ")}`);
+    }
+
+    function resolveTemplate(payload) {
+      const t = jsTemplates.get(payload.template);
+      if (!t) throw new Error(`未知模板: ${payload.template}`);
+      if (payload.template_hash && t.hash !== payload.template_hash) {
+        throw new Error(`模板版本不一致: ${payload.template} (${t.hash} != ${payload.template_hash})`);
+      }
+      const hashKey = JSON.stringify(t.hash);
+      return {
+        define: `(() => { window.__ortensiaTemplates = window.__ortensiaTemplates || {}; window.__ortensiaTemplates[${hashKey}] = (${t.source}); return true; })()`,
+        invoke: `(() => { const fn = window.__ortensiaTemplates && window.__ortensiaTemplates[${hashKey}]; return fn ? fn(${JSON.stringify(payload.args || {})}) : ${JSON.stringify(TEMPLATE_MISSING)}; })()`,
+      };
+    }
+
+    async function runInWindow(win, code, template) {
+      if (!template) return win.webContents.executeJavaScript(code);
+      let result = await win.webContents.executeJavaScript(template.invoke);
+      if (result === TEMPLATE_MISSING) {
+        // 新窗口或页面重载后缓存丢失：定义一次再调用
+        await win.webContents.executeJavaScript(template.define);
+        result = await win.webContents.executeJavaScript(template.invoke);
+      }
+      return result;
+    }
+
     async function handleExecuteJs(fromId, payload) {
       const code = payload.code || "";
       const requestId = payload.request_id || "unknown";
@@ -216,6 +252,7 @@
       );
 
       try {
+        const template = payload.template ? resolveTemplate(payload) : null;
         const electron = await import("electron");
         const windows = electron.BrowserWindow.getAllWindows();
         if (windows.length === 0) throw new Error("没有打开的窗口");
@@ -255,13 +292,13 @@
 
         if (targetIndex !== null) {
           const targetWindow = windows[targetIndex];
-          result = await targetWindow.webContents.executeJavaScript(code);
+          result = await runInWindow(targetWindow, code, template);
         } else {
           log(`📢 [广播模式] 在所有 ${windows.length} 个窗口执行`);
           const results = {};
           for (let i = 0; i < windows.length; i++) {
             try {
-              const windowResult = await windows[i].webContents.executeJavaScript(code);
+              const windowResult = await runInWindow(windows[i], code, template);
               results[i] = windowResult;
               log(`  ✅ 窗口 [${i}] 执行成功`);
             } catch (err) {
@@ -304,6 +341,8 @@
       const { type, from, payload } = message;
       if (type === "execute_js") {
         await handleExecuteJs(from, payload || {});
+      } else if (type === "js_template_define") {
+        handleTemplateDefine(payload || {});
       } else {
         // ignore unknown messages for now
       }
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+"""
+中央服务器（bridge/websocket_server.py）吞吐 / 延迟基准
+
+在本进程内启动服务器（随机端口），再启动模拟客户端：
+- cursor_inject:  像 ortensia-injector.js 一样响应 execute_js（广播模式返回 {窗口索引: JSON 字符串}）
+- agent_hook:     发送 aituber_receive_text
+- aituber_client: 接收 hook 消息 / session 事件
+- command_client: 发送命令、input_submit、get_conversation_id
+
+场景：
+1. route       command_client → inject → command_client（agent_execute_prompt / *_result）往返与单程延迟
+2. hook        多个 hook 并发发送 aituber_receive_text，统计投递吞吐（msgs/s）和延迟
+3. fanout      单条 hook 消息广播到 N 个 aituber_client，到最后一个客户端收到为止的延迟
+4. input       input_submit → input_ack / cursor_input_text_result（经 session 队列和 inject）
+5. discovery   get_conversation_id → 每个窗口一条 get_conversation_id_result
+               （discovery：关闭对话目录缓存，每次都在 inject 执行查询脚本；discovery_cached：缓存命中）
+6. memory      每个已注册空闲连接占用的内存（tracemalloc，含同进程内客户端一侧）
+7. throttle    （正确性检查）直通快速路径上的 aituber_speak 超出 event 预算时被拒绝
+
+Usage:
+  python tests/bench_central_server.py
+  python tests/bench_central_server.py --quick
+  python tests/bench_central_server.py --json out.json               # 保存结果
+  python tests/bench_central_server.py --baseline out.json           # 与基线比较，退化超过容差时退出码 1
+  python tests/bench_central_server.py --max-route-p99-ms 20 --min-hook-throughput 5000
+  python tests/bench_central_server.py --url ws://127.0.0.1:8765     # 测已启动的服务器（例如多进程模式）
+
+注意：默认服务器和模拟客户端共用一个事件循环，数值用于比较前后版本，而不是绝对容量。
+使用 --url 时不测 memory、throttle 和 discovery_cached（服务器不在本进程内），discovery 按该服务器的缓存配置。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import websockets
+
+BRIDGE_DIR = Path(__file__).resolve().parent.parent / "bridge"
+sys.path.insert(0, str(BRIDGE_DIR))
+
+# 基准要测的是服务器本身的容量，关闭准入限流（--url 连接的外部服务器按其自身配置）
+os.environ.setdefault("ORTENSIA_RATE_LIMITS", "off")
+
+import websocket_server  # noqa: E402
+
+# 服务器默认 DEBUG 日志，会严重拉低基准数值
+SERVER_LOG_LEVEL = os.environ.get("BENCH_SERVER_LOG_LEVEL", "WARNING")
+
+
+# ============================================================================
+# 统计工具
+# ============================================================================
+
+def percentile(samples, p):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def summarize(samples):
+    """毫秒样本 → p50/p95/p99/max"""
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 0.50), 3),
+        "p95_ms": round(percentile(samples, 0.95), 3),
+        "p99_ms": round(percentile(samples, 0.99), 3),
+        "max_ms": round(max(samples), 3) if samples else float("nan"),
+    }
+
+
+def now_ms():
+    return time.perf_counter() * 1000
+
+
+# ============================================================================
+# 模拟客户端
+# ============================================================================
+
+class Peer:
+    """已注册的模拟客户端；收到的消息按类型分发给 on_message"""
+
+    client_type = "unknown"
+
+    def __init__(self, url, client_id):
+        self.url = url
+        self.client_id = client_id
+        self.ws = None
+        self._reader = None
+        self.received = 0
+
+    async def start(self, **register_payload):
+        self.ws = await websockets.connect(self.url, max_size=None)
+        await self.ws.send(json.dumps({
+            "type": "register",
+            "from": self.client_id,
+            "to": "server",
+            "timestamp": int(time.time()),
+            "payload": {"client_type": self.client_type, **register_payload},
+        }))
+        ack = json.loads(await self.ws.recv())
+        assert ack["type"] == "register_ack", ack
+        self._reader = asyncio.create_task(self._read_loop())
+        return self
+
+    async def _read_loop(self):
+        try:
+            async for raw in self.ws:
+                self.received += 1
+                await self.on_message(json.loads(raw))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def on_message(self, msg):
+        pass
+
+    async def send(self, msg_type, to, payload):
+        await self.ws.send(json.dumps({
+            "type": msg_type,
+            "from": self.client_id,
+            "to": to,
+            "timestamp": int(time.time()),
+            "payload": payload,
+        }))
+
+    async def close(self):
+        if self._reader:
+            self._reader.cancel()
+        if self.ws:
+            await self.ws.close()
+
+
+class InjectPeer(Peer):
+    """cursor_inject 替身：按 ortensia-injector.js 的格式回复 execute_js 和命令"""
+
+    client_type = "cursor_inject"
+
+    def __init__(self, url, client_id, windows=3, js_delay_ms=0.0):
+        super().__init__(url, client_id)
+        self.windows = [f"conv-{client_id}-{i:04d}" for i in range(windows)]
+        self.js_delay = js_delay_ms / 1000
+        self.route_latency = []  # command → inject 单程（ms）
+
+    def _window_result(self, code, conv_id):
+        if "composer-bottom-add-context" in code and "conversationId" in code:
+            return json.dumps({"found": True, "conversationId": conv_id, "title": f"Chat {conv_id[-4:]}",
+                               "elementId": f"composer-bottom-add-context-{conv_id}"})
+        return json.dumps({"success": True, "skipped": False})
+
+    async def on_message(self, msg):
+        msg_type = msg["type"]
+        payload = msg.get("payload") or {}
+        if msg_type == "execute_js":
+            if self.js_delay:
+                await asyncio.sleep(self.js_delay)
+            code = payload.get("code", "")
+            if payload.get("window_index") is not None:
+                index = payload["window_index"]
+                result = json.loads(self._window_result(code, self.windows[index]))
+            else:
+                # 广播模式：{窗口索引: 原始字符串}
+                result = {str(i): self._window_result(code, conv) for i, conv in enumerate(self.windows)}
+            await self.send("execute_js_result", msg["from"], {
+                "success": True, "result": result, "request_id": payload.get("request_id"),
+            })
+        elif msg_type == "agent_execute_prompt":
+            sent_at = payload.get("sent_at")
+            if sent_at is not None:
+                self.route_latency.append(now_ms() - sent_at)
+            await self.send("agent_execute_prompt_result", msg["from"], {
+                "success": True, "agent_id": payload.get("agent_id", "default"), "sent_at": sent_at,
+            })
+
+
+class WaiterPeer(Peer):
+    """按消息类型等待响应的客户端（command_client / aituber_client）"""
+
+    def __init__(self, url, client_id, client_type):
+        super().__init__(url, client_id)
+        self.client_type = client_type
+        self.latency = {}  # msg_type → [ms]，按 payload.sent_at 计算
+        self._waiters = {}  # msg_type → [future]
+
+    def wait_for(self, msg_type):
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(msg_type, []).append(fut)
+        return fut
+
+    async def on_message(self, msg):
+        msg_type = msg["type"]
+        sent_at = (msg.get("payload") or {}).get("sent_at")
+        if sent_at is not None:
+            self.latency.setdefault(msg_type, []).append(now_ms() - sent_at)
+        waiters = self._waiters.get(msg_type)
+        if waiters:
+            fut = waiters.pop(0)
+            if not fut.done():
+                fut.set_result(msg)
+
+
+# ============================================================================
+# 场景
+# ============================================================================
+
+async def bench_route(url, inject, count, concurrency):
+    """command_client → inject → command_client"""
+    cmd = await WaiterPeer(url, "bench-cmd-route", "command_client").start()
+    round_trips = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            fut = cmd.wait_for("agent_execute_prompt_result")
+            start = now_ms()
+            await cmd.send("agent_execute_prompt", inject.client_id,
+                           {"prompt": f"p{i}", "agent_id": "bench", "sent_at": start})
+            await asyncio.wait_for(fut, 10)
+            round_trips.append(now_ms() - start)
+
+    inject.route_latency.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(count)])
+    elapsed = time.perf_counter() - started
+    await cmd.close()
+    return {
+        "messages_per_sec": round(count * 2 / elapsed, 1),  # 每次往返经过服务器两次
+        "one_way": summarize(inject.route_latency),
+        "round_trip": summarize(round_trips),
+    }
+
+
+async def bench_hook_throughput(url, hooks, aitubers, per_hook):
+    """多个 hook 并发发送，多个 aituber 接收"""
+    receivers = [await WaiterPeer(url, f"bench-aituber-tp-{i}", "aituber_client").start() for i in range(aitubers)]
+    senders = [await Peer(url, f"hook-bench-tp-{i}").start(client_type="agent_hook") for i in range(hooks)]
+    expected = hooks * per_hook * aitubers
+
+    async def blast(peer):
+        for n in range(per_hook):
+            await peer.send("aituber_receive_text", "aituber",
+                            {"text": f"event {n}", "emotion": "happy", "sent_at": now_ms()})
+
+    started = time.perf_counter()
+    await asyncio.gather(*[blast(p) for p in senders])
+    deadline = time.perf_counter() + 30
+    while sum(r.received for r in receivers) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    delivered = sum(r.received for r in receivers)
+    latency = [ms for r in receivers for ms in r.latency.get("aituber_receive_text", [])]
+    for p in senders + receivers:
+        await p.close()
+    return {
+        "hooks": hooks,
+        "aitubers": aitubers,
+        "sent": hooks * per_hook,
+        "delivered": delivered,
+        "expected": expected,
+        "deliveries_per_sec": round(delivered / elapsed, 1),
+        "latency": summarize(latency),
+    }
+
+
+async def bench_fanout(url, client_counts, rounds):
+    """广播到 N 个 aituber_client 的完成延迟（最后一个客户端收到为止）"""
+    hook = await Peer(url, "hook-bench-fanout").start(client_type="agent_hook")
+    results = []
+    for n in client_counts:
+        receivers = [await WaiterPeer(url, f"bench-aituber-fo-{n}-{i}", "aituber_client").start() for i in range(n)]
+        completion = []
+        for r in range(rounds):
+            futs = [rc.wait_for("aituber_receive_text") for rc in receivers]
+            start = now_ms()
+            await hook.send("aituber_receive_text", "aituber", {"text": f"fanout {r}", "sent_at": start})
+            await asyncio.wait_for(asyncio.gather(*futs), 10)
+            completion.append(now_ms() - start)
+        results.append({"clients": n, **summarize(completion)})
+        for rc in receivers:
+            await rc.close()
+    await hook.close()
+    return results
+
+
+async def bench_input(url, count):
+    """input_submit → input_ack → cursor_input_text_result（经过 session 队列与 inject）"""
+    cmd = await WaiterPeer(url, "bench-cmd-input", "command_client").start()
+    ack_latency, result_latency = [], []
+    for i in range(count):
+        ack = cmd.wait_for("input_ack")
+        result = cmd.wait_for("cursor_input_text_result")
+        start = now_ms()
+        await cmd.send("input_submit", "server", {
+            "client_event_id": f"bench-input-{i}-{time.time_ns()}",
+            "text": f"bench input {i}",
+            "conversation_id": None,
+            "execute": False,
+            "session_id": "bench-session",
+        })
+        await asyncio.wait_for(ack, 10)
+        ack_latency.append(now_ms() - start)
+        await asyncio.wait_for(result, 10)
+        result_latency.append(now_ms() - start)
+    await cmd.close()
+    return {"ack": summarize(ack_latency), "result": summarize(result_latency)}
+
+
+async def bench_discovery(url, inject, count, client_id="bench-cmd-discovery"):
+    """get_conversation_id → 每个窗口一条结果"""
+    cmd = await WaiterPeer(url, client_id, "command_client").start()
+    first, complete = [], []
+    windows = len(inject.windows)
+    for i in range(count):
+        futs = [cmd.wait_for("get_conversation_id_result") for _ in range(windows)]
+        start = now_ms()
+        await cmd.send("get_conversation_id", "server", {"request_id": f"bench-disc-{i}"})
+        await asyncio.wait_for(futs[0], 10)
+        first.append(now_ms() - start)
+        await asyncio.wait_for(asyncio.gather(*futs), 10)
+        complete.append(now_ms() - start)
+    await cmd.close()
+    return {"windows": windows, "first_result": summarize(first), "all_results": summarize(complete)}
+
+
+async def check_relay_throttle(url, frames=100, rate=10, burst=20):
+    """
+    直通快速路径上的预算类型（aituber_speak）同样受准入控制：超出突发的帧不转发，发送方收到 throttled
+
+    临时打开限流并调低 event 预算（只在本进程内启动服务器时运行）
+    """
+    limits = websocket_server.RATE_LIMITS
+    saved = websocket_server.RATE_LIMIT_ENABLED, limits["event"]
+    websocket_server.RATE_LIMIT_ENABLED, limits["event"] = True, (rate, burst)
+    try:
+        receiver = await WaiterPeer(url, "bench-throttle-rx", "aituber_client").start()
+        sender = await WaiterPeer(url, "bench-throttle-tx", "command_client").start()
+        throttled = sender.wait_for("throttled")
+        for i in range(frames):
+            await sender.send("aituber_speak", receiver.client_id, {"text": str(i)})
+        await asyncio.wait_for(throttled, 5)
+        await asyncio.sleep(0.2)
+        delivered = receiver.received
+        await sender.close()
+        await receiver.close()
+    finally:
+        websocket_server.RATE_LIMIT_ENABLED, limits["event"] = saved
+    # 发送期间按 rate 补充的少量令牌也会放行
+    assert delivered < frames, f"aituber_speak 未被限流: {delivered}/{frames}"
+    return {"frames": frames, "delivered": delivered}
+
+
+async def bench_memory(url, connections):
+    """每个已注册空闲连接的内存（服务端 + 同进程客户端两侧）"""
+    import gc
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    peers = [await WaiterPeer(url, f"bench-idle-{i}", "aituber_client").start() for i in range(connections)]
+    await asyncio.sleep(0.2)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    for p in peers:
+        await p.close()
+    return {"connections": connections, "bytes_per_connection": int((after - before) / connections)}
+
+
+# ============================================================================
+# 主流程
+# ============================================================================
+
+def compare_with_baseline(current, baseline, tolerance):
+    """返回退化项列表（延迟上升或吞吐下降超过容差）"""
+    regressions = []
+
+    def walk(cur, base, path):
+        if isinstance(cur, dict) and isinstance(base, dict):
+            for key, value in cur.items():
+                if key in base:
+                    walk(value, base[key], f"{path}.{key}" if path else key)
+        elif isinstance(cur, list) and isinstance(base, list):
+            for i, (c, b) in enumerate(zip(cur, base)):
+                walk(c, b, f"{path}[{i}]")
+        elif isinstance(cur, (int, float)) and isinstance(base, (int, float)) and base > 0:
+            if path.endswith("_ms") or path.endswith("bytes_per_connection"):
+                if cur > base * (1 + tolerance):
+                    regressions.append(f"{path}: {base} → {cur}")
+            elif path.endswith("_per_sec"):
+                if cur < base * (1 - tolerance):
+                    regressions.append(f"{path}: {base} → {cur}")
+
+    walk(current, baseline, "")
+    return regressions
+
+
+async def run(args):
+    logging.getLogger().setLevel(SERVER_LOG_LEVEL)
+
+    if args.url:
+        server, url = None, args.url
+    else:
+        server = await websockets.serve(websocket_server.handle_client, "127.0.0.1", 0, max_size=None)
+        port = server.sockets[0].getsockname()[1]
+        url = f"ws://127.0.0.1:{port}"
+
+    inject = await InjectPeer(url, "bench-inject", windows=args.windows, js_delay_ms=args.js_delay_ms).start(
+        inject_id="bench-inject", workspace="/bench")
+
+    results = {}
+    try:
+        print("▶ route ...", flush=True)
+        results["route"] = await bench_route(url, inject, args.route_count, args.concurrency)
+        print("▶ hook throughput ...", flush=True)
+        results["hook"] = await bench_hook_throughput(url, args.hooks, args.aitubers, args.per_hook)
+        print("▶ fanout ...", flush=True)
+        results["fanout"] = await bench_fanout(url, args.fanout, args.fanout_rounds)
+        print("▶ input ...", flush=True)
+        results["input"] = await bench_input(url, args.input_count)
+        print("▶ discovery ...", flush=True)
+        if server is not None:
+            directory = websocket_server.conversation_directory
+            ttl, directory.ttl = directory.ttl, 0
+            try:
+                results["discovery"] = await bench_discovery(url, inject, args.discovery_count)
+            finally:
+                directory.ttl = ttl
+            print("▶ discovery (cached) ...", flush=True)
+            results["discovery_cached"] = await bench_discovery(
+                url, inject, args.discovery_count, client_id="bench-cmd-discovery-cached")
+        else:
+            results["discovery"] = await bench_discovery(url, inject, args.discovery_count)
+        if server is not None:
+            print("▶ relay throttle ...", flush=True)
+            results["throttle"] = await check_relay_throttle(url)
+            print("▶ memory ...", flush=True)
+            results["memory"] = await bench_memory(url, args.idle_connections)
+    finally:
+        await inject.close()
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+    return results
+
+
+def print_report(results):
+    print("=" * 72)
+    print("📊 中央服务器基准")
+    print("=" * 72)
+    r = results["route"]
+    print(f"route       {r['messages_per_sec']:>10.1f} msg/s   one-way p50/p95/p99 "
+          f"{r['one_way']['p50_ms']}/{r['one_way']['p95_ms']}/{r['one_way']['p99_ms']} ms   "
+          f"rtt p99 {r['round_trip']['p99_ms']} ms")
+    h = results["hook"]
+    print(f"hook        {h['deliveries_per_sec']:>10.1f} deliveries/s  ({h['delivered']}/{h['expected']})  "
+          f"p50/p99 {h['latency']['p50_ms']}/{h['latency']['p99_ms']} ms")
+    for f in results["fanout"]:
+        print(f"fanout x{f['clients']:<4} p50/p95/p99 {f['p50_ms']}/{f['p95_ms']}/{f['p99_ms']} ms")
+    i = results["input"]
+    print(f"input       ack p99 {i['ack']['p99_ms']} ms   result p50/p99 {i['result']['p50_ms']}/{i['result']['p99_ms']} ms")
+    d = results["discovery"]
+    print(f"discovery   first p50 {d['first_result']['p50_ms']} ms   all({d['windows']}) p99 {d['all_results']['p99_ms']} ms")
+    d = results.get("discovery_cached")
+    if d:
+        print(f"  (cached)  first p50 {d['first_result']['p50_ms']} ms   all({d['windows']}) p99 {d['all_results']['p99_ms']} ms")
+    t = results.get("throttle")
+    if t:
+        print(f"throttle    aituber_speak 直通 {t['delivered']}/{t['frames']} 帧放行（其余回复 throttled）")
+    m = results.get("memory")
+    if m:
+        print(f"memory      {m['bytes_per_connection'] / 1024:.1f} KiB / connection ({m['connections']} idle)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ortensia 中央服务器基准")
+    parser.add_argument("--quick", action="store_true", help="缩小规模，快速冒烟")
+    parser.add_argument("--url", help="连接已启动的服务器，而不是在本进程内启动")
+    parser.add_argument("--route-count", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--hooks", type=int, default=20)
+    parser.add_argument("--aitubers", type=int, default=3)
+    parser.add_argument("--per-hook", type=int, default=200)
+    parser.add_argument("--fanout", type=lambda s: [int(x) for x in s.split(",")], default=[1, 10, 50, 100])
+    parser.add_argument("--fanout-rounds", type=int, default=50)
+    parser.add_argument("--input-count", type=int, default=200)
+    parser.add_argument("--discovery-count", type=int, default=100)
+    parser.add_argument("--idle-connections", type=int, default=200)
+    parser.add_argument("--windows", type=int, default=3, help="模拟 inject 的窗口数")
+    parser.add_argument("--js-delay-ms", type=float, default=0.0, help="模拟 execute_js 执行耗时")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与基线 JSON 比较")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="基线比较容差（默认 25%%）")
+    parser.add_argument("--max-route-p99-ms", type=float, default=None)
+    parser.add_argument("--min-hook-throughput", type=float, default=None)
+    args = parser.parse_args()
+
+    if args.quick:
+        args.route_count, args.per_hook, args.hooks = 300, 50, 5
+        args.fanout, args.fanout_rounds = [1, 10, 50], 10
+        args.input_count, args.discovery_count, args.idle_connections = 30, 20, 50
+
+    results = asyncio.run(run(args))
+    print_report(results)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"💾 结果已写入 {args.json}")
+
+    failures = []
+    if args.max_route_p99_ms is not None and results["route"]["one_way"]["p99_ms"] > args.max_route_p99_ms:
+        failures.append(f"route one-way p99 {results['route']['one_way']['p99_ms']}ms > {args.max_route_p99_ms}ms")
+    if args.min_hook_throughput is not None and results["hook"]["deliveries_per_sec"] < args.min_hook_throughput:
+        failures.append(f"hook throughput {results['hook']['deliveries_per_sec']}/s < {args.min_hook_throughput}/s")
+    if results["hook"]["delivered"] < results["hook"]["expected"]:
+        failures.append(f"hook 消息丢失: {results['hook']['delivered']}/{results['hook']['expected']}")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        failures.extend(compare_with_baseline(results, baseline, args.tolerance))
+
+    if failures:
+        print("❌ 性能退化:")
+        for f in failures:
+            print(f"   • {f}")
+        return 1
+    print("✅ 未发现退化")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Session 去重表微基准：旧的列表实现 vs bridge/websocket_server.py 中的 _RecentIdMap
+
+每个 INPUT_SUBMIT / CLIENT_EVENT_SUBMIT 都会查询并插入一次去重表。
+旧实现在表满之后每次插入都要切片重建列表（O(N)），_RecentIdMap 用 OrderedDict 做定长环（O(1)）。
+
+对每个容量 N，先插满 N 个 id，再测量表满状态下继续插入的平均耗时；
+新实现各容量下的耗时应基本不变。
+
+Usage:
+  python tests/bench_recent_ids.py
+  python tests/bench_recent_ids.py --sizes 1024 10000 100000 --inserts 20000
+"""
+
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bridge"))
+
+import websocket_server  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+class LegacyRecentIdSet:
+    """旧实现（对照组）"""
+
+    def __init__(self, max_size: int = 512):
+        self.max_size = max_size
+        self._items = []
+        self._set = set()
+
+    def __contains__(self, item: str) -> bool:
+        return item in self._set
+
+    def add(self, item: str):
+        if item in self._set:
+            return
+        self._set.add(item)
+        self._items.append(item)
+        if len(self._items) > self.max_size:
+            drop = self._items[: len(self._items) - self.max_size]
+            self._items = self._items[-self.max_size :]
+            for d in drop:
+                self._set.discard(d)
+
+
+def _measure(factory, size: int, inserts: int) -> float:
+    """表满之后每次「查询 + 插入」的平均耗时（纳秒）"""
+    table = factory(size)
+    for i in range(size):
+        table.add(f"evt_warm_{i}")
+    ids = [f"evt_{i}" for i in range(inserts)]
+    start = time.perf_counter_ns()
+    for seq, event_id in enumerate(ids):
+        if event_id not in table:
+            if isinstance(table, LegacyRecentIdSet):
+                table.add(event_id)
+            else:
+                table.add(event_id, seq)
+    return (time.perf_counter_ns() - start) / inserts
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 10_000, 100_000])
+    parser.add_argument("--inserts", type=int, default=20_000)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"🧪 去重表：表满后每次查询 + 插入的平均耗时（{args.inserts} 次）")
+    print("=" * 60)
+    print(f"{'容量':>10}{'旧实现 ns':>16}{'_RecentIdMap ns':>20}")
+    for size in args.sizes:
+        legacy = _measure(LegacyRecentIdSet, size, args.inserts)
+        ring = _measure(websocket_server._RecentIdMap, size, args.inserts)
+        print(f"{size:>10}{legacy:>16.0f}{ring:>20.0f}")
+
+    # 正确性：容量内保留最近的 id 与 seq，超出后淘汰最早的
+    table = websocket_server._RecentIdMap(max_size=3)
+    for seq, event_id in enumerate(["a", "b", "c", "d"], start=1):
+        table.add(event_id, seq)
+    assert "a" not in table and len(table) == 3
+    assert table.get("d") == 4 and table.get("a", -1) == -1
+    print("✅ 淘汰顺序与 seq 映射正确")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())